@@ -0,0 +1,167 @@
+import pandas as pd
+import os
+from os import path
+import functools
+import pickle as pkl
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import util_funcs
+from util_funcs import read_config, get_data_split, get_reference_node_types
+
+MANIFEST_VERSION = 1 #bump if the pickled layout changes, invalidates every saved manifest
+MANIFEST_COLUMNS = ["split", "ref", "patient_prefix", "patient", "session", "token", "edf_path", "tse_path", "lbl_path", "txt_path"]
+
+CorpusManifest = namedtuple("CorpusManifest", ["tokens", "patient_dirs", "session_dirs"])
+
+def get_split_root_dir(data_split, ref):
+    """directory holding the patient prefix dirs (000, 001, ...) of a split"""
+    assert data_split in get_data_split()
+    assert ref in get_reference_node_types()
+    config = read_config()
+    if data_split is None:
+        return config["data_dir_root"] + "/" + ref
+    return config[data_split + "_" + ref]
+
+def get_manifest_path(data_split, ref):
+    return path.join(util_funcs.get_cache_dir("corpus_manifest"), "{}_{}.pkl".format(data_split, ref))
+
+def scan_dir(dir_path, dir_listings=None):
+    """Lists a directory with os.scandir, in the same order as os.listdir
+
+    Parameters
+    ----------
+    dir_path : str
+    dir_listings : dict
+        previous listings, dir path -> (mtime, entries). If dir_path is in there
+        and its mtime hasn't changed, the old entries are used without listing
+        the directory again
+
+    Returns
+    -------
+    float
+        mtime of the directory
+    list
+        (name, full path, is_dir) of every entry
+    """
+    mtime = os.stat(dir_path).st_mtime #stat before listing, so a change during the listing shows up next time
+    if dir_listings is not None and dir_path in dir_listings and dir_listings[dir_path][0] == mtime:
+        return dir_listings[dir_path]
+    with os.scandir(dir_path) as dir_entries:
+        entries = [(entry.name, path.join(dir_path, entry.name), entry.is_dir()) for entry in dir_entries]
+    return mtime, entries
+
+def walk_patient_dir(patient_dir, old_dir_listings=None):
+    """Scans the session dirs of a patient
+
+    Returns
+    -------
+    dict
+        dir path -> (mtime, entries) for the patient dir and every session dir
+    """
+    dir_listings = {patient_dir: scan_dir(patient_dir, old_dir_listings)}
+    for name, session_dir, is_dir in dir_listings[patient_dir][1]:
+        if is_dir:
+            dir_listings[session_dir] = scan_dir(session_dir, old_dir_listings)
+    return dir_listings
+
+def get_manifest_rows(data_split, ref, patient_prefix, patient_dir, dir_listings):
+    """token rows of a walked patient dir, sibling label/notes files are looked
+        up in the session listing instead of being stat'ed
+    """
+    rows = []
+    patient = path.basename(patient_dir)
+    for session, session_dir, is_dir in dir_listings[patient_dir][1]:
+        if not is_dir:
+            continue
+        session_files = set([name for name, full_path, is_dir in dir_listings[session_dir][1]])
+        for token, edf_path, is_dir in dir_listings[session_dir][1]:
+            if token[-4:] != ".edf":
+                continue
+            sibling_paths = [edf_path[:-4] + ".tse", edf_path[:-4] + ".lbl", edf_path[:-9] + ".txt"]
+            sibling_paths = [sibling_path if path.basename(sibling_path) in session_files else None for sibling_path in sibling_paths]
+            rows.append((data_split, ref, patient_prefix, patient, session, token, edf_path, *sibling_paths))
+    return rows
+
+def build_manifest(data_split, ref, n_threads=None, rebuild=False):
+    """Walks a split with os.scandir, patient dirs in parallel threads, and
+        persists every directory listing in the cache dir together with its
+        mtime. Next time, only directories whose mtime changed are listed again
+        (adding or removing files in a directory changes its mtime), the rest
+        just get stat'ed
+
+    Parameters
+    ----------
+    data_split : str
+    ref : str
+    n_threads : int
+        threads walking patient dirs. If None, "manifest_threads" from the
+        config, defaults to 16
+    rebuild : bool
+        if True, ignores any saved listings and walks everything again
+
+    Returns
+    -------
+    CorpusManifest
+        tokens : pd.DataFrame, one row per edf token with MANIFEST_COLUMNS, in
+            the same order get_all_token_file_names always returned them.
+            tse_path/lbl_path/txt_path are None if the file doesn't exist
+        patient_dirs : list
+        session_dirs : list
+    """
+    if n_threads is None:
+        n_threads = read_config()["manifest_threads"] if "manifest_threads" in read_config() else 16
+    root_dir = get_split_root_dir(data_split, ref)
+    manifest_path = get_manifest_path(data_split, ref)
+    old_dir_listings = {}
+    if path.exists(manifest_path) and not rebuild:
+        saved = pkl.load(open(manifest_path, "rb"))
+        if saved["version"] == MANIFEST_VERSION and saved["root_dir"] == root_dir:
+            old_dir_listings = saved["dir_listings"]
+
+    dir_listings = {root_dir: scan_dir(root_dir, old_dir_listings)}
+    patient_dirs = []
+    patient_prefixes = []
+    for patient_prefix, prefix_dir, is_dir in dir_listings[root_dir][1]:
+        if not is_dir:
+            continue
+        dir_listings[prefix_dir] = scan_dir(prefix_dir, old_dir_listings)
+        for patient, patient_dir, is_patient_dir in dir_listings[prefix_dir][1]:
+            if is_patient_dir:
+                patient_dirs.append(patient_dir)
+                patient_prefixes.append(patient_prefix)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        patient_listings = list(executor.map(lambda patient_dir: walk_patient_dir(patient_dir, old_dir_listings), patient_dirs))
+
+    rows = []
+    session_dirs = []
+    for patient_prefix, patient_dir, patient_listing in zip(patient_prefixes, patient_dirs, patient_listings):
+        dir_listings.update(patient_listing)
+        session_dirs += [session_dir for name, session_dir, is_dir in patient_listing[patient_dir][1] if is_dir]
+        rows += get_manifest_rows(data_split, ref, patient_prefix, patient_dir, patient_listing)
+
+    if dir_listings != old_dir_listings:
+        os.makedirs(path.dirname(manifest_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid()) #write then rename so other processes never see a partial file
+        pkl.dump({"version": MANIFEST_VERSION, "root_dir": root_dir, "dir_listings": dir_listings}, open(tmp_path, "wb"))
+        os.replace(tmp_path, manifest_path)
+    return CorpusManifest(
+        tokens=pd.DataFrame(rows, columns=MANIFEST_COLUMNS),
+        patient_dirs=patient_dirs,
+        session_dirs=session_dirs)
+
+@functools.lru_cache(10)
+def get_manifest(data_split, ref):
+    """cached version of build_manifest, checked for changed directories once per process
+    """
+    return build_manifest(data_split, ref)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="builds (or incrementally updates) the corpus manifest for a split")
+    parser.add_argument("data_split")
+    parser.add_argument("ref")
+    parser.add_argument("--n_threads", type=int, default=None)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+    manifest = build_manifest(args.data_split, args.ref, n_threads=args.n_threads, rebuild=args.rebuild)
+    print("{} tokens in {} sessions of {} patients, saved to {}".format(len(manifest.tokens), len(manifest.session_dirs), len(manifest.patient_dirs), get_manifest_path(args.data_split, args.ref)))
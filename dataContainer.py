@@ -6,6 +6,7 @@ import pyedflib
 from os import path
 import sys, os
 import util_funcs
+import feature_store as fstore
 from util_funcs import read_config, get_abs_files, get_annotation_types, get_data_split, get_reference_node_types, np_rolling_window
 import multiprocessing as mp
 import argparse
@@ -18,26 +19,319 @@ from wf_analysis import filters
 from addict import Dict
 import functools
 from copy import deepcopy
+from collections import OrderedDict
+import threading
+import time
+
+class TransformNode():
+    """A step of a DataContainerV2 pipeline
+
+    Parameters
+    ----------
+    name : str
+    inputs : list
+        names of the nodes this one reads from
+    func : callable
+        for function nodes, called with the input values of an index
+    dataset : array-like
+        for dataset nodes, indexed directly, reads its inputs through NodeViews
+    memoize : bool
+        keep the last cache_size outputs of this node, by index. Costs up to
+        cache_size outputs of memory in every process that evaluates the node,
+        each pool worker included, i.e. cache_size whole recordings for an
+        EdfDataset source
+    cache_size : int
+    """
+    def __init__(self, name, inputs=[], func=None, dataset=None, memoize=False, cache_size=4):
+        self.name = name
+        self.inputs = list(inputs)
+        self.func = func
+        self.dataset = dataset
+        self.memoize = memoize
+        self.cache_size = cache_size
+        self.cache = OrderedDict() #index -> output, in lru order
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict() #copies of the container start with empty caches
+        return state
+
+class NodeView():
+    """Array-like over the outputs of a node, handed to the datasets of
+        downstream nodes in place of the dataset they used to read from.
+        Attributes it doesn't have itself (i.e. expand_tse) are looked up on
+        the dataset of the node
+    """
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith("__") or "container" not in self.__dict__: #copy and pickle look things up before __init__ ran
+            raise AttributeError(name)
+        dataset = self.container.nodes[self.name].dataset
+        if dataset is None:
+            raise AttributeError("{} is a function node, it has no attribute {}".format(self.name, name))
+        return getattr(dataset, name)
+
+    def get_feature_key(self, i):
+        """feature_store key of item i, the key of the node's dataset combined
+            with the node name. None for function nodes and datasets without keys
+        """
+        dataset = self.container.nodes[self.name].dataset
+        if dataset is None:
+            return None
+        return fstore.get_layer_key(fstore.get_dataset_item_key(dataset, i), type(self).__name__, (self.name,))
+
+    def __len__(self):
+        return len(self.container)
+
+    def __getitem__(self, i):
+        if type(i) == slice or type(i) == list:
+            indices = range(*i.indices(len(self))) if type(i) == slice else i
+            return [self.container.get_node_output(self.name, j) for j in indices]
+        return self.container.get_node_output(self.name, i)
+
+    def get_upstream_datasets(self):
+        return [self.container]
 
 class DataContainerV2(util_funcs.MultiProcessingDataset):
-    def __init__(self):
+    """Lazy DAG of transform nodes over one source dataset. Instead of stacking
+        transformers that each read (and re-filter) the base item on their own,
+        every node gets its inputs from the container, so within one index each
+        node runs once and its output is fanned out to every consumer. Nodes
+        can also memoize a few recent outputs across indices, off by default
+        since every process keeps its own cache
+
+        container = DataContainerV2(read.EdfDataset(...))
+        container.attachNewDataTransformer("fft", lambda source: read.EdfFFTDatasetTransformer(source, n_process=1))
+        container.attachNewDataTransformer("coherence", lambda source: wfdata.CoherenceTransformer(source, n_process=1))
+        container.attachNewFunction("features", lambda fft, coher: np.hstack([fft[0].values.flatten(), coher[0].values]), inputs=["fft", "coherence"])
+        container.setOutputs(["features"])
+        container[:] #each item is read from the EdfDataset once
+
+    Parameters
+    ----------
+    source : array-like
+        dataset at the root of the graph, its node is named "source"
+    n_process : int
+        processes used when indexing by slice, if None uses cpu count
+    memoize_source : bool
+        keep the last few source items (see TransformNode.cache_size), for
+        when nodes are indexed one at a time (i.e. through their own views)
+        instead of through the container. Off by default, each process (pool
+        workers included) holds its own copies, which for edf sources means
+        whole recordings
+    cache_size : int
+        outputs kept per memoized node
+
+    """
+    runtime_attributes = util_funcs.MultiProcessingDataset.runtime_attributes + ["seconds", "calls", "cache_hits", "reporters", "evaluation"]
+
+    def __init__(self, source, n_process=None, memoize_source=False, cache_size=4):
         self.transformers = [] #itself a list of data containers, each with similar functions
-        pass
+        self.nodes = OrderedDict()
+        self.cache_size = cache_size
+        self.nodes["source"] = TransformNode("source", dataset=source, memoize=memoize_source, cache_size=cache_size)
+        self.outputs = None
+        self.reporters = []
+        if n_process is None:
+            n_process = mp.cpu_count()
+        self.n_process = n_process
+        self.reset_stats()
+        self.evaluation = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["evaluation"]
+        state["reporters"] = [] #reporters stay in the process they were attached in
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.evaluation = threading.local()
+
     def __len__(self):
-        return 0
+        return len(self.nodes["source"].dataset)
+
+    def get_upstream_datasets(self):
+        return util_funcs.find_datasets([node.dataset for node in self.nodes.values()], seen=set([id(self)]))
+
     def __getitem__(self, i):
-        return None
+        if self.should_use_mp(i):
+            return self.getItemSlice(i)
+        outputs = self.get_outputs()
+        frame = self.evaluate(i, outputs)
+        if len(outputs) == 1:
+            return frame[outputs[0]]
+        return tuple([frame[name] for name in outputs])
+
+    def attachNewDataTransformer(self, name, transformer, inputs=["source"], memoize=False):
+        """Adds a dataset node
+
+        Parameters
+        ----------
+        name : str
+        transformer : callable
+            called with a NodeView of each input, returns the array-like for
+            this node, i.e. lambda source: EdfFFTDatasetTransformer(source, n_process=1).
+            Give the transformers n_process=1, the container already parallelizes slices
+        inputs : list
+        memoize : bool
+            keep the outputs of the last cache_size indices, in every process
+        """
+        self.check_new_node(name, inputs)
+        dataset = transformer(*[NodeView(self, input_name) for input_name in inputs])
+        self.transformers.append(dataset)
+        self.nodes[name] = TransformNode(name, inputs=inputs, dataset=dataset, memoize=memoize, cache_size=self.cache_size)
+        self.invalidate_pool() #nodes is changed in place, workers wouldn't see the new node
+        return self.get_view(name)
+
+    def attachNewFunction(self, name, func, inputs=["source"], memoize=False):
+        """Adds a function node, func is called with the output of every input
+            for the same index (i.e. concatenating features from several nodes)
+        """
+        self.check_new_node(name, inputs)
+        self.nodes[name] = TransformNode(name, inputs=inputs, func=func, memoize=memoize, cache_size=self.cache_size)
+        self.invalidate_pool()
+        return self.get_view(name)
+
+    def check_new_node(self, name, inputs):
+        if name in self.nodes:
+            raise Exception("node {} already exists".format(name))
+        for input_name in inputs:
+            if input_name not in self.nodes:
+                raise Exception("node {} reads from {}, which doesn't exist".format(name, input_name))
+
+    def get_view(self, name):
+        """array-like over the outputs of a single node"""
+        return NodeView(self, name)
+
+    def setOutputs(self, outputs):
+        """names of the nodes returned by indexing the container, a tuple if more than one"""
+        for name in outputs:
+            if name not in self.nodes:
+                raise Exception("node {} doesn't exist".format(name))
+        self.outputs = list(outputs)
+
+    def get_outputs(self):
+        """the nodes set with setOutputs, if not set every node nothing else reads from"""
+        if self.outputs is not None:
+            return self.outputs
+        consumed = set([input_name for node in self.nodes.values() for input_name in node.inputs])
+        return [name for name in self.nodes if name not in consumed]
+
+    def get_plan(self, outputs=None):
+        """Evaluation plan, the nodes needed for outputs in the order they are run.
+            Nodes can only read from nodes attached before them, so attach order
+            is already a topological order
+
+        Returns
+        -------
+        list
+            node names
+        """
+        if outputs is None:
+            outputs = self.get_outputs()
+        needed = set(outputs)
+        for name in reversed(self.nodes):
+            if name in needed:
+                needed.update(self.nodes[name].inputs)
+        return [name for name in self.nodes if name in needed]
+
+    def evaluate(self, i, outputs=None):
+        """Runs the plan for index i
+
+        Returns
+        -------
+        dict
+            node name -> output, for every node in the plan
+        """
+        frames = self.get_frames()
+        frames[i] = {}
+        try:
+            for name in self.get_plan(outputs):
+                self.get_node_output(name, i)
+            return frames[i]
+        finally:
+            del frames[i]
+
+    def get_frames(self):
+        if not hasattr(self.evaluation, "frames"):
+            self.evaluation.frames = {} #index -> outputs computed for that index, while it is evaluated
+            self.evaluation.child_seconds = [] #stack, time spent in the inputs of the nodes being computed
+        return self.evaluation.frames
+
+    def get_node_output(self, name, i):
+        """output of a node for index i, computed at most once per evaluation of i"""
+        frames = self.get_frames()
+        if i in frames and name in frames[i]:
+            return frames[i][name]
+        node = self.nodes[name]
+        if node.memoize and i in node.cache:
+            node.cache.move_to_end(i)
+            self.cache_hits[name] = self.cache_hits.get(name, 0) + 1
+            output = node.cache[i]
+        else:
+            child_seconds = self.evaluation.child_seconds
+            child_seconds.append(0)
+            start_time = time.time()
+            try:
+                if node.dataset is not None:
+                    output = node.dataset[i]
+                else:
+                    output = node.func(*[self.get_node_output(input_name, i) for input_name in node.inputs])
+            finally:
+                total_seconds = time.time() - start_time
+                own_seconds = total_seconds - child_seconds.pop()
+                if len(child_seconds) != 0:
+                    child_seconds[-1] += total_seconds
+            self.seconds[name] = self.seconds.get(name, 0) + own_seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+            for reporter in self.reporters:
+                reporter(name, i, own_seconds)
+            if node.memoize:
+                node.cache[i] = output
+                while len(node.cache) > node.cache_size:
+                    node.cache.popitem(last=False)
+        if i in frames:
+            frames[i][name] = output
+        return output
+
     def get_main_label(self, i):
-        pass
+        """label of the source item, if the source returns (data, label) tuples"""
+        source_output = self.get_node_output("source", i)
+        return source_output[1] if type(source_output) == tuple else None
+
     def transform(self):
-        return None
+        """runs the plan over every index"""
+        return self[:]
+
+    def reset_stats(self):
+        self.seconds = OrderedDict()
+        self.calls = OrderedDict()
+        self.cache_hits = OrderedDict()
+
     def reportStats(self):
         '''
         Returns a set of statistics about each step in the pipeline
+
+        Returns
+        -------
+        pd.DataFrame
+            index is node, in attach order. seconds excludes time spent computing
+            the node's inputs. Like StageTimer, counts only what ran in this
+            process, not in the workers of a slice
         '''
-        return None
+        stats = pd.DataFrame({
+            "seconds": pd.Series(self.seconds),
+            "calls": pd.Series(self.calls),
+            "cache_hits": pd.Series(self.cache_hits)},
+            index=list(self.nodes), columns=["seconds", "calls", "cache_hits"]).fillna(0)
+        stats["seconds_per_call"] = stats["seconds"] / stats["calls"]
+        return stats
+
     def attachStatsReporter(self, reporter):
+        """reporter is called with (node name, index, seconds) whenever a node is computed"""
         self.reporters.append(reporter)
         return None
-    def attachNewDataTransformer(self, transformer):
-        self.transformers.append(transformer)
@@ -5,19 +5,27 @@ import pyedflib
 from os import path
 import sys, os
 import util_funcs
+import label_index
+import corpus_manifest
+import edf_header_index
+import feature_store as fstore
 from util_funcs import read_config, get_abs_files, get_annotation_types, get_data_split, get_reference_node_types, np_rolling_window
 import multiprocessing as mp
 import argparse
 import pickle as pkl
 import constants
 import re
+import hashlib
 from scipy.signal import butter, lfilter
 import pywt
-from wf_analysis import filters
+from wf_analysis import filters, resampling
 from addict import Dict
 import time
 import functools
 from copy import deepcopy
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 
 class EdfStandardScaler(util_funcs.MultiProcessingDataset):
     """
@@ -73,7 +81,8 @@ class GeneralLabelReader(util_funcs.MultiProcessingDataset):
 
 
 class SeizureLabelReader(util_funcs.MultiProcessingDataset):
-    def __init__(self, split=None, ref="01_tcp_ar", return_tse_data=False, is_present_only=True, edf_token_paths=[], sampleInfo=None, n_process=4, overwrite_sample_info_label=True):
+    executor = "threads" #reads tse files and searches the label index, nothing worth forking for
+    def __init__(self, split=None, ref="01_tcp_ar", return_tse_data=False, is_present_only=True, edf_token_paths=[], sampleInfo=None, n_process=4, overwrite_sample_info_label=True, tse_label_index=None):
         """ Provides access to an array-like that can create labels matching sampleInfo
         or if edf_token_paths is available
 
@@ -89,6 +98,10 @@ class SeizureLabelReader(util_funcs.MultiProcessingDataset):
             (has fileTokenPath, sampleNum, max_length)
         overwrite_sample_info_label : bool
             Whether to overwrite the label info in the sampleInfo # DEBUG: ict passed in
+        tse_label_index : label_index.TseLabelIndex
+            index used to label the samples, if None one is built from the
+            tokens in sampleInfo the first time labels are asked for (or, without
+            sampleInfo, the cached label_index.get_label_index of the split)
 
         Returns
         -------
@@ -98,6 +111,9 @@ class SeizureLabelReader(util_funcs.MultiProcessingDataset):
         if not is_present_only:
             raise NotImplementedError("TODO: maybe allow ways to get labels over time or if seizure is about to occur")
         self.sampleInfo = sampleInfo
+        self.split = split
+        self.ref = ref
+        self.is_whole_split = sampleInfo is None
         if sampleInfo is None:
             token_files = get_all_token_file_names(split, ref)
             self.sampleInfo = Dict()
@@ -109,6 +125,7 @@ class SeizureLabelReader(util_funcs.MultiProcessingDataset):
         self.edf_token_paths = edf_token_paths
         self.overwrite_sample_info_label = overwrite_sample_info_label
         self.return_tse_data = return_tse_data
+        self.tse_label_index = tse_label_index
 
     def self_assign_to_sample_info(self, convert_to_int):
         labels = self[:]
@@ -124,27 +141,48 @@ class SeizureLabelReader(util_funcs.MultiProcessingDataset):
         else:
             return len(self.edf_token_paths)
     def __getitem__(self, i):
+        if self.is_present_only and self.sampleInfo is not None and not self.return_tse_data:
+            #labels come from the interval index in one vectorized lookup, no need for processes
+            if type(i) == slice:
+                return self.get_labels(range(*i.indices(len(self))))
+            elif type(i) == list:
+                return self.get_labels(i)
+            return self.get_labels([i])[0]
         if self.should_use_mp(i):
             return self.getItemSlice(i)
         if self.is_present_only and self.sampleInfo is not None:
             token_file_path = self.sampleInfo[i].token_file_path
-            sampleNum = self.sampleInfo[i].sample_num
-            sample_width = self.sampleInfo[i].sample_width
             label_file = convert_edf_path_to_tse(token_file_path)
-            seiz_label = read_tse_file(label_file)
-            seiz_label = seiz_label
-            if self.return_tse_data:
-                return seiz_label
-            startTime = pd.Timedelta(sampleNum * sample_width).seconds
-            endTime = pd.Timedelta(sampleNum*sample_width + sample_width).seconds
-            #look for where the slice lands
-            seizInfoSlice = seiz_label.loc[(seiz_label.end > startTime) & (seiz_label.end <= endTime).shift(1)]
-            label = (seizInfoSlice.label != "bckg").any()
+            return read_tse_file(label_file)
 
-            if self.overwrite_sample_info_label: #only works if n_process is 1???
-                self.sampleInfo[i].label = label
+    def get_tse_label_index(self):
+        if self.tse_label_index is None and self.is_whole_split:
+            self.tse_label_index = label_index.get_label_index(self.split, self.ref) #shared by every reader of the split
+        if self.tse_label_index is None:
+            tokens = list(OrderedDict.fromkeys([self.sampleInfo[i].token_file_path for i in range(len(self.sampleInfo))]))
+            self.tse_label_index = label_index.TseLabelIndex(tokens)
+        return self.tse_label_index
 
-            return label
+    def get_labels(self, indices):
+        """whether any non bckg event overlaps [sample_num * sample_width, (sample_num + 1) * sample_width)
+            of each sample, for all the indices at once
+
+        Returns
+        -------
+        list
+            bool label per index
+        """
+        indices = list(indices)
+        tokens = [self.sampleInfo[i].token_file_path for i in indices]
+        start_times = np.array([pd.Timedelta(self.sampleInfo[i].sample_num * self.sampleInfo[i].sample_width).total_seconds() for i in indices])
+        end_times = start_times + np.array([pd.Timedelta(self.sampleInfo[i].sample_width).total_seconds() for i in indices])
+        labels = self.get_tse_label_index().any_not_background(tokens, start_times, end_times)
+        if self.overwrite_sample_info_label:
+            for i, label in zip(indices, labels):
+                old_label = self.sampleInfo[i].label
+                if type(old_label) != type(label) or old_label != label: #writes into sampleInfo restart the workers of every dataset, skip the ones that change nothing
+                    self.sampleInfo[i].label = label
+        return list(labels)
 
 
 class Flattener(util_funcs.MultiProcessingDataset):
@@ -208,7 +246,8 @@ class EdfFFTDatasetTransformer(util_funcs.MultiProcessingDataset):
         window_size=None,
         non_overlapping=True,
         return_ann=True,
-        return_numpy=False #return pandas.dataframe if possible (if windows_size is false)
+        return_numpy=False, #return pandas.dataframe if possible (if windows_size is false)
+        feature_store=None
     ):
         """Used to read the raw data in
 
@@ -228,6 +267,11 @@ class EdfFFTDatasetTransformer(util_funcs.MultiProcessingDataset):
             If true, the windows are used to reduce dim red, we don't use rolling-like behavior
         return_ann : bool
             If false, we just output the raw data
+        feature_store : bool, str or feature_store.FeatureStore
+            If set, items are looked up in (and added to) this store, keyed by
+            the key of the edf_dataset item and the parameters of this
+            transformer. See feature_store.get_feature_store. Items of an
+            edf_dataset without get_feature_key are computed every time
         Returns
         -------
         None
@@ -247,6 +291,7 @@ class EdfFFTDatasetTransformer(util_funcs.MultiProcessingDataset):
         self.window_size = window_size
         self.non_overlapping = non_overlapping
         self.return_ann = return_ann
+        self.feature_store = fstore.get_feature_store(feature_store)
         if precache:
             print(
                 "starting precache job with: {} processes".format(
@@ -257,11 +302,20 @@ class EdfFFTDatasetTransformer(util_funcs.MultiProcessingDataset):
     def __len__(self):
         return len(self.edf_dataset)
 
+    def get_feature_key(self, i):
+        params = (self.is_tuple_data, self.is_pandas_data, tuple(self.freq_bins), self.window_size, self.non_overlapping, self.return_ann, self.return_numpy)
+        return fstore.get_layer_key(fstore.get_dataset_item_key(self.edf_dataset, i), type(self).__name__, params)
+
     def __getitem__(self, i):
         if self.precache:
             return self.data[i]
         if self.should_use_mp(i):
             return self.getItemSlice(i)
+        if self.feature_store is not None:
+            return self.feature_store.get_or_compute(self.get_feature_key(i), lambda: self.compute_item(i))
+        return self.compute_item(i)
+
+    def compute_item(self, i):
         if self.window_size is None:
             original_data_label = self.edf_dataset[i]
             if self.is_tuple_data:
@@ -340,9 +394,9 @@ class EdfDataset(util_funcs.MultiProcessingDataset):
     """Basic access to the raw data. Is the first layer in any/all data processing
     and is usually what is passed to the other datasets/transformers
 
-    TODO: possibly create a parallel backend so that same calls to same data input
-    with multiple higher level layers don't do same expensive io/mem allocations
-    in this base dataset
+    Multiple higher level layers over the same EdfDataset each read (and filter)
+    the same items again. Put them in a dataContainer.DataContainerV2 to have
+    every item read once and shared between them
 
     Parameters
     ----------
@@ -367,6 +421,7 @@ class EdfDataset(util_funcs.MultiProcessingDataset):
     resample : pd.Timedelta
 
     """
+    executor = "threads" #pyedflib reads and scipy resampling/filtering, forking and pickling the recordings costs more
 
     def __init__(
             self,
@@ -387,7 +442,8 @@ class EdfDataset(util_funcs.MultiProcessingDataset):
             order_filt=5,
             columns_to_use=util_funcs.get_common_channel_names(),
             use_numpy=False,
-            specific_seiz_types=None
+            specific_seiz_types=None,
+            reader_config=None #EdfReaderConfig, resolved from the config once here if not given
             ):
         self.data_split = data_split
         if n_process is None:
@@ -398,7 +454,6 @@ class EdfDataset(util_funcs.MultiProcessingDataset):
         self.dtype = dtype
         self.start_offset = start_offset
         self.max_length = max_length
-        self.manager = mp.Manager()
         self.edf_tokens = get_all_token_file_names(data_split, ref)
         self.specific_seiz_types = specific_seiz_types
         if self.specific_seiz_types is not None:
@@ -413,37 +468,60 @@ class EdfDataset(util_funcs.MultiProcessingDataset):
         self.order_filt = order_filt
         self.columns_to_use = columns_to_use
         self.use_numpy = use_numpy
+        self.reader_config = reader_config if reader_config is not None else get_edf_reader_config()
+        self.preprocessor = EdfPreprocessor(
+            channels=self.get_channels_to_read(),
+            resample=resample,
+            filter=filter,
+            lp_cutoff=lp_cutoff,
+            hp_cutoff=hp_cutoff,
+            order_filt=order_filt,
+            dtype=dtype,
+            reader_config=self.reader_config)
 
     def __len__(self):
         return len(self.edf_tokens)
 
+    def get_feature_key(self, i):
+        """feature_store key of item i, for transformers that store their outputs"""
+        params = (self.resample, self.start_offset, self.max_length, self.expand_tse, np.dtype(self.dtype).str, self.use_average_ref_names, self.filter, self.lp_cutoff, self.hp_cutoff, self.order_filt, tuple(self.columns_to_use), self.use_numpy)
+        return fstore.get_source_key(self.edf_tokens[i], type(self).__name__, params, extra_paths=[convert_edf_path_to_tse(self.edf_tokens[i])])
+
     def __getitem__(self, i):
         if self.should_use_mp(i):
             return self.getItemSlice(i)
-        data, ann = get_edf_data_and_label_ts_format(
-            self.edf_tokens[i], resample=self.resample, expand_tse=self.expand_tse, dtype=self.dtype, start=self.start_offset, max_length=self.max_length)
-        if (self.max_length != None and max(data.index) > self.max_length):
-            if type(self.max_length) == pd.Timedelta:
-                data = data.loc[pd.Timedelta(seconds=0):self.max_length]
-            else:
-                data = data.iloc[0:self.max_length]
-        if self.use_average_ref_names:
-            data = data[self.columns_to_use]
-        if self.filter:
-            data = data.apply(
-                lambda col: filters.butter_bandpass_filter(
-                    col,
-                    lowcut=self.lp_cutoff,
-                    highcut=self.hp_cutoff,
-                    fs=pd.Timedelta(
-                        seconds=1) /
-                    self.resample,
-                    order=self.order_filt),
-                axis=0)
-        data = data.fillna(method="ffill").fillna(method="bfill")
         if self.use_numpy:
-            data = data.values
-        return data, ann
+            return self.get_numpy_item(i)
+        edf_path = self.edf_tokens[i]
+        data, channel_names, period = self.preprocessor.read(edf_path, start=self.start_offset, max_length=self.max_length) #goes through the preprocessor so every stage shows up in get_stage_stats
+        data = pd.DataFrame(
+            data,
+            index=pd.timedelta_range(start=0, periods=data.shape[0], freq=period),
+            columns=channel_names)
+        return data, self.get_annotations(edf_path, data.index)
+
+    def get_channels_to_read(self):
+        """Channels to pass down to the edf reader so the channels we would throw
+            away are never decoded. None means read everything
+        """
+        if self.use_average_ref_names:
+            return tuple(self.columns_to_use)
+        return None
+
+    def get_numpy_item(self, i):
+        """Same as __getitem__ when use_numpy is set, but reads straight into a
+            (time, channel) array with edf_eeg_2_np instead of going through a DataFrame
+        """
+        edf_path = self.edf_tokens[i]
+        data, channel_names, period = self.preprocessor.read(edf_path, start=self.start_offset, max_length=self.max_length)
+        return data, self.get_annotations(edf_path, pd.timedelta_range(start=0, periods=data.shape[0], freq=period))
+
+    def get_annotations(self, edf_path, index):
+        """tse annotations of edf_path, expanded onto index if expand_tse"""
+        tse_data_path = convert_edf_path_to_tse(edf_path)
+        if self.expand_tse:
+            return read_tse_file_and_return_ts(tse_data_path, index)
+        return read_tse_file(tse_data_path)
 
 def parse_edf_token_path_structure(edf_token_path):
     remaining, token = path.split(edf_token_path)
@@ -457,9 +535,9 @@ def parse_edf_token_path_structure(edf_token_path):
 
 def get_edf_data_and_label_ts_format(
     edf_path, expand_tse=True, resample=pd.Timedelta(
-        seconds=constants.COMMON_DELTA), start=pd.Timedelta(seconds=0), dtype=np.float32, max_length=None):
+        seconds=constants.COMMON_DELTA), start=pd.Timedelta(seconds=0), dtype=np.float32, max_length=None, channels=None, reader_config=None):
     try:
-        edf_data = edf_eeg_2_df(edf_path, resample, dtype=dtype, start=start, max_length=max_length)
+        edf_data = edf_eeg_2_df(edf_path, resample, dtype=dtype, start=start, max_length=max_length, channels=channels, reader_config=reader_config)
         tse_data_path = convert_edf_path_to_tse(edf_path)
         if expand_tse:
             tse_data_ts = read_tse_file_and_return_ts(
@@ -473,8 +551,30 @@ def get_edf_data_and_label_ts_format(
     return edf_data, tse_data_ts
 
 
-def read_tse_file(tse_path):
-    tse_data_lines = []
+TseColumns = namedtuple("TseColumns", ["start", "end", "label_code", "p"])
+
+@functools.lru_cache(1)
+def get_tse_label_categories():
+    """label categories of parsed tse files, the annotation codes in get_annotation_types() order
+    """
+    return tuple(get_annotation_types())
+
+def parse_tse_file(tse_path):
+    """Parses a tse file in one pass into typed columns
+
+    Returns
+    -------
+    np.ndarray
+        start of each event in seconds, float64
+    np.ndarray
+        end of each event in seconds, float64
+    pd.Categorical
+        label of each event, categories are get_tse_label_categories() plus any
+        label in the file that isn't one of the known annotation types
+    np.ndarray
+        probability of each event, float64
+    """
+    fields = []
     with open(tse_path, 'r') as f:
         for line in f:
             if "#" in line:
@@ -484,18 +584,53 @@ def read_tse_file(tse_path):
             elif len(line.strip()) == 0:
                 continue  # Just blank space, continue
             else:
-                line = line.strip()
-                subparts = line.split()
-                tse_data_line = pd.Series(index=['start', 'end', 'label', 'p'])
-                tse_data_line['start'] = float(subparts[0])
-                tse_data_line['end'] = float(subparts[1])
-                tse_data_line['label'] = str(subparts[2])
-                tse_data_line['p'] = float(subparts[3])
-                tse_data_line["duration"] = tse_data_line["end"] - tse_data_line["start"]
+                fields.append(line.split()[:4])
+    fields = np.array(fields, dtype=str).reshape(-1, 4)
+    labels = fields[:, 2]
+    categories = list(get_tse_label_categories())
+    categories += sorted(set(labels) - set(categories))
+    return fields[:, 0].astype(np.float64), fields[:, 1].astype(np.float64), pd.Categorical(labels, categories=categories), fields[:, 3].astype(np.float64)
+
+@functools.lru_cache(50000)
+def load_tse_file(tse_path, mtime):
+    """parse_tse_file as a DataFrame, memoized per (path, mtime) so a file that
+        gets rewritten is parsed again. Use read_tse_file, which returns a copy
+    """
+    start, end, labels, p = parse_tse_file(tse_path)
+    return pd.DataFrame(
+        OrderedDict([("start", start), ("end", end), ("label", labels), ("p", p), ("duration", end - start)]),
+        columns=["start", "end", "label", "p", "duration"])
+
+def read_tse_file(tse_path):
+    """Reads the event annotations of a tse file
+
+    Parameters
+    ----------
+    tse_path : str
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per event, columns are start, end, p and duration as float64 and
+        label as a categorical (see get_tse_label_categories). A copy, so
+        callers can modify it without touching the memoized table
+    """
+    return load_tse_file(tse_path, os.stat(tse_path).st_mtime).copy()
 
-                tse_data_lines.append(tse_data_line)
-    tse_data = pd.concat(tse_data_lines, axis=1).T
-    return tse_data
+def read_tse_columns(tse_path):
+    """read_tse_file as plain numpy arrays, without the DataFrame copy
+
+    Returns
+    -------
+    TseColumns
+        start, end, label_code (int codes into the label categories) and p
+    """
+    tse_data = load_tse_file(tse_path, os.stat(tse_path).st_mtime)
+    return TseColumns(
+        start=tse_data["start"].values.copy(),
+        end=tse_data["end"].values.copy(),
+        label_code=np.asarray(tse_data["label"].cat.codes.values),
+        p=tse_data["p"].values.copy())
 
 
 def convert_edf_path_to_tse(edf_path):
@@ -549,57 +684,219 @@ def expand_tse_file_seizure_only(ann_y, fully_expand=True, time_period=pd.Timede
     seiz_series = expand_tse_file(ann_y, fully_expand=False, time_period=time_period)
     return pd.DataFrame([seiz_series == "bckg", seiz_series != "bckg"]).T
 
-def expand_tse_file(ann_y, ts_index=None, dtype=np.float32, fully_expand=True, time_period=pd.Timedelta(seconds=1)):
+def expand_tse_file(ann_y, ts_index=None, dtype=np.float32, fully_expand=True, time_period=pd.Timedelta(seconds=1), return_codes=False):
     """expands a time series file to fill up a set period of time
 
+        Each event covers the rows of ts_index from start to end (both inclusive),
+        found with np.searchsorted, and is written into a preallocated array with
+        one slice assignment. Events are written last to first, so where two
+        events cover the same row the earlier one in the file wins
+
     Parameters
     ----------
-    ann_y : type
-        Description of parameter `ann_y`.
-    ts_index : type
-        Description of parameter `ts_index`.
+    ann_y : pd.DataFrame
+        events, as returned by read_tse_file
+    ts_index : pd.TimedeltaIndex
+        sorted times to expand onto
     dtype : type
-        Description of parameter `dtype`.
+        dtype of the fully expanded frame
     fully_expand : bool
         If True, then expand to be total annotations by time (1's and 0's), else if false, just expand into series of time, holding ann strings
     time_period : pd.Timedelta
         Used for granularity of our time series preprocessing, mostly used if ts_index isn't supplied
+    return_codes : bool
+        only used if fully_expand is False. If True, the series holds int label
+        codes into the categories of ann_y.label (see read_tse_file) instead of
+        strings, -1 where no event covers the row
+
     Returns
     -------
-    type
-        Description of returned object.
+    pd.DataFrame or pd.Series
+        if fully_expand, time by get_annotation_types() frame holding p where an
+        event with that label covers the row and 0 elsewhere. Otherwise a series
+        of the label covering each row, NaN (or -1) where there is none
 
     """
     if ts_index is None:
         ts_index = pd.timedelta_range(start=0, end=ann_y.end.max()*pd.Timedelta(seconds=1), freq=time_period)
+    index_values = pd.TimedeltaIndex(ts_index).asi8
+    starts = np.searchsorted(index_values, [pd.Timedelta(seconds=start).value for start in ann_y["start"]], side="left")
+    ends = np.searchsorted(index_values, [pd.Timedelta(seconds=end).value for end in ann_y["end"]], side="right")
+    labels = ann_y["label"].values if hasattr(ann_y["label"], "cat") else pd.Categorical(ann_y["label"])
     if fully_expand:
-        ann_y_t = pd.DataFrame(columns=get_annotation_types(), index=ts_index)
-        ann_y.apply(lambda row: ann_y_t[row['label']].loc[pd.Timedelta(
-            seconds=row['start']):pd.Timedelta(seconds=row['end'])].fillna(row['p'], inplace=True), axis=1)
-        ann_y_t.fillna(0, inplace=True)
-    else:
-        ann_y_t = pd.Series(index=ts_index, dtype=str)
-        ann_y.apply(lambda row: ann_y_t.loc[pd.Timedelta(
-            seconds=row['start']):pd.Timedelta(seconds=row['end'])].fillna(row['label'], inplace=True), axis=1)
-    return ann_y_t
+        columns = get_annotation_types()
+        column_indices = {label: j for j, label in enumerate(columns)}
+        label_columns = [column_indices[label] for label in labels.categories]
+        ann_y_t = np.zeros((len(index_values), len(columns)), dtype=dtype)
+        for start, end, code, p in reversed(list(zip(starts, ends, labels.codes, ann_y["p"].values))):
+            ann_y_t[start:end, label_columns[code]] = p
+        return pd.DataFrame(ann_y_t, index=ts_index, columns=columns)
+    label_codes = np.full(len(index_values), -1, dtype=np.int64)
+    for start, end, code in reversed(list(zip(starts, ends, labels.codes))):
+        label_codes[start:end] = code
+    if return_codes:
+        return pd.Series(label_codes, index=ts_index)
+    return pd.Series(np.array(list(labels.categories) + [np.nan], dtype=object)[label_codes], index=ts_index)
+
+EdfReaderConfig = namedtuple("EdfReaderConfig", ["check_file_size", "max_open_files"])
+EDFLIB_MAXFILES = 64 #edflib can't have more files than this open in one process
+
+@functools.lru_cache(1)
+def get_edf_reader_config():
+    """Reader options resolved from config.json once per process. Datasets grab this
+        when they are built and pass it down to every read, instead of the read
+        functions looking at the config on every call
+
+    Returns
+    -------
+    EdfReaderConfig
+        check_file_size : pyedflib.CHECK_FILE_SIZE unless "edf_check_file_size" is false
+        max_open_files : "edf_reader_pool_size", defaults to 8
+    """
+    config = read_config()
+    check_file_size = pyedflib.DO_NOT_CHECK_FILE_SIZE if "edf_check_file_size" in config and not config["edf_check_file_size"] else pyedflib.CHECK_FILE_SIZE
+    max_open_files = config["edf_reader_pool_size"] if "edf_reader_pool_size" in config else 8
+    return EdfReaderConfig(check_file_size=check_file_size, max_open_files=max_open_files)
+
+class EdfReaderPool():
+    """Keeps pyedflib.EdfReader handles open so consecutive window reads from the
+    same recording don't pay for open/header parsing/close every time.
 
-file_list = set()
-file_list_lock = mp.Lock()
+    pyedflib can only have a path open once per process, so a handle is lent
+    out to one caller at a time. Other threads asking for the same path block
+    on a condition variable until it is given back, instead of spinning.
+
+    Because of that, every open in this module goes through the pool, and code
+    that opens a file with pyedflib.EdfReader itself (i.e. in a notebook) has
+    to close the pooled handle first, with edf_reader_pool.close(path) or
+    close_edf_readers(). Using the pool as a context manager closes every idle
+    handle on exit
+
+        with read.edf_reader_pool:
+            data = read.edf_eeg_2_df(edf_path)
+        reader = pyedflib.EdfReader(edf_path)
+
+    Parameters
+    ----------
+    max_open_files : int
+        number of idle handles to keep around, least recently used ones are
+        closed first. If None, uses get_edf_reader_config().max_open_files
+    max_total_files : int
+        idle plus lent out handles, callers wait for a handle to come back
+        past this. Has to stay under EDFLIB_MAXFILES
+
+    """
+    def __init__(self, max_open_files=None, max_total_files=EDFLIB_MAXFILES - 8):
+        if max_open_files is None:
+            max_open_files = get_edf_reader_config().max_open_files
+        if max_total_files >= EDFLIB_MAXFILES:
+            raise Exception("edflib can have at most {} files open".format(EDFLIB_MAXFILES))
+        self.max_open_files = min(max_open_files, max_total_files)
+        self.max_total_files = max_total_files
+        self.reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.close_inherited)
+
+    def reset(self):
+        self.condition = threading.Condition()
+        self.idle_readers = OrderedDict() #path -> reader, in lru order
+        self.paths_in_use = set()
+        self.reader_versions = {} #path -> (mtime, size) of the file when its handle was opened
+
+    @contextmanager
+    def get_reader(self, path, reader_config=None):
+        if reader_config is None:
+            reader_config = get_edf_reader_config()
+        with self.condition:
+            while True:
+                if path in self.paths_in_use:
+                    self.condition.wait()
+                    continue
+                reader = self.idle_readers.pop(path, None)
+                if reader is not None and self.reader_versions.get(path) != fstore.get_file_version(path):
+                    reader._close() #the file was rewritten since the handle was opened
+                    reader = None
+                if reader is not None or len(self.idle_readers) + len(self.paths_in_use) < self.max_total_files:
+                    break
+                if len(self.idle_readers) > 0: #make room by closing the least recently used idle handle
+                    self.idle_readers.popitem(last=False)[1]._close()
+                    continue
+                self.condition.wait() #every handle is lent out
+            self.paths_in_use.add(path)
+        try:
+            if reader is None:
+                self.reader_versions[path] = fstore.get_file_version(path)
+                reader = pyedflib.EdfReader(path, check_file_size=reader_config.check_file_size)
+            yield reader
+        except Exception:
+            if reader is not None: #don't trust a handle that errored out, open a fresh one next time
+                reader._close()
+                reader = None
+            raise
+        finally:
+            with self.condition:
+                self.paths_in_use.remove(path)
+                if reader is not None:
+                    self.idle_readers[path] = reader
+                    while len(self.idle_readers) > self.max_open_files:
+                        self.idle_readers.popitem(last=False)[1]._close()
+                self.condition.notify_all()
+
+    def close(self, path=None):
+        """closes the idle handle of path, or every idle handle if path is None,
+            so the file can be opened directly with pyedflib again
+        """
+        with self.condition:
+            if path is not None:
+                reader = self.idle_readers.pop(path, None)
+                if reader is not None:
+                    reader._close()
+                return
+            while len(self.idle_readers) > 0:
+                self.idle_readers.popitem(last=False)[1]._close()
+
+    def close_all(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close_inherited(self):
+        """Forked workers get a copy of the parent's handles; close the idle ones
+        and forget the ones other parent threads had checked out
+        """
+        idle_readers = self.idle_readers
+        self.reset()
+        for reader in idle_readers.values():
+            reader._close()
+
+edf_reader_pool = EdfReaderPool()
+
+def close_edf_readers(path=None):
+    """closes the pooled handle of path (every pooled handle if None), see EdfReaderPool"""
+    edf_reader_pool.close(path)
 
 @functools.lru_cache(100)
-def edf_eeg_2_df(path, resample=None, dtype=np.float32, start=0, filter=True, max_length=None):
+def edf_eeg_2_df(path, resample=None, dtype=np.float32, start=0, filter=False, max_length=None, channels=None, reader_config=None):
     """ Transforms from EDF to pd.df, with channel labels as columns.
         This does not attempt to concatenate multiple time series but only takes
         a single edf filepath
 
+        Built on top of edf_eeg_2_np, so the channels share a single index instead
+        of being aligned through a pd.concat of per channel series
+
     Parameters
     ----------
     path : str
         path of the edf file
 
     resample : pd.Timedelta
-        if None, returns original data with original sampling
-        otherwise, resamples to correct Timedelta using forward filling
+        if None, returns data at the fastest sample rate in the file
+        otherwise, resamples to correct Timedelta using polyphase filtering
 
     dtype : dtype
         used to reduce memory consumption (np.float64 can be expensive)
@@ -607,82 +904,539 @@ def edf_eeg_2_df(path, resample=None, dtype=np.float32, start=0, filter=True, ma
     start : int or pd.Timedelta
         which place to start at
 
+    filter : bool
+        if True, bandpass filters 1-50 Hz with a single sos pass. Off by default,
+        datasets filter through their EdfPreprocessor instead
+
+    channels : tuple
+        if not None, only these channel labels are read, in this order. Has to be
+        a tuple (not a list) because of the lru_cache
+
+    reader_config : EdfReaderConfig
+        if None, uses get_edf_reader_config()
+
     Returns
     -------
     pd.DataFrame
         index is time, columns is waveform channel label
 
     """
-    global file_list, file_list_lock
-    waiting_for_path = True
-    while waiting_for_path: #hack around pyedflib having access to only one file handle at a time, if file is open, don't do anything
-        file_list_lock.acquire()
-        if path not in file_list:
-            file_list.add(path)
-            waiting_for_path = False
-        file_list_lock.release()
-
-
-    with pyedflib.EdfReader(path, check_file_size=pyedflib.CHECK_FILE_SIZE) as reader:
-        channel_names = [headerDict['label']
-                         for headerDict in reader.getSignalHeaders()]
-        sample_rates = [headerDict['sample_rate']
-                        for headerDict in reader.getSignalHeaders()]
-        for headerDict in reader.getSignalHeaders():
-            if headerDict["dimension"] != "uV" and headerDict["label"] in util_funcs.get_common_channel_names():
-                raise Exception()
-        start_time = pd.Timestamp(reader.getStartdatetime())
-        all_channels = []
-        for i, channel_name in enumerate(channel_names):
+    data, channel_names, period = edf_eeg_2_np(path, resample=resample, dtype=dtype, start=start, max_length=max_length, channels=channels, reader_config=reader_config)
+    if filter:
+        data = filters.sos_bandpass_filter(data, lowcut=1, highcut=50, fs=pd.Timedelta(seconds=1) / period, order=5, axis=0)
+    data = pd.DataFrame(
+        data,
+        index=pd.timedelta_range(start=0, periods=data.shape[0], freq=period),
+        columns=channel_names)
+    return data
+
+def edf_eeg_2_np(path, resample=None, dtype=np.float32, start=0, max_length=None, channels=None, reader_config=None, timer=None):
+    """ NumPy-native version of edf_eeg_2_df. All channels are read into one
+        preallocated (time, channel) array instead of building a pd.Series with
+        its own date_range index for every channel
+
+    Parameters
+    ----------
+    path : str
+        path of the edf file
+    resample : pd.Timedelta
+        if None, returns data at the fastest sample rate in the file. Channels
+        not already at the target rate are resampled with a cached polyphase
+        filter (wf_analysis.resampling), one block of same rate channels at a time
+    dtype : dtype
+        dtype of the returned array
+    start : int or pd.Timedelta
+        which place to start at
+    max_length : pd.Timedelta
+        if not None, only reads roughly this much data past start
+    channels : list
+        if not None, only these channel labels are decoded and resampled, in this
+        order. Raises a KeyError if one of them is not in the file
+    reader_config : EdfReaderConfig
+        if None, uses get_edf_reader_config()
+    timer : StageTimer
+        if not None, time spent in the read, select_channels and resample stages
+        is added to it
+
+    Returns
+    -------
+    np.ndarray
+        time by channel array
+    list
+        channel labels, in the same order as the columns of the array
+    pd.Timedelta
+        time between the rows of the array
+
+    """
+    if timer is None:
+        timer = StageTimer()
+    header = edf_header_index.get_header(path) #before taking the pooled handle, reading a header that isn't indexed yet needs it
+    with edf_reader_pool.get_reader(path, reader_config) as reader:
+        with timer.stage("select_channels"):
+            channel_names, signal_indices, rate_groups, num_samples = get_signal_layout(reader, path, channels, header=header)
+        if resample is None:
+            target_rate = max(rate_groups.keys())
+            resample = pd.Timedelta(seconds=1/target_rate)
+        else:
+            target_rate = pd.Timedelta(seconds=1) / resample
+        blocks = []
+        for sample_rate, columns in rate_groups.items():
+            period = pd.Timedelta(seconds=1/sample_rate)
+            resampler = resampling.get_resampler(sample_rate, target_rate)
+            needs_resample = resampler.up != resampler.down
             if type(start) == pd.Timedelta: #we ask for time t=1 s, then we take into account sample rate
-                start_count_native_freq = start/pd.Timedelta(seconds=1/sample_rates[i])
+                start_count_native_freq = int(start/period)
+            else:
+                start_count_native_freq = int(start)
+            num_samples_in_file = num_samples[[signal_indices[column] for column in columns]].max()
+            numStepsToRead = max(num_samples_in_file - start_count_native_freq, 0)
+            if max_length is not None:
+                numStepsToRead = min(numStepsToRead, int(np.ceil(max_length / period)) + 5) #adding a fudge factor of 5 for any off by 1 errors
+            context_before = 0
+            context_after = 0
+            if needs_resample: #read extra samples around the window so the filter doesn't see an edge there
+                context_before = min(resampler.context, start_count_native_freq // resampler.down * resampler.down)
+                context_after = max(min(resampler.context, num_samples_in_file - start_count_native_freq - numStepsToRead), 0)
+            read_start = start_count_native_freq - context_before
+            read_length = context_before + numStepsToRead + context_after
+            with timer.stage("read"):
+                block, signal_lengths = read_signal_block(reader, [signal_indices[column] for column in columns], num_samples, read_start, read_length, dtype=np.float64 if needs_resample else dtype)
+            if needs_resample:
+                with timer.stage("resample"):
+                    block = resample_block(resampler, block, signal_lengths)
+                first_row = resampler.num_context_output_samples(context_before)
+                block = block[first_row:first_row + resampler.num_output_samples(numStepsToRead)].astype(dtype)
+            blocks.append((columns, block))
+
+    if len(blocks) == 1: #common case, every channel has the same sample rate
+        return blocks[0][1], channel_names, resample
+    num_rows = max([block.shape[0] for columns, block in blocks])
+    data = np.full((num_rows, len(channel_names)), np.nan, dtype=dtype)
+    for columns, block in blocks:
+        data[:block.shape[0], columns] = block
+    return data, channel_names, resample
+
+def get_signal_layout(reader, path, channels=None, header=None):
+    """Works out which signals of an open edf file to read. If header (from
+        edf_header_index.get_header) is given, the layout comes from it instead
+        of asking the reader signal by signal
+
+    Returns
+    -------
+    list
+        channel labels to return, in order
+    list
+        signal index in the edf file of each of those channels
+    dict
+        sample rate -> positions in the channel list of channels sampled at that rate
+    np.ndarray
+        number of samples of every signal in the file
+    """
+    if header is None:
+        header = Dict(
+            channel_labels=reader.getSignalLabels(),
+            dimensions=[reader.getPhysicalDimension(i) for i in range(reader.signals_in_file)],
+            sample_rates=[reader.getSampleFrequency(i) for i in range(reader.signals_in_file)],
+            num_samples=reader.getNSamples())
+    channel_names = list(header.channel_labels)
+    if channels is None:
+        signal_indices = list(range(len(channel_names)))
+    else:
+        missing_channels = [channel for channel in channels if channel not in channel_names]
+        if len(missing_channels) != 0:
+            raise KeyError("{} not in {}".format(missing_channels, path))
+        signal_indices = [channel_names.index(channel) for channel in channels]
+        channel_names = list(channels)
+    for i, channel_name in zip(signal_indices, channel_names):
+        if header.dimensions[i] != "uV" and channel_name in util_funcs.get_common_channel_names():
+            raise Exception()
+    rate_groups = {} #channels sharing a sample rate are read into the same block
+    for j, i in enumerate(signal_indices):
+        rate_groups.setdefault(header.sample_rates[i], []).append(j)
+    return channel_names, signal_indices, rate_groups, np.asarray(header.num_samples)
+
+def read_signal_block(reader, signal_indices, num_samples, read_start, read_length, dtype=np.float32):
+    """Reads the same span of several signals into one (time, channel) block. Signals
+        that end before read_start + read_length are left NaN past their end.
+        Reads are clamped to the samples left in each signal, so pyedflib never
+        gets asked for a short read and never prints about one (which is what
+        messy_read_outputs used to redirect stdout around)
+
+    Returns
+    -------
+    np.ndarray
+        read_length by len(signal_indices) array
+    list
+        number of samples actually read for each signal
+    """
+    block = np.full((read_length, len(signal_indices)), np.nan, dtype=dtype)
+    signal_lengths = []
+    for j, signal_index in enumerate(signal_indices):
+        num_to_read = min(read_length, max(num_samples[signal_index] - read_start, 0))
+        if num_to_read == 0:
+            signal_lengths.append(0)
+            continue
+        signal_data = reader.readSignal(signal_index, start=read_start, n=num_to_read)
+        block[:len(signal_data), j] = signal_data
+        signal_lengths.append(len(signal_data))
+    return block, signal_lengths
+
+def read_window(path, start_s, duration_s, channels=None, resample=pd.Timedelta(seconds=constants.COMMON_DELTA), dtype=np.float32, reader_config=None, timer=None):
+    """Reads exactly duration_s seconds starting at start_s, at the resample rate.
+        Rows are on the same grid as resampling the whole recording, i.e. row k
+        of the window is row round(start_s / resample) + k of the whole recording,
+        so callers don't need to slice the result down any further
+
+    Parameters
+    ----------
+    path : str
+        path of the edf file
+    start_s : float
+        start of the window in seconds from the start of the recording
+    duration_s : float
+        length of the window in seconds
+    channels : list
+        channel labels to read, in this order. If None, every channel in the file
+    resample : pd.Timedelta
+        time between rows of the returned window
+    dtype : dtype
+    reader_config : EdfReaderConfig
+        if None, uses get_edf_reader_config()
+    timer : StageTimer
+        if not None, collects the time spent in each stage, same as edf_eeg_2_np
+
+    Returns
+    -------
+    np.ndarray
+        round(duration_s / resample) by channel array. Rows past the end of the
+        recording are NaN
+    list
+        channel labels, in the same order as the columns of the array
+    pd.Timedelta
+        time between the rows of the array, i.e. resample
+    """
+    target_rate = pd.Timedelta(seconds=1) / resample
+    start_row = int(round(start_s * target_rate))
+    num_rows = int(round(duration_s * target_rate))
+    if timer is None:
+        timer = StageTimer()
+    header = edf_header_index.get_header(path) #before taking the pooled handle, reading a header that isn't indexed yet needs it
+    with edf_reader_pool.get_reader(path, reader_config) as reader:
+        with timer.stage("select_channels"):
+            channel_names, signal_indices, rate_groups, num_samples = get_signal_layout(reader, path, channels, header=header)
+        data = np.full((num_rows, len(channel_names)), np.nan, dtype=dtype)
+        for sample_rate, columns in rate_groups.items():
+            resampler = resampling.get_resampler(sample_rate, target_rate)
+            group_signal_indices = [signal_indices[column] for column in columns]
+            num_samples_in_file = num_samples[group_signal_indices].max()
+            #start reading at the input sample that lines up with the output grid at or before start_row
+            aligned_start = start_row // resampler.up * resampler.down
+            skip_rows = start_row - start_row // resampler.up * resampler.up
+            read_start = max(aligned_start - resampler.context, 0)
+            read_end = min(int(np.ceil((start_row + num_rows) * resampler.down / resampler.up)) + resampler.context, num_samples_in_file)
+            if read_end <= read_start:
+                continue
+            with timer.stage("read"):
+                block, signal_lengths = read_signal_block(reader, group_signal_indices, num_samples, read_start, read_end - read_start, dtype=np.float64 if resampler.up != resampler.down else dtype)
+            if resampler.up != resampler.down:
+                with timer.stage("resample"):
+                    block = resample_block(resampler, block, signal_lengths)
+            first_row = resampler.num_context_output_samples(aligned_start - read_start) + skip_rows
+            block = block[first_row:first_row + num_rows]
+            data[:block.shape[0], columns] = block
+    return data, channel_names, resample
+
+def read_windows(requests, channels=None, resample=pd.Timedelta(seconds=constants.COMMON_DELTA), dtype=np.float32, max_gap_s=60, reader_config=None, timer=None):
+    """Batched read_window. Requests are grouped by file and windows of the same
+        file that are close together are read as one covering span, then scattered
+        into a single preallocated array
+
+    Parameters
+    ----------
+    requests : list
+        (path, start_s, duration_s) tuples
+    channels : list
+        channel labels to read, in this order. If None, every channel in the
+        files, which then all have to have the same channels
+    resample : pd.Timedelta
+        time between rows
+    dtype : dtype
+    max_gap_s : float
+        windows of a file more than this many seconds apart are read as separate
+        spans instead of reading everything between them
+    reader_config : EdfReaderConfig
+        if None, uses get_edf_reader_config()
+    timer : StageTimer
+        passed on to read_window
+
+    Returns
+    -------
+    np.ndarray
+        len(requests) by time by channel array, windows shorter than the longest
+        one are NaN padded at the end
+    list
+        channel labels, in the same order as the last axis of the array
+    pd.Timedelta
+        time between rows
+    """
+    target_rate = pd.Timedelta(seconds=1) / resample
+    start_rows = [int(round(start_s * target_rate)) for path, start_s, duration_s in requests]
+    window_rows = [int(round(duration_s * target_rate)) for path, start_s, duration_s in requests]
+    requests_by_file = OrderedDict()
+    for j, (path, start_s, duration_s) in enumerate(requests):
+        requests_by_file.setdefault(path, []).append(j)
+    data = None
+    channel_names = channels
+    for path, file_requests in requests_by_file.items():
+        file_requests = sorted(file_requests, key=lambda j: start_rows[j])
+        spans = [[file_requests[0]]]
+        for j in file_requests[1:]:
+            span_end = max([start_rows[k] + window_rows[k] for k in spans[-1]])
+            if (start_rows[j] - span_end) / target_rate > max_gap_s:
+                spans.append([j])
             else:
-                start_count_native_freq = start
-            if max_length is None: #read everything
-                signal_data = reader.readSignal(i, start=start_count_native_freq)
+                spans[-1].append(j)
+        for span in spans:
+            span_start = start_rows[span[0]]
+            span_end = max([start_rows[j] + window_rows[j] for j in span])
+            block, block_channel_names, period = read_window(path, span_start / target_rate, (span_end - span_start) / target_rate, channels=channels, resample=resample, dtype=dtype, reader_config=reader_config, timer=timer)
+            if data is None:
+                channel_names = block_channel_names
+                data = np.full((len(requests), max(window_rows), len(channel_names)), np.nan, dtype=dtype)
+            elif block_channel_names != channel_names:
+                raise Exception("{} has different channels than the other files, pass channels explicitly".format(path))
+            for j in span:
+                data[j, :window_rows[j]] = block[start_rows[j] - span_start:start_rows[j] - span_start + window_rows[j]]
+    if data is None:
+        data = np.full((0, 0, 0 if channels is None else len(channels)), np.nan, dtype=dtype)
+    return data, channel_names, resample
+
+def stream_windows(path, window_s, channels=None, resample=pd.Timedelta(seconds=constants.COMMON_DELTA), start_s=0, end_s=None, lp_cutoff=1, hp_cutoff=50, order_filt=5, dtype=np.float32, streaming_filter=None, reader_config=None):
+    """Generator over consecutive, non overlapping windows of a recording, bandpass
+        filtered incrementally with a filters.StreamingSosFilter. Since read_window
+        rows are on the whole recording's grid and the filter carries its state
+        from one window to the next, the windows concatenate to exactly the
+        filtered whole recording, with no edge transient at each window
+
+    Parameters
+    ----------
+    path : str
+    window_s : float
+        length of each window in seconds
+    channels : list
+        if None, every channel in the file
+    start_s : float
+        where to start streaming. The filter state starts from zero here
+    end_s : float
+        where to stop, if None the end of the recording. The last window may be
+        shorter than window_s
+    streaming_filter : filters.StreamingSosFilter
+        if None, a new one is made from lp_cutoff, hp_cutoff and order_filt.
+        Pass one in to keep filtering a token across calls, i.e. online inference
+
+    Yields
+    -------
+    np.ndarray
+        time by channel window
+    """
+    if reader_config is None:
+        reader_config = get_edf_reader_config()
+    if end_s is None:
+        end_s = edf_header_index.get_header(path).file_duration
+    if streaming_filter is None:
+        streaming_filter = filters.StreamingSosFilter(lp_cutoff, hp_cutoff, pd.Timedelta(seconds=1) / resample, order=order_filt)
+    target_rate = pd.Timedelta(seconds=1) / resample
+    start_row = int(round(start_s * target_rate))
+    end_row = int(round(end_s * target_rate))
+    window_rows = int(round(window_s * target_rate))
+    for window_start_row in range(start_row, end_row, window_rows):
+        num_rows = min(window_rows, end_row - window_start_row)
+        data, channel_names, period = read_window(path, window_start_row / target_rate, num_rows / target_rate, channels=channels, resample=resample, dtype=dtype, reader_config=reader_config)
+        yield streaming_filter.filter(path, data, channel_names)
+
+def resample_block(resampler, block, signal_lengths):
+    """Resamples a (time, channel) block of channels that share a sample rate,
+        resampling channels that ended early on just their own samples so the
+        NaN padding doesn't get smeared into them
+    """
+    if min(signal_lengths) == block.shape[0]:
+        return resampler(block, axis=0)
+    resampled = np.full((resampler.num_output_samples(block.shape[0]), block.shape[1]), np.nan)
+    for signal_length in set(signal_lengths):
+        columns = [j for j, length in enumerate(signal_lengths) if length == signal_length]
+        if signal_length == 0:
+            continue
+        resampled_columns = resampler(block[:signal_length, columns], axis=0)
+        resampled[:resampled_columns.shape[0], columns] = resampled_columns
+    return resampled
+
+class StageTimer():
+    """Accumulates wall time and number of calls per named stage. Each process
+        keeps its own, so time spent inside MultiProcessingDataset workers isn't
+        added to the timer of the parent
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = OrderedDict()
+        self.calls = OrderedDict()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start_time)
+
+    def get_stats(self):
+        """
+        Returns
+        -------
+        pd.DataFrame
+            index is stage, columns are total seconds, calls and seconds per call
+        """
+        stats = pd.DataFrame({"seconds": pd.Series(self.seconds), "calls": pd.Series(self.calls)}, columns=["seconds", "calls"])
+        stats["seconds_per_call"] = stats["seconds"] / stats["calls"]
+        return stats
+
+class EdfPreprocessor():
+    """The single preprocessing stage between the edf files and the datasets:
+        read -> select channels -> resample -> filter -> fill NaNs. A dataset
+        configures one of these in its __init__ and every read goes through it,
+        so each array gets bandpass filtered exactly once.
+
+        Channels are selected before decoding and resampled inside the reader
+        (edf_eeg_2_np/read_window), the filter runs after resampling so every
+        channel shares one cached sos design at the common rate.
+
+    Parameters
+    ----------
+    channels : tuple
+        channel labels to read, in order. None reads every channel in the file
+    resample : pd.Timedelta
+        time between rows of the output
+    filter : bool
+        whether to bandpass filter from lp_cutoff to hp_cutoff
+    lp_cutoff : float
+    hp_cutoff : float
+    order_filt : int
+    fill_nans : bool
+        forward then backward fill NaNs (i.e. channels that end early)
+    dtype : dtype
+    reader_config : EdfReaderConfig
+        if None, uses get_edf_reader_config()
+
+    Attributes
+    ----------
+    timer : StageTimer
+        time spent per stage by this process, see get_stage_stats
+
+    """
+    STAGES = ["read", "select_channels", "resample", "filter", "fill_nans"]
+
+    def __init__(
+            self,
+            channels=None,
+            resample=pd.Timedelta(seconds=constants.COMMON_DELTA),
+            filter=True,
+            lp_cutoff=1,
+            hp_cutoff=50,
+            order_filt=5,
+            fill_nans=True,
+            dtype=np.float32,
+            reader_config=None):
+        self.channels = tuple(channels) if channels is not None else None
+        self.resample = resample
+        self.filter = filter
+        self.lp_cutoff = lp_cutoff
+        self.hp_cutoff = hp_cutoff
+        self.order_filt = order_filt
+        self.fill_nans = fill_nans
+        self.dtype = dtype
+        self.reader_config = reader_config if reader_config is not None else get_edf_reader_config()
+        self.timer = StageTimer()
+
+    def read(self, path, start=0, max_length=None):
+        """Same arguments as edf_eeg_2_np. If max_length is given, the result is
+            cut down to max_length (inclusive of the end for a pd.Timedelta)
+            before filtering
+
+        Returns
+        -------
+        np.ndarray
+            time by channel array
+        list
+            channel labels
+        pd.Timedelta
+            time between rows
+        """
+        data, channel_names, period = edf_eeg_2_np(path, resample=self.resample, dtype=self.dtype, start=start, max_length=max_length, channels=self.channels, reader_config=self.reader_config, timer=self.timer)
+        if max_length is not None:
+            if type(max_length) == pd.Timedelta:
+                data = data[:int(max_length / period) + 1]
             else:
-                numStepsToRead = int(np.ceil(max_length / pd.Timedelta(seconds=1/sample_rates[i]))) + 5 #adding a fudge factor of 5 for any off by 1 errors
-                if "messy_read_outputs" in read_config() and read_config()["messy_read_outputs"]:
-                    sys.stdout = open(os.devnull, "w")
-                signal_data = reader.readSignal(i, start=start_count_native_freq, n=numStepsToRead)
-                if "messy_read_outputs" in read_config() and read_config()["messy_read_outputs"]:
-                    sys.stdout = sys.__stdout__
-
-            signal_data = pd.Series(
-                signal_data,
-                index=pd.date_range(
-                    start=start_time,
-                    freq=pd.Timedelta(seconds=1 / sample_rates[i]),
-                    periods=len(signal_data)
-                ),
-                name=channel_name
-            )
-            all_channels.append(signal_data)
-    data = pd.concat(all_channels, axis=1)
-    data.index = data.index - data.index[0]
-    data = data.astype(dtype)
-    if filter is not None:
-        segSize = data.index[1]-data.index[0]
-        data.apply(
-            lambda col: filters.butter_bandpass_filter(
-                col,
-                lowcut=1,
-                highcut=50,
-                fs=pd.Timedelta(
-                    seconds=1) /
-                segSize,
-                order=5),
-            axis=0)
-    if resample is not None:
-        data = data.resample(resample).mean()
-
-    waiting_for_path = True
-    file_list_lock.acquire()
-    file_list.remove(path)
-    file_list_lock.release()
+                data = data[:max_length]
+        return self.process(data, period), channel_names, period
 
+    def read_window(self, path, start_s, duration_s):
+        """read_window, then filter and fill NaNs
+        """
+        data, channel_names, period = read_window(path, start_s, duration_s, channels=self.channels, resample=self.resample, dtype=self.dtype, reader_config=self.reader_config, timer=self.timer)
+        return self.process(data, period), channel_names, period
 
-    return data
+    def read_windows(self, requests, max_gap_s=60):
+        """read_windows, then filter and fill NaNs of the whole (window, time, channel) array at once
+        """
+        data, channel_names, period = read_windows(requests, channels=self.channels, resample=self.resample, dtype=self.dtype, max_gap_s=max_gap_s, reader_config=self.reader_config, timer=self.timer)
+        return self.process(data, period, axis=1), channel_names, period
+
+    def process(self, data, period=None, axis=0):
+        """filter and fill NaN stages for data that was already read and resampled
+
+        Parameters
+        ----------
+        data : np.ndarray
+            (time, channel) array, or (window, time, channel) with axis=1
+        period : pd.Timedelta
+            time between rows of data, if None self.resample
+        axis : int
+            time axis of data
+        """
+        if period is None:
+            period = self.resample
+        if self.filter:
+            with self.timer.stage("filter"):
+                data = filters.sos_bandpass_filter(
+                    data,
+                    lowcut=self.lp_cutoff,
+                    highcut=self.hp_cutoff,
+                    fs=pd.Timedelta(seconds=1) / period,
+                    order=self.order_filt,
+                    axis=axis)
+        if self.fill_nans:
+            with self.timer.stage("fill_nans"):
+                if data.ndim == 3:
+                    data = np.stack([util_funcs.np_ffill_bfill(window) for window in data]) if len(data) != 0 else data
+                else:
+                    data = util_funcs.np_ffill_bfill(data)
+        return data
+
+    def process_df(self, data):
+        """process for a DataFrame with a pd.TimedeltaIndex, keeps the index and columns
+        """
+        period = data.index[1] - data.index[0] if len(data.index) > 1 else self.resample
+        return pd.DataFrame(self.process(data.values, period), index=data.index, columns=data.columns)
+
+    def get_stage_stats(self):
+        """time spent in each stage by this process, see StageTimer.get_stats"""
+        stats = self.timer.get_stats()
+        return stats.loc[[stage for stage in EdfPreprocessor.STAGES if stage in stats.index]]
 
 def get_associated_lbl(edf_fn):
     """
@@ -690,73 +1444,169 @@ def get_associated_lbl(edf_fn):
     """
     return edf_fn[:-4] + ".lbl"
 
+LBL_CACHE_VERSION = 1 #bump if tokenize_lbl_file changes, invalidates the cached .npz files
+LBL_MONTAGE_RE = re.compile(r"^\s*montage\s*=\s*(\d+)\s*,\s*([^:]+?)\s*:")
+LBL_SYMBOLS_RE = re.compile(r"^\s*symbols\[(\d+)\]\s*=\s*\{(.*)\}")
+LBL_SYMBOL_RE = re.compile(r"(\d+)\s*:\s*'([^']*)'")
+LBL_LABEL_RE = re.compile(r"^\s*label\s*=\s*\{\s*(\d+)\s*,\s*(\d+)\s*,\s*([^,\s]+)\s*,\s*([^,\s]+)\s*,\s*(\d+)\s*,\s*[\[{]([^\]}]*)[\]}]\s*\}")
+
+LblFile = namedtuple("LblFile", ["montage_names", "symbols", "level", "sublevel", "start", "end", "montage", "probs"])
+LblColumns = namedtuple("LblColumns", ["start", "end", "montage_index", "bckg_prob"])
+
+def tokenize_lbl_file(lbl_fn):
+    """Tokenizes a .lbl file with regular expressions. The label and symbol lines
+        look like python literals, but they are matched field by field instead of
+        going through exec/eval
+
+    Returns
+    -------
+    LblFile
+        montage_names : dict, montage number -> montage name (i.e. FP1-F7)
+        symbols : list, label names of level 0, the columns of probs
+        level, sublevel, montage : int arrays, one entry per label line
+        start, end : float arrays, in seconds
+        probs : label line by len(symbols) float array
+    """
+    montage_names = {}
+    symbols = []
+    labels = []
+    with open(lbl_fn, "r") as f:
+        for line in f:
+            match = LBL_LABEL_RE.match(line)
+            if match is not None:
+                labels.append(match.groups())
+                continue
+            match = LBL_MONTAGE_RE.match(line)
+            if match is not None:
+                montage_names[int(match.group(1))] = match.group(2)
+                continue
+            match = LBL_SYMBOLS_RE.match(line)
+            if match is not None and int(match.group(1)) == 0:
+                symbol_dict = {int(key): symbol for key, symbol in LBL_SYMBOL_RE.findall(match.group(2))}
+                symbols = [symbol_dict[i] for i in range(len(symbol_dict))]
+    probs = np.array([[float(prob) for prob in label[5].split(",") if prob.strip() != ""] for label in labels], dtype=np.float64).reshape(len(labels), -1) if len(labels) != 0 else np.zeros((0, len(symbols)))
+    return LblFile(
+        montage_names=montage_names,
+        symbols=symbols,
+        level=np.array([int(label[0]) for label in labels], dtype=np.int64),
+        sublevel=np.array([int(label[1]) for label in labels], dtype=np.int64),
+        start=np.array([float(label[2]) for label in labels], dtype=np.float64),
+        end=np.array([float(label[3]) for label in labels], dtype=np.float64),
+        montage=np.array([int(label[4]) for label in labels], dtype=np.int64),
+        probs=probs)
+
 def get_per_channel_annotation(lbl_fn):
     """ Get a compressed dataframe breaking down time seizure info for each channel
 
     Parameters
     ----------
     lbl_fn : str
-        Description of parameter `fn`.
+        path of the .lbl file
 
     Returns
     -------
-    type
-        Description of returned object.
-
-    """
-    with open(lbl_fn, "rb") as  open_label_file:
-        output = open_label_file.readlines()
-    montage_channel_dict = {}
-    start_montage_channel_assign = False
-    symbols = [None]
-    symbols_list = []
-    full_list = []
-    for line in output:
-        if "montage = 0" in str(line):
-            start_montage_channel_assign = True
-        if start_montage_channel_assign:
-            if b'\n' == (line):
-                start_montage_channel_assign = False
-            else:
-                montage_channel_dict[int(line[10:str(line).index(',') - 2])] = (line[str(line).index(','):str(line).index(':') - 2]).decode("utf-8")
-        elif "symbols[0]" in str(line):
-            #since we are using weird pseudocode, run the string through exec and get the symbols variable out
-            exec(line.decode("utf8"))
-            symbols_dict = symbols
-            symbols_list = [symbols_dict[0][i] for i in range(len(symbols[0].keys()))]
-    #         print(symbols_list)
-        elif "label =" in str(line):
-#             print(line.decode("utf8").replace("{", "[").replace("}", "]"))
-            #since we are using weird pseudocode, run the string through exec and get the label variable out
-            label = eval(line.decode("utf8").replace("{", "[").replace("}", "]")[7:])
-
-            curr_level = label[0]
-            curr_sublevel = label[1]
-            curr_start = label[2]
-            curr_end = label[3]
-            curr_mont_num = label[4]
-            curr_channel = montage_channel_dict[int(curr_mont_num)]
-            curr_label_probs = label[5]
-            curr_vals = pd.Series([curr_level, curr_sublevel, curr_start, curr_end, curr_channel, *curr_label_probs], index=["level", "sublevel", "start", "end", "channel", *symbols_list])
-            full_list.append(curr_vals)
-    return pd.concat(full_list, axis=1).T
+    pd.DataFrame
+        one row per label line, columns are level, sublevel, start, end,
+        channel (the montage name) and then one column per symbol with its probability
+
+    """
+    lbl_file = tokenize_lbl_file(lbl_fn)
+    data = pd.DataFrame(OrderedDict([
+        ("level", lbl_file.level),
+        ("sublevel", lbl_file.sublevel),
+        ("start", lbl_file.start),
+        ("end", lbl_file.end),
+        ("channel", [lbl_file.montage_names[montage] for montage in lbl_file.montage])]))
+    for j, symbol in enumerate(lbl_file.symbols):
+        data[symbol] = lbl_file.probs[:, j]
+    return data
+
+def build_lbl_columns(lbl_fn):
+    """Compact version of a .lbl file, just what the montage labels need
+
+    Returns
+    -------
+    LblColumns
+        start, end in seconds, montage_index into constants.MONTAGE_COLUMNS and
+        bckg_prob of each label line, in file order. Lines on montages that
+        aren't in constants.MONTAGE_COLUMNS are dropped
+    """
+    lbl_file = tokenize_lbl_file(lbl_fn)
+    montage_columns = {montage_name: j for j, montage_name in enumerate(constants.MONTAGE_COLUMNS)}
+    montage_index = np.array([montage_columns.get(lbl_file.montage_names[montage], -1) for montage in lbl_file.montage], dtype=np.int64)
+    keep = montage_index != -1
+    return LblColumns(
+        start=lbl_file.start[keep],
+        end=lbl_file.end[keep],
+        montage_index=montage_index[keep],
+        bckg_prob=lbl_file.probs[keep, lbl_file.symbols.index("bckg")])
+
+def get_lbl_cache_path(lbl_fn, file_stat):
+    key = repr((LBL_CACHE_VERSION, path.abspath(lbl_fn), file_stat.st_mtime, file_stat.st_size))
+    key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return path.join(util_funcs.get_cache_dir("lbl_annotations"), key[:2], key + ".npz")
+
+@functools.lru_cache(10000)
+def load_lbl_columns(lbl_fn, mtime, size):
+    """build_lbl_columns, cached as a .npz in the cache dir and in memory per (path, mtime, size)
+    """
+    file_stat = os.stat(lbl_fn)
+    cache_path = get_lbl_cache_path(lbl_fn, file_stat)
+    if path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            return LblColumns(**{column: cached[column] for column in LblColumns._fields})
+    lbl_columns = build_lbl_columns(lbl_fn)
+    os.makedirs(path.dirname(cache_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp.npz".format(cache_path[:-len(".npz")], os.getpid()) #write then rename so other workers never see a partial file
+    np.savez(tmp_path, **lbl_columns._asdict())
+    os.replace(tmp_path, cache_path)
+    return lbl_columns
+
+def read_lbl_columns(lbl_fn):
+    file_stat = os.stat(lbl_fn)
+    return load_lbl_columns(lbl_fn, file_stat.st_mtime, file_stat.st_size)
+
+def get_montage_labels_at(lbl_fn, times):
+    """Seizure probability (1 - bckg) of every montage channel at the given times,
+        the same values as the rows of gen_seizure_channel_labels at those times
+        but without building the expanded frame. Label lines cover [start, end],
+        later lines in the file win where they overlap
+
+    Parameters
+    ----------
+    lbl_fn : str
+    times : float, list, np.ndarray or pd.TimedeltaIndex
+        seconds from the start of the recording
+
+    Returns
+    -------
+    np.ndarray
+        len(constants.MONTAGE_COLUMNS) array for a single time, otherwise a
+        time by len(constants.MONTAGE_COLUMNS) array
+    """
+    lbl_columns = read_lbl_columns(lbl_fn)
+    is_scalar = np.ndim(times) == 0
+    times = pd.to_timedelta(np.atleast_1d(times) if is_scalar else times, unit="s").values.astype(np.int64)
+    starts = pd.to_timedelta(lbl_columns.start, unit="s").values.astype(np.int64)
+    ends = pd.to_timedelta(lbl_columns.end, unit="s").values.astype(np.int64)
+    covers = (starts[None, :] <= times[:, None]) & (times[:, None] <= ends[None, :])
+    montage_labels = np.zeros((len(times), len(constants.MONTAGE_COLUMNS)))
+    for j in range(len(starts)):
+        montage_labels[covers[:, j], lbl_columns.montage_index[j]] = 1 - lbl_columns.bckg_prob[j]
+    if is_scalar:
+        return montage_labels[0]
+    return montage_labels
 
 def gen_seizure_channel_labels(fn, width=pd.Timedelta(seconds=0.5)):
-    data = get_per_channel_annotation(fn)
-    max_time = pd.Timedelta(seconds=int(data.end.max()))
+    lbl_columns = read_lbl_columns(fn)
+    max_time = pd.Timedelta(seconds=int(lbl_columns.end.max()))
     index = pd.timedelta_range(start=pd.Timedelta(0), end=max_time, freq=width)
-    columns = constants.MONTAGE_COLUMNS
-    expanded_is_seizure = pd.DataFrame(index=index, columns=columns).fillna(0)
-    for i, row in data.iterrows():
-        expanded_is_seizure.loc[pd.Timedelta(seconds=row.start):pd.Timedelta(seconds=row.end), row.channel] = 1 - row.bckg
-    return expanded_is_seizure
+    return pd.DataFrame(get_montage_labels_at(fn, index), index=index, columns=constants.MONTAGE_COLUMNS)
 
 @functools.lru_cache()
 def getAllTrainPatients():
     #used for adversarial multitask learning, captures interpatient variation
-    allTrainEdfTokens = get_all_token_file_names("train", "01_tcp_ar")
-    allTrainPatients = [parse_edf_token_path_structure(edfToken)[1] for edfToken in allTrainEdfTokens]
-    allTrainPatients = list(set(allTrainPatients))
+    allTrainPatients = list(set(corpus_manifest.get_manifest("train", "01_tcp_ar").tokens["patient"]))
     return sorted(allTrainPatients)
 
 def getAllValidTestPatients():
@@ -764,9 +1614,7 @@ def getAllValidTestPatients():
 
 @functools.lru_cache()
 def getAllTrainSessions():
-    allTrainEdfTokens = get_all_token_file_names("train", "01_tcp_ar")
-    allTrainPatients = [parse_edf_token_path_structure(edfToken)[2] for edfToken in allTrainEdfTokens]
-    allTrainPatients = list(set(allTrainPatients))
+    allTrainPatients = list(set(corpus_manifest.get_manifest("train", "01_tcp_ar").tokens["session"]))
     return sorted(allTrainPatients)
     #captures intersession variation, instead of only interpatient variation
 
@@ -805,15 +1653,7 @@ def get_patient_dir_names(data_split, ref, full_path=True):
     """
     assert data_split in get_data_split()
     assert ref in get_reference_node_types()
-    config = read_config()
-    if data_split is None:
-        root_dir_path = config["data_dir_root"] + "/" + ref
-    else:
-        root_dir_entry = data_split + "_" + ref
-        root_dir_path = config[root_dir_entry]
-    subdirs = get_abs_files(root_dir_path)
-    patient_dirs = list(itertools.chain.from_iterable(
-        [get_abs_files(subdir) for subdir in subdirs]))
+    patient_dirs = corpus_manifest.get_manifest(data_split, ref).patient_dirs
     if full_path:
         return patient_dirs
     else:
@@ -841,9 +1681,10 @@ def get_session_dir_names(data_split, ref, full_path=True, patient_dirs=None):
     assert data_split in get_data_split()
     assert ref in get_reference_node_types()
     if patient_dirs is None:
-        patient_dirs = get_patient_dir_names(data_split, ref)
-    session_dirs = list(itertools.chain.from_iterable(
-        [get_abs_files(patient_dir) for patient_dir in patient_dirs]))
+        session_dirs = corpus_manifest.get_manifest(data_split, ref).session_dirs
+    else:
+        session_dirs = list(itertools.chain.from_iterable(
+            [get_abs_files(patient_dir) for patient_dir in patient_dirs]))
     if full_path:
         return session_dirs
     else:
@@ -851,9 +1692,10 @@ def get_session_dir_names(data_split, ref, full_path=True, patient_dirs=None):
 
 
 def get_all_token_file_names(data_split, ref, full_path=True):
-    session_dirs = get_session_dir_names(data_split, ref)
-    token_fns = list(itertools.chain.from_iterable(
-        [get_token_file_names(session_dir) for session_dir in session_dirs]))
+    """paths of every edf token in a split, from the corpus manifest (see
+        corpus_manifest.build_manifest) instead of walking the directories
+    """
+    token_fns = corpus_manifest.get_manifest(data_split, ref).tokens["edf_path"].tolist()
     if full_path:
         return token_fns
     else:
@@ -943,7 +1785,7 @@ if __name__ == "__main__":
         times = []
         for path in token_files:
             try:
-                with pyedflib.EdfReader(path, check_file_size=pyedflib.DO_NOT_CHECK_FILE_SIZE) as reader:
+                with edf_reader_pool.get_reader(path, get_edf_reader_config()._replace(check_file_size=pyedflib.DO_NOT_CHECK_FILE_SIZE)) as reader:
                     times.append(
                         reader.readSignal(0).shape[0] /
                         reader.getSignalHeader(0)["sample_rate"])
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import os
+from os import path
+import hashlib
+import functools
+import util_funcs
+import data_reader as read
+import edf_header_index
+
+CACHE_VERSION = 1 #bump if the way recordings are preprocessed changes, invalidates every cached file
+
+def get_cache_path(edf_path, resample, channels, filter=True, lp_cutoff=1, hp_cutoff=50, order_filt=5, dtype=np.float32):
+    """Path of the cached .npy for an edf file and the read parameters. The key
+        includes the mtime and size of the edf file, so rewritten files miss the cache
+    """
+    file_stat = os.stat(edf_path)
+    key = repr((CACHE_VERSION, path.abspath(edf_path), file_stat.st_mtime, file_stat.st_size,
+                resample.value, tuple(channels), filter, lp_cutoff, hp_cutoff, order_filt, np.dtype(dtype).str))
+    key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return path.join(util_funcs.get_cache_dir("edf_recordings"), key[:2], key + ".npy")
+
+def build_cached_recording(edf_path, resample, channels, filter=True, lp_cutoff=1, hp_cutoff=50, order_filt=5, dtype=np.float32, reader_config=None):
+    """Reads the whole recording, resamples, bandpass filters and orders the channels,
+        then writes it as a (time, channel) .npy in the cache dir if it isn't already there
+
+    Returns
+    -------
+    str
+        path of the cached .npy
+    """
+    if channels is None:
+        channels = edf_header_index.get_header(edf_path).channel_labels
+    cache_path = get_cache_path(edf_path, resample, channels, filter, lp_cutoff, hp_cutoff, order_filt, dtype)
+    if path.exists(cache_path):
+        return cache_path
+    preprocessor = read.EdfPreprocessor(channels=channels, resample=resample, filter=filter, lp_cutoff=lp_cutoff, hp_cutoff=hp_cutoff, order_filt=order_filt, fill_nans=False, dtype=np.float64, reader_config=reader_config)
+    data, channel_names, period = preprocessor.read(edf_path)
+    os.makedirs(path.dirname(cache_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp.npy".format(cache_path[:-len(".npy")], os.getpid()) #write then rename so other workers never see a partial file
+    np.save(tmp_path, data.astype(dtype))
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+@functools.lru_cache(100)
+def load_cached_recording(cache_path):
+    """memory maps a cached recording read only, pages are shared between processes
+    """
+    return np.load(cache_path, mmap_mode="r")
+
+def read_cached_window(edf_path, start, max_length, resample, channels, filter=True, lp_cutoff=1, hp_cutoff=50, order_filt=5, dtype=np.float32, reader_config=None):
+    """Window of a recording served from the memory mapped cache, building the cache
+        entry on first touch. Unlike reading the window with edf_eeg_2_np and
+        filtering it, the window is cut out of the continuously filtered recording,
+        so there is no filter start up transient at the beginning of each window
+
+    Parameters
+    ----------
+    edf_path : str
+    start : pd.Timedelta or int
+        where the window starts, an int is a row of the resampled recording
+    max_length : pd.Timedelta
+        if None, reads until the end of the recording. Otherwise exactly
+        round(max_length / resample) rows are returned, NaN past the end of the recording
+    resample : pd.Timedelta
+        has to be set, the cached recording is stored at this period
+    channels : list
+        channel labels, columns of the returned array are in this order. If
+        None, every channel in the file
+
+    Returns
+    -------
+    np.ndarray
+        time by channel array, a copy of just the requested rows
+    list
+        channel labels
+    pd.Timedelta
+        time between rows
+    """
+    if resample is None:
+        raise Exception("cached reads need a resample period")
+    if channels is None:
+        channels = edf_header_index.get_header(edf_path).channel_labels
+    cache_path = build_cached_recording(edf_path, resample, channels, filter, lp_cutoff, hp_cutoff, order_filt, dtype, reader_config=reader_config)
+    recording = load_cached_recording(cache_path)
+    if type(start) == pd.Timedelta:
+        start = int(round(start / resample))
+    if max_length is None:
+        return np.array(recording[start:]), list(channels), resample
+    data = np.full((int(round(max_length / resample)), recording.shape[1]), np.nan, dtype=recording.dtype)
+    window = recording[start:start + data.shape[0]]
+    data[:window.shape[0]] = window
+    return data, list(channels), resample
@@ -0,0 +1,178 @@
+import pandas as pd
+import pyedflib
+import os
+from os import path
+import multiprocessing as mp
+import functools
+import util_funcs
+import data_reader as read
+from addict import Dict
+
+HEADER_COLUMNS = ["mtime", "size", "channel_labels", "sample_rates", "num_samples", "dimensions", "start_time", "file_duration"]
+
+class EdfHeaderReader(util_funcs.MultiProcessingDataset):
+    """Reads only the headers of a list of edf files, used to build the header index in parallel
+
+    Parameters
+    ----------
+    edf_tokens : list
+        paths of edf files to read the headers of
+    n_process : int
+        number of processes to use when indexing by slice
+
+    """
+    executor = "threads" #header reads are io bound
+
+    def __init__(self, edf_tokens, n_process=None):
+        self.edf_tokens = edf_tokens
+        if n_process is None:
+            n_process = mp.cpu_count()
+        self.n_process = n_process
+        self.verbosity = 1000
+
+    def __len__(self):
+        return len(self.edf_tokens)
+
+    def __getitem__(self, i):
+        if self.should_use_mp(i):
+            return self.getItemSlice(i)
+        return read_edf_header(self.edf_tokens[i])
+
+def read_edf_header(edf_path):
+    """Reads the header of a single edf file
+
+    Parameters
+    ----------
+    edf_path : str
+        path of the edf file
+
+    Returns
+    -------
+    tuple
+        values in the same order as HEADER_COLUMNS
+    """
+    file_stat = os.stat(edf_path)
+    with read.edf_reader_pool.get_reader(edf_path) as reader: #edflib won't open a file twice, so share the pooled handle with the data reads
+        channel_labels = tuple(reader.getSignalLabels())
+        sample_rates = tuple([float(reader.getSampleFrequency(i)) for i in range(len(channel_labels))])
+        num_samples = tuple([int(num) for num in reader.getNSamples()])
+        dimensions = tuple([reader.getPhysicalDimension(i) for i in range(len(channel_labels))])
+        start_time = pd.Timestamp(reader.getStartdatetime())
+        file_duration = float(reader.getFileDuration())
+    return (file_stat.st_mtime, file_stat.st_size, channel_labels, sample_rates, num_samples, dimensions, start_time, file_duration)
+
+def get_header_index_path(data_split, ref):
+    return path.join(util_funcs.get_cache_dir("edf_header_index"), "{}_{}.pkl".format(data_split, ref))
+
+def build_header_index(data_split, ref, n_process=None, edf_tokens=None, rebuild=False):
+    """Scans the edf headers of a split and persists them in the cache dir. If an
+        index already exists, only files that are new or whose mtime/size changed
+        get read again, and files that are gone are dropped. If edf_tokens is
+        given, only those files are checked and the rest of the saved index is
+        kept as it is
+
+    Parameters
+    ----------
+    data_split : str
+    ref : str
+    n_process : int
+        number of processes used to read the headers
+    edf_tokens : list
+        if None, every file of the split (read.get_all_token_file_names(data_split, ref))
+    rebuild : bool
+        if True, ignores any existing index and reads every header again
+
+    Returns
+    -------
+    pd.DataFrame
+        index is edf token path (edf_tokens, in order), columns are HEADER_COLUMNS
+
+    """
+    whole_split = edf_tokens is None
+    if whole_split:
+        edf_tokens = read.get_all_token_file_names(data_split, ref)
+    edf_tokens = list(edf_tokens)
+    index_path = get_header_index_path(data_split, ref)
+    if path.exists(index_path) and not rebuild:
+        header_index = pd.read_pickle(index_path)
+    else:
+        header_index = pd.DataFrame(columns=HEADER_COLUMNS)
+
+    stale_tokens = []
+    for token in edf_tokens:
+        if token not in header_index.index:
+            stale_tokens.append(token)
+            continue
+        file_stat = os.stat(token)
+        if file_stat.st_mtime != header_index.loc[token, "mtime"] or file_stat.st_size != header_index.loc[token, "size"]:
+            stale_tokens.append(token)
+
+    changed = len(stale_tokens) != 0 or (whole_split and len(header_index) != len(edf_tokens))
+    if len(stale_tokens) != 0:
+        headers = EdfHeaderReader(stale_tokens, n_process=n_process)[:]
+        stale_index = pd.DataFrame(headers, index=stale_tokens, columns=HEADER_COLUMNS)
+        header_index = pd.concat([header_index.drop(stale_tokens, errors="ignore"), stale_index])
+    if whole_split:
+        header_index = header_index.reindex(edf_tokens) #drops files that were deleted, keeps token order
+    if changed:
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        header_index.to_pickle(tmp_path)
+        os.replace(tmp_path, index_path)
+    header_index = header_index.loc[edf_tokens]
+    loaded_headers.update(header_index.to_dict(orient="index"))
+    return header_index
+
+@functools.lru_cache(10)
+def get_header_index(data_split, ref, n_process=None):
+    """cached version of build_header_index, checked for changed files once per process
+    """
+    return build_header_index(data_split, ref, n_process=n_process)
+
+def get_file_lengths(data_split, ref, n_process=None, edf_tokens=None):
+    """Replacement for util_funcs.get_file_sizes that doesn't depend on the hand
+        generated assets/*_file_lengths.csv
+
+    Parameters
+    ----------
+    edf_tokens : list
+        if given, only the headers of these files are indexed (and returned)
+        instead of the whole split
+
+    Returns
+    -------
+    pd.Series
+        index is edf token path, value is length of the recording in seconds
+    """
+    if edf_tokens is not None:
+        return build_header_index(data_split, ref, n_process=n_process, edf_tokens=edf_tokens)["file_duration"]
+    return get_header_index(data_split, ref, n_process=n_process)["file_duration"]
+
+loaded_headers = {} #path -> header, filled as indices get loaded or single headers get read
+
+def get_header(edf_path):
+    """Header of a single edf file, taken from any header index already loaded in
+        this process if the file's mtime and size still match. Otherwise the
+        header is read again and remembered
+
+    Returns
+    -------
+    addict.Dict
+        keys are HEADER_COLUMNS
+    """
+    file_stat = os.stat(edf_path)
+    header = loaded_headers.get(edf_path)
+    if header is None or header["mtime"] != file_stat.st_mtime or header["size"] != file_stat.st_size:
+        header = dict(zip(HEADER_COLUMNS, read_edf_header(edf_path)))
+        loaded_headers[edf_path] = header
+    return Dict(header)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="builds (or incrementally updates) the edf header index for a split")
+    parser.add_argument("data_split")
+    parser.add_argument("ref")
+    parser.add_argument("--n_process", type=int, default=None)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+    header_index = build_header_index(args.data_split, args.ref, n_process=args.n_process, rebuild=args.rebuild)
+    print("indexed {} files to {}".format(len(header_index), get_header_index_path(args.data_split, args.ref)))
@@ -1,6 +1,9 @@
 import util_funcs
 import clinical_text_analysis as cta
 import data_reader as read
+import edf_header_index
+import edf_cache
+import feature_store as fstore
 from wf_analysis import filters
 import pandas as pd
 import numpy as np
@@ -43,21 +46,6 @@ class EnsemblerSequence():
     def on_epoch_end(self):
         pass
 
-class Utility_Custom_Annotater(util_funcs.MultiProcessingDataset):
-    def __init__(self, files, labels, custom_annotate, n_process=20):
-        self.labels = labels
-        self.files = files
-        self.n_process = n_process
-        self.verbosity = 1000
-        self.custom_annotate = custom_annotate
-    def __len__(self):
-        return len(self.files)
-    def __getitem__(self, i):
-        if self.should_use_mp(i):
-            print("starting custom_annotater")
-            return self.getItemSlice(i)
-        return self.files[i], self.custom_annotate(self.labels[i])
-
 class EdfDatasetSegmentsSamePatientsSplitSessions():
     """Short summary.
 
@@ -87,7 +75,7 @@ class EdfDatasetSegmentsSamePatientsSplitSessions():
     num_seconds : int
         granularity of label
     use_rolling : bool
-        use the generate_label_rolling_window function (which is slow)
+        use the generate_label_rolling_window function instead of seizure_series_annotate_times
 
     Attributes
     ----------
@@ -136,6 +124,7 @@ class EdfDatasetSegmentsSamePatientsSplitSessions():
         self.valid_files = []
         self.train_labeling = []
         self.valid_labeling = []
+        self.use_rolling = use_rolling
         if use_rolling:
             self.func_call = generate_label_rolling_window
         else:
@@ -158,19 +147,26 @@ class EdfDatasetSegmentsSamePatientsSplitSessions():
 
 
 
+    def annotate_split(self, files, anns):
+        return annotate_split(
+            files,
+            anns,
+            num_seconds=self.num_seconds,
+            pre_cooldown=self.pre_cooldown,
+            post_cooldown=self.post_cooldown,
+            sample_time=self.sample_time,
+            use_rolling=self.use_rolling)
+
     def get_train_valid_split(self):
-        return [(self.train_valid_files[i], self.custom_annotate(self.train_valid_labels[i],)) for i in range(len(self.train_valid_files))]
+        return self.annotate_split(self.train_valid_files, self.train_valid_labels)
     def get_test_split(self):
-        return Utility_Custom_Annotater(self.test_files, self.test_labeling, self.custom_annotate)[:]
-        return [(self.test_files[i], self.custom_annotate(self.test_labeling[i],)) for i in range(len(self.test_files))]
+        return self.annotate_split(self.test_files, self.test_labeling)
 
     def get_train_split(self):
-        return Utility_Custom_Annotater(self.train_files, self.train_labeling, self.custom_annotate)[:]
-        return [(self.train_files[i], self.custom_annotate(self.train_labeling[i],)) for i in range(len(self.train_files))]
+        return self.annotate_split(self.train_files, self.train_labeling)
 
     def get_valid_split(self):
-        return Utility_Custom_Annotater(self.valid_files, self.valid_labeling, self.custom_annotate)[:]
-        return [(self.valid_files[i], self.custom_annotate(self.valid_labeling[i],)) for i in range(len(self.valid_files))]
+        return self.annotate_split(self.valid_files, self.valid_labeling)
 
 
 class EdfDatasetSegmentsOnlySeizures():
@@ -221,6 +217,7 @@ class EdfDatasetSegmentsOnlySeizures():
         self.valid_files = []
         self.train_labeling = []
         self.valid_labeling = []
+        self.use_rolling = use_rolling
         if use_rolling:
             self.func_call = generate_label_rolling_window
         else:
@@ -243,19 +240,26 @@ class EdfDatasetSegmentsOnlySeizures():
 
 
 
+    def annotate_split(self, files, anns):
+        return annotate_split(
+            files,
+            anns,
+            num_seconds=self.num_seconds,
+            pre_cooldown=self.pre_cooldown,
+            post_cooldown=self.post_cooldown,
+            sample_time=self.sample_time,
+            use_rolling=self.use_rolling)
+
     def get_train_valid_split(self):
-        return [(self.train_valid_files[i], self.custom_annotate(self.train_valid_labels[i],)) for i in range(len(self.train_valid_files))]
+        return self.annotate_split(self.train_valid_files, self.train_valid_labels)
     def get_test_split(self):
-        return Utility_Custom_Annotater(self.test_files, self.test_labeling, self.custom_annotate)[:]
-        return [(self.test_files[i], self.custom_annotate(self.test_labeling[i],)) for i in range(len(self.test_files))]
+        return self.annotate_split(self.test_files, self.test_labeling)
 
     def get_train_split(self):
-        return Utility_Custom_Annotater(self.train_files, self.train_labeling, self.custom_annotate)[:]
-        return [(self.train_files[i], self.custom_annotate(self.train_labeling[i],)) for i in range(len(self.train_files))]
+        return self.annotate_split(self.train_files, self.train_labeling)
 
     def get_valid_split(self):
-        return Utility_Custom_Annotater(self.valid_files, self.valid_labeling, self.custom_annotate)[:]
-        return [(self.valid_files[i], self.custom_annotate(self.valid_labeling[i],)) for i in range(len(self.valid_files))]
+        return self.annotate_split(self.valid_files, self.valid_labeling)
 
 
 
@@ -288,7 +292,7 @@ class EdfDatasetSegments():
     num_seconds : int
         granularity of label
     use_rolling : bool
-        use the generate_label_rolling_window function (which is slow)
+        use the generate_label_rolling_window function instead of seizure_series_annotate_times
 
     Attributes
     ----------
@@ -336,6 +340,7 @@ class EdfDatasetSegments():
         self.valid_files = []
         self.train_labeling = []
         self.valid_labeling = []
+        self.use_rolling = use_rolling
         if use_rolling:
             self.func_call = generate_label_rolling_window
         else:
@@ -358,19 +363,26 @@ class EdfDatasetSegments():
 
 
 
+    def annotate_split(self, files, anns):
+        return annotate_split(
+            files,
+            anns,
+            num_seconds=self.num_seconds,
+            pre_cooldown=self.pre_cooldown,
+            post_cooldown=self.post_cooldown,
+            sample_time=self.sample_time,
+            use_rolling=self.use_rolling)
+
     def get_train_valid_split(self):
-        return [(self.train_valid_files[i], self.custom_annotate(self.train_valid_labels[i],)) for i in range(len(self.train_valid_files))]
+        return self.annotate_split(self.train_valid_files, self.train_valid_labels)
     def get_test_split(self):
-        return Utility_Custom_Annotater(self.test_files, self.test_labeling, self.custom_annotate)[:]
-        return [(self.test_files[i], self.custom_annotate(self.test_labeling[i],)) for i in range(len(self.test_files))]
+        return self.annotate_split(self.test_files, self.test_labeling)
 
     def get_train_split(self):
-        return Utility_Custom_Annotater(self.train_files, self.train_labeling, self.custom_annotate)[:]
-        return [(self.train_files[i], self.custom_annotate(self.train_labeling[i],)) for i in range(len(self.train_files))]
+        return self.annotate_split(self.train_files, self.train_labeling)
 
     def get_valid_split(self):
-        return Utility_Custom_Annotater(self.valid_files, self.valid_labeling, self.custom_annotate)[:]
-        return [(self.valid_files[i], self.custom_annotate(self.valid_labeling[i],)) for i in range(len(self.valid_files))]
+        return self.annotate_split(self.valid_files, self.valid_labeling)
 
 
 
@@ -401,6 +413,8 @@ class EdfDatasetSegmentedSampler(util_funcs.MultiProcessingDataset):
         include_montage_channels=False, # which montage channels have seizure
         include_segment=False,
         shuffle = True,
+        use_cache=False, #serve windows from edf_cache instead of decoding the edf file every time
+        reader_config=None, #read.EdfReaderConfig, resolved from the config once here if not given
     ):
         self.mode = mode
         self.n_process = n_process
@@ -424,6 +438,15 @@ class EdfDatasetSegmentedSampler(util_funcs.MultiProcessingDataset):
         self.overlapping_augmentation = overlapping_augmentation
         self.include_montage_channels = include_montage_channels
         self.include_segment = include_segment
+        self.use_cache = use_cache
+        self.reader_config = reader_config if reader_config is not None else read.get_edf_reader_config()
+        self.preprocessor = read.EdfPreprocessor(
+            channels=self.columns_to_use,
+            resample=self.resample,
+            lp_cutoff=self.lp_cutoff,
+            hp_cutoff=self.hp_cutoff,
+            order_filt=self.order_filt,
+            reader_config=self.reader_config)
         # self.num_splits_per_sample = num_splits_per_sample
         currentIndex = 0
         for token_file_path, segment in self.segment_file_tuples:
@@ -491,8 +514,7 @@ class EdfDatasetSegmentedSampler(util_funcs.MultiProcessingDataset):
         # lbl_fn = read.get_associated_lbl(indexData.token_file_path)
         # per_channel_ann = read.get_per_channel_annotation(lbl_fn)
         start = indexData.sample_num * indexData.sample_width / pd.Timedelta(seconds=1)
-        end = (indexData.sample_num+1) * indexData.sample_width / pd.Timedelta(seconds=1)
-        return read.gen_seizure_channel_labels(read.get_associated_lbl(indexData.token_file_path), indexData.sample_width).loc[pd.Timedelta(seconds=start)][constants.MONTAGE_COLUMNS]
+        return pd.Series(read.get_montage_labels_at(read.get_associated_lbl(indexData.token_file_path), start), index=constants.MONTAGE_COLUMNS)
         # raise Exception()
 
     def __len__(self):
@@ -506,54 +528,215 @@ class EdfDatasetSegmentedSampler(util_funcs.MultiProcessingDataset):
         offset = 0
         if self.overlapping_augmentation:
             offset = randint(0, 50) #add some random overlap up to 25% of the whole segment sample for data augmentation
+        if self.use_numpy:
+            data = self.get_numpy_data(indexData, offset)
+        else:
+            data = self.get_pandas_data(indexData, offset)
+        return self.attach_label(data, indexData)
+
+    def attach_label(self, data, indexData):
+        if not self.include_montage_channels:
+            return data, indexData.label
+        else:
+            return data, (*indexData.label, self.get_montage_channel(indexData))
+
+    def get_batch(self, indices):
+        """Same as self[indices], but every window is read in one pass with
+            read.read_windows (grouped by edf file) and filtered as one array,
+            instead of one read per sample. Windows from several files are split
+            into groups of files read on the executor, see read_batch_in_file_groups
+        """
+        indices = list(indices)
+        if self.use_cache or not self.use_numpy:
+            return self[indices]
+        return read_batch_in_file_groups(self, indices)
+
+    def read_batch(self, indices):
+        """get_batch of indices in this process"""
+        indexDatas = [self.sampleInfo[i] for i in indices]
+        requests = []
+        for indexData in indexDatas:
+            offset = 0
+            if self.overlapping_augmentation:
+                offset = randint(0, 50)
+            start = (indexData.sample_num + offset/200) * self.gap
+            requests.append((indexData.token_file_path, start.total_seconds(), self.gap.total_seconds()))
+        data, channel_names, period = self.preprocessor.read_windows(requests)
+        return [self.attach_label(data[j], indexData) for j, indexData in enumerate(indexDatas)]
+
+    def get_numpy_data(self, indexData, offset=0):
+        """Reads exactly the segment into a (time, channel) array with
+            read.read_window, skipping the DataFrame entirely
+        """
+        start = (indexData.sample_num + offset/200) * self.gap
+        if self.use_cache:
+            data, channel_names, period = edf_cache.read_cached_window(indexData.token_file_path,
+                                                                       start=start,
+                                                                       max_length=self.gap,
+                                                                       resample=self.resample,
+                                                                       channels=self.columns_to_use,
+                                                                       lp_cutoff=self.lp_cutoff,
+                                                                       hp_cutoff=self.hp_cutoff,
+                                                                       order_filt=self.order_filt,
+                                                                       reader_config=self.reader_config)
+            return util_funcs.np_ffill_bfill(data)
+        data, channel_names, period = self.preprocessor.read_window(indexData.token_file_path,
+                                                                    start.total_seconds(),
+                                                                    self.gap.total_seconds())
+        return data
+
+    def get_pandas_data(self, indexData, offset=0):
         data = read.edf_eeg_2_df(indexData.token_file_path,
                                  resample=self.resample,
                                  start=(indexData.sample_num + offset/200) * self.gap,
-                                 max_length=self.gap)
+                                 max_length=self.gap,
+                                 channels=tuple(self.columns_to_use),
+                                 reader_config=self.reader_config)
 
         data = data.loc[pd.Timedelta(seconds=0):self.gap].iloc[0:-1]
 
-        data = data[self.columns_to_use]
-        data = data.apply(
-            lambda col: filters.butter_bandpass_filter(
-                col,
-                lowcut=self.lp_cutoff,
-                highcut=self.hp_cutoff,
-                fs=pd.Timedelta(
-                    seconds=1) /
-                self.resample,
-                order=self.order_filt),
-            axis=0)
-        data = data.fillna(method="ffill").fillna(method="bfill")
-        if self.use_numpy:
-            data = data.values
-        if not self.include_montage_channels:
-            return data, indexData.label
-        else:
-            return data, (*indexData.label, self.get_montage_channel(indexData))
+        data = self.preprocessor.process_df(data)
+        return data
+
+
+
+def read_batch_in_file_groups(dataset, indices):
+    """dataset.read_batch(indices), but when the samples come from more than one
+        edf file and the dataset can use workers, the files are dealt out into
+        up to n_process groups (a file is never split, so its windows are still
+        read in one pass) and each group is read with read_batch on the executor
 
+    Returns
+    -------
+    list
+        items in the order of indices
+    """
+    token_files = [dataset.sampleInfo[i].token_file_path for i in indices]
+    file_groups = {token_file: k % dataset.n_process for k, token_file in enumerate(pd.unique(token_files))}
+    groups = [[] for k in range(min(dataset.n_process, len(file_groups)))]
+    for position, token_file in enumerate(token_files):
+        groups[file_groups[token_file]].append(position)
+    if len(groups) <= 1 or not dataset.can_use_workers(len(indices)):
+        return dataset.read_batch(indices)
+    group_results = dataset.map_method("read_batch", [[indices[position] for position in group] for group in groups])
+    toReturn = [None for i in indices]
+    for group, results in zip(groups, group_results):
+        for position, item in zip(group, results):
+            toReturn[position] = item
+    return toReturn
+
+SEGMENT_LABELS = ["bckg", "sample", "presz", "postsz"]
+
+@functools.lru_cache(1)
+def get_segment_label_names():
+    """label names of the codes returned by the *_label_codes functions,
+        SEGMENT_LABELS and then every seizure annotation type
+    """
+    return tuple(SEGMENT_LABELS + [label for label in read.get_tse_label_categories() if "sz" in label])
 
+def get_segment_label_code(label):
+    segment_label_codes = {name: code for code, name in enumerate(get_segment_label_names())}
+    if label not in segment_label_codes:
+        raise Exception("{} is not a known seizure label".format(label))
+    return segment_label_codes[label]
+
+def count_in_ranges(is_true, range_starts, range_ends):
+    """number of True values of is_true in each inclusive range [range_starts[i], range_ends[i]],
+        ranges are clamped to the array and empty if range_ends < range_starts
+    """
+    cumulative_count = np.concatenate([[0], np.cumsum(is_true)])
+    range_starts = np.clip(range_starts, 0, len(is_true))
+    range_ends = np.clip(range_ends + 1, 0, len(is_true))
+    return np.where(range_ends > range_starts, cumulative_count[range_ends] - cumulative_count[range_starts], 0)
+
+def rolling_window_label_codes(ann, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1):
+    """Integer grid version of generate_label_rolling_window. Each second of the
+        recording gets the seizure label covering it, else postsz if a seizure
+        ended within post_cooldown seconds before it, else presz if one starts
+        within pre_cooldown seconds, else sample if one starts within
+        sample_time seconds after that, else bckg
+
+    Returns
+    -------
+    np.ndarray
+        int8 codes into get_segment_label_names(), entry k is the label at
+        k * num_seconds seconds
+    """
+    if post_cooldown is None:
+        post_cooldown = pre_cooldown
+    per_second = read.expand_tse_file(ann, fully_expand=False).fillna("bckg").values #label at every second, seconds without an event count as bckg
+    is_seizure = np.array(["sz" in label for label in per_second], dtype=bool)
+    seconds = np.arange(len(per_second))
+    codes = np.zeros(len(per_second), dtype=np.int8)
+    is_sample = count_in_ranges(is_seizure, seconds + pre_cooldown, seconds + pre_cooldown + sample_time - 1) > 0
+    codes[is_sample] = get_segment_label_code("sample")
+    is_presz = count_in_ranges(is_seizure, seconds, seconds + pre_cooldown - 1) > 0
+    codes[is_presz] = get_segment_label_code("presz")
+    is_postsz = (seconds != 0) & (count_in_ranges(is_seizure, np.maximum(seconds - post_cooldown, 0), seconds - 2) > 0)
+    codes[is_postsz] = get_segment_label_code("postsz")
+    for label in set(per_second[is_seizure]):
+        codes[per_second == label] = get_segment_label_code(label)
+    num_rows = int(ann.end.max())
+    label_codes = np.zeros(num_rows, dtype=np.int8)
+    on_grid = np.arange(num_rows) * num_seconds
+    on_grid = on_grid[on_grid < len(codes)]
+    label_codes[:len(on_grid)] = codes[on_grid]
+    if num_seconds == 1 and len(codes) > num_rows and codes[num_rows] != get_segment_label_code("bckg"):
+        label_codes = np.append(label_codes, codes[num_rows]) #the last second is past int(ann.end.max()), the pd.Series version appended it when it wasn't bckg
+    return label_codes
+
+def label_codes_to_series(label_codes, num_seconds=1):
+    """label names of an int8 code array from the *_label_codes functions,
+        indexed by time at every num_seconds
+    """
+    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, periods=len(label_codes))
+    return pd.Series(np.array(get_segment_label_names(), dtype=object)[label_codes], index=timeInd)
 
 def generate_label_rolling_window(ann, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1):
+    """
+    Returns
+    -------
+    pd.Series
+        label at every num_seconds for int(ann.end.max()) steps, see rolling_window_label_codes
+    """
+    label_codes = rolling_window_label_codes(ann, pre_cooldown=pre_cooldown, post_cooldown=post_cooldown, sample_time=sample_time, num_seconds=num_seconds)
+    return label_codes_to_series(label_codes, num_seconds)
+
+def annotate_times_label_codes(raw_ann, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1):
+    """Integer grid version of seizure_series_annotate_times. On the grid of
+        num_seconds steps, every seizure marks [start - pre_cooldown - sample_time,
+        start - pre_cooldown] as sample, [start - pre_cooldown, start] as presz,
+        [end, end + post_cooldown] as postsz and [start, end] with its label,
+        each range including both ends. Later kinds overwrite earlier ones in
+        that order
+
+    Returns
+    -------
+    np.ndarray
+        int8 codes into get_segment_label_names(), entry k is the label at
+        k * num_seconds seconds
+    """
     if post_cooldown is None:
         post_cooldown = pre_cooldown
-    partial_expand = read.expand_tse_file(ann, fully_expand=False)
-    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, periods=ann.end.max())
-    label_arr = pd.Series(index=timeInd, dtype=str).fillna("bckg")
-    def is_seiz_class(label):
-        if type(label) == pd.Series:
-            return label.apply(lambda data: "sz" in data)
-        return "sz" in label
-    for i, time_index in enumerate(partial_expand.index):
-        if is_seiz_class(partial_expand[i]):
-            label_arr[time_index] = partial_expand[i]
-        elif i != 0 and is_seiz_class(partial_expand[partial_expand.index[max(0,i-post_cooldown):i-1]]).any():
-            label_arr[time_index] = "postsz" # we had seizure in past, we can't use the following period for seizure prediction
-        elif is_seiz_class(partial_expand.iloc[i:i+pre_cooldown]).any():
-            label_arr[time_index] = "presz" #cooldown period before seizure starts, we can't use this
-        elif is_seiz_class(partial_expand.iloc[i+pre_cooldown:i+pre_cooldown+sample_time]).any():
-            label_arr[time_index] = "sample" #seizure target
-    return label_arr
+    end_max = raw_ann.end.max() - raw_ann.end.max() % num_seconds #deal with off by one error
+    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, end=end_max * pd.Timedelta(seconds=1))
+    grid = timeInd.asi8
+    label_codes = np.zeros(len(grid), dtype=np.int8)
+    raw_end_max = raw_ann.end.max()
+    seizures = [(start, end, label) for start, end, label in zip(raw_ann.start.values, raw_ann.end.values, raw_ann.label.astype(str).values) if "sz" in label.lower()]
+    ranges = []
+    ranges += [(max(0, start - pre_cooldown - sample_time), max(0, start - pre_cooldown), "sample") for start, end, label in seizures]
+    ranges += [(max(0, start - pre_cooldown), start, "presz") for start, end, label in seizures]
+    ranges += [(end, min(raw_end_max, end + post_cooldown), "postsz") for start, end, label in seizures]
+    ranges += [(start, end, label) for start, end, label in seizures]
+    for start, end, label in ranges:
+        if start == end:
+            continue
+        lo = np.searchsorted(grid, pd.Timedelta(seconds=start).value, side="left")
+        hi = np.searchsorted(grid, pd.Timedelta(seconds=end).value, side="right")
+        label_codes[lo:hi] = get_segment_label_code(label)
+    last_row = np.searchsorted(grid, pd.Timedelta(seconds=end_max - num_seconds * 2).value, side="right")
+    return label_codes[:last_row]
 
 def seizure_series_annotate_times(raw_ann,
                                   pre_cooldown=5,
@@ -561,55 +744,39 @@ def seizure_series_annotate_times(raw_ann,
                                   sample_time=5,
                                   num_seconds=1
                                   ):
-    if post_cooldown is None:
-        post_cooldown = pre_cooldown
-    possibleSeizureTrainTimes = []
-    possibleNonseizureTrainTimes = []
-    start_min = raw_ann.start.min()
-    end_max = raw_ann.end.max() -  raw_ann.end.max() % num_seconds #deal with off by one error
-
-    cooldown_times = []
-    seizure_times = []
-    preseizure_cooldown_times = []
-    postseizure_cooldown_times = []
-    possible_sample_times = []
-    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, end=end_max * pd.Timedelta(seconds=1))
-    labelTimeSeries = pd.Series(index=timeInd)
-
-
-    preseizure_predict_times = []
-    for i, label in raw_ann.iterrows():
-        if "sz" in label["label"].lower():
-            seizure_times.append((label.start, label.end, label.label))
-            preseizure_cooldown_times.append((max(0, label.start-pre_cooldown), label.start, label.label))
-            possible_sample_times.append((max(0, label.start-pre_cooldown - sample_time), max(0, label.start-pre_cooldown), label.label))
-            postseizure_cooldown_times.append((label.end, min(max(raw_ann.end), label.end+post_cooldown), label.label))
-    postseizure_cooldown_times = pd.DataFrame(postseizure_cooldown_times, columns=["start", "end", "label"])
-    postseizure_cooldown_times = postseizure_cooldown_times.loc[postseizure_cooldown_times["start"] != postseizure_cooldown_times["end"]]
-
-
-    preseizure_cooldown_times = pd.DataFrame(preseizure_cooldown_times, columns=["start", "end", "label"])
-    preseizure_cooldown_times = preseizure_cooldown_times.loc[preseizure_cooldown_times["start"] != preseizure_cooldown_times["end"]]
+    """
+    Returns
+    -------
+    pd.Series
+        label at every num_seconds, see annotate_times_label_codes
+    """
+    label_codes = annotate_times_label_codes(raw_ann, pre_cooldown=pre_cooldown, post_cooldown=post_cooldown, sample_time=sample_time, num_seconds=num_seconds)
+    return label_codes_to_series(label_codes, num_seconds)
 
-    seizure_times = pd.DataFrame(seizure_times, columns=["start", "end", "label"])
-    seizure_times = seizure_times.loc[seizure_times["start"] != seizure_times["end"]]
+def annotate_label_codes(anns, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1, use_rolling=False):
+    """annotate_times_label_codes (or rolling_window_label_codes if use_rolling)
+        for a batch of recordings
 
-    possible_sample_times = pd.DataFrame(possible_sample_times, columns=["start", "end", "label"])
-    possible_sample_times = possible_sample_times.loc[possible_sample_times["start"] != possible_sample_times["end"]]
-    new_ann = raw_ann.copy()
+    Parameters
+    ----------
+    anns : list
+        pd.DataFrame of tse events per recording, as returned by read.read_tse_file
 
-    labelTimeSeries = labelTimeSeries.fillna("bckg")
-    for i, samp_time in possible_sample_times.iterrows():
-        labelTimeSeries[pd.Timedelta(seconds=samp_time.start):pd.Timedelta(seconds=samp_time.end)] = "sample"
-    for i, cooldown in preseizure_cooldown_times.iterrows():
-        labelTimeSeries[pd.Timedelta(seconds=cooldown.start):pd.Timedelta(seconds=cooldown.end)] = "presz"
-    for i, cooldown in postseizure_cooldown_times.iterrows():
-        labelTimeSeries[pd.Timedelta(seconds=cooldown.start):pd.Timedelta(seconds=cooldown.end)] = "postsz"
+    Returns
+    -------
+    list
+        int8 label code array per recording
+    """
+    label_code_func = rolling_window_label_codes if use_rolling else annotate_times_label_codes
+    return [label_code_func(ann, pre_cooldown=pre_cooldown, post_cooldown=post_cooldown, sample_time=sample_time, num_seconds=num_seconds) for ann in anns]
 
-    for i, seizure in seizure_times.iterrows():
-        labelTimeSeries[pd.Timedelta(seconds=seizure.start):pd.Timedelta(seconds=seizure.end)] = seizure.label
-    labelTimeSeries = labelTimeSeries[pd.Timedelta(seconds=0):pd.Timedelta(seconds=end_max-num_seconds*2)]
-    return labelTimeSeries
+def annotate_split(files, anns, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1, use_rolling=False):
+    """(file, label pd.Series) per recording for the get_*_split methods of the
+        EdfDatasetSegments classes. Labels stay int8 codes from annotate_label_codes
+        until they are turned into names here
+    """
+    label_codes = annotate_label_codes(anns, pre_cooldown=pre_cooldown, post_cooldown=post_cooldown, sample_time=sample_time, num_seconds=num_seconds, use_rolling=use_rolling)
+    return [(file, label_codes_to_series(file_label_codes, num_seconds)) for file, file_label_codes in zip(files, label_codes)]
 
 class EdfDatasetEnsembler(util_funcs.MultiProcessingDataset):
     """
@@ -640,7 +807,9 @@ class EdfDatasetEnsembler(util_funcs.MultiProcessingDataset):
             file_lengths=None, #automatically populated if not given
             edf_tokens=None,
             labels=None, # labels that map to edf token level
-            generate_sample_info=True
+            generate_sample_info=True,
+            use_cache=False, #serve windows from edf_cache instead of decoding the edf file every time
+            reader_config=None #read.EdfReaderConfig, resolved from the config once here if not given
             ):
         if labels is not None:
             assert len(labels) == len(edf_tokens)
@@ -654,7 +823,6 @@ class EdfDatasetEnsembler(util_funcs.MultiProcessingDataset):
         if (type(max_length) == int):
             max_length = max_length * pd.Timedelta(seconds=pd.Timedelta(constants.COMMON_DELTA))
         self.max_length = max_length
-        self.manager = mp.Manager()
         if edf_tokens is None:
             self.edf_tokens = read.get_all_token_file_names(data_split, ref)
         else:
@@ -672,9 +840,20 @@ class EdfDatasetEnsembler(util_funcs.MultiProcessingDataset):
         self.ensemble_mode = ensemble_mode
         self.max_num_samples = max_num_samples
         if file_lengths is None:
-            file_lengths = util_funcs.get_file_sizes(data_split, ref)
+            file_lengths = edf_header_index.get_file_lengths(data_split, ref, n_process=n_process, edf_tokens=self.edf_tokens)
         self.file_lengths=file_lengths
         self.labels = labels
+        self.use_cache = use_cache
+        self.reader_config = reader_config if reader_config is not None else read.get_edf_reader_config()
+        self.preprocessor = read.EdfPreprocessor(
+            channels=self.get_channels_to_read(),
+            resample=resample,
+            filter=filter,
+            lp_cutoff=lp_cutoff,
+            hp_cutoff=hp_cutoff,
+            order_filt=order_filt,
+            dtype=dtype,
+            reader_config=self.reader_config)
 
 
 
@@ -758,37 +937,75 @@ class EdfDatasetEnsembler(util_funcs.MultiProcessingDataset):
     def __len__(self):
         return len(self.sampleInfo)
 
+    def get_feature_key(self, i):
+        """feature_store key of sample i, for transformers that store their outputs"""
+        indexData = self.sampleInfo[i]
+        params = (indexData.sample_num, repr(indexData.label) if "label" in indexData.keys() else None, self.resample, self.max_length, self.expand_tse, np.dtype(self.dtype).str, self.use_average_ref_names, self.filter, self.lp_cutoff, self.hp_cutoff, self.order_filt, tuple(self.columns_to_use), self.use_numpy, self.use_cache)
+        return fstore.get_source_key(indexData.token_file_path, type(self).__name__, params, extra_paths=[read.convert_edf_path_to_tse(indexData.token_file_path)])
+
     def __getitem__(self, i):
         if self.should_use_mp(i):
             return self.getItemSlice(i)
         indexData = self.sampleInfo[i]
-        data = read.edf_eeg_2_df(indexData.token_file_path, resample=self.resample, start=pd.Timedelta(indexData.sample_num * self.max_length), max_length=self.max_length)
-        if (self.max_length != None and max(data.index) > self.max_length):
-            if type(self.max_length) == pd.Timedelta:
-                data = data.loc[pd.Timedelta(seconds=0):self.max_length].iloc[0:-1]
-            else:
-                data = data.iloc[0:self.max_length]
-        if self.use_average_ref_names:
-            data = data[self.columns_to_use]
-        if self.filter:
-            data = data.apply(
-                lambda col: filters.butter_bandpass_filter(
-                    col,
-                    lowcut=self.lp_cutoff,
-                    highcut=self.hp_cutoff,
-                    fs=pd.Timedelta(
-                        seconds=1) /
-                    self.resample,
-                    order=self.order_filt),
-                axis=0)
-        data = data.fillna(method="ffill").fillna(method="bfill")
         if self.use_numpy:
-            data = data.values
+            data = self.get_numpy_data(indexData)
+        else:
+            data = self.get_pandas_data(indexData)
+        return self.attach_label(data, indexData)
+
+    def attach_label(self, data, indexData):
         if "label" not in indexData.keys():
             return data
         else:
             return data, indexData.label
 
+    def get_batch(self, indices):
+        """Same as self[indices], but every sample is read in one pass with
+            read.read_windows (grouped by edf file) and filtered as one array,
+            instead of one read per sample. Samples from several files are split
+            into groups of files read on the executor, see read_batch_in_file_groups
+        """
+        indices = list(indices)
+        if self.use_cache or not self.use_numpy:
+            return self[indices]
+        return read_batch_in_file_groups(self, indices)
+
+    def read_batch(self, indices):
+        """get_batch of indices in this process"""
+        indexDatas = [self.sampleInfo[i] for i in indices]
+        requests = [(indexData.token_file_path, pd.Timedelta(indexData.sample_num * self.max_length).total_seconds(), self.max_length.total_seconds()) for indexData in indexDatas]
+        data, channel_names, period = self.preprocessor.read_windows(requests)
+        return [self.attach_label(data[j], indexData) for j, indexData in enumerate(indexDatas)]
+
+    def get_channels_to_read(self):
+        """Channels to pass down to the edf reader so the channels we would throw
+            away are never decoded. None means read everything
+        """
+        if self.use_average_ref_names:
+            return tuple(self.columns_to_use)
+        return None
+
+    def get_numpy_data(self, indexData):
+        """Reads exactly the sample into a (time, channel) array with
+            read.read_window, skipping the DataFrame entirely
+        """
+        start = pd.Timedelta(indexData.sample_num * self.max_length)
+        if self.use_cache:
+            data, channel_names, period = edf_cache.read_cached_window(indexData.token_file_path, start=start, max_length=self.max_length, resample=self.resample, channels=self.get_channels_to_read(), filter=self.filter, lp_cutoff=self.lp_cutoff, hp_cutoff=self.hp_cutoff, order_filt=self.order_filt, dtype=self.dtype, reader_config=self.reader_config)
+            return util_funcs.np_ffill_bfill(data)
+        data, channel_names, period = self.preprocessor.read_window(indexData.token_file_path, start.total_seconds(), self.max_length.total_seconds())
+        return data
+
+    def get_pandas_data(self, indexData):
+        data = read.edf_eeg_2_df(indexData.token_file_path, resample=self.resample, start=pd.Timedelta(indexData.sample_num * self.max_length), max_length=self.max_length, channels=self.get_channels_to_read(), reader_config=self.reader_config)
+        if (self.max_length != None and max(data.index) > self.max_length):
+            if type(self.max_length) == pd.Timedelta:
+                data = data.loc[pd.Timedelta(seconds=0):self.max_length].iloc[0:-1]
+            else:
+                data = data.iloc[0:self.max_length]
+        data = self.preprocessor.process_df(data)
+        return data
+
 class AdditionalLabelEndpoints():
     def __init__(self, split, ref, sampleInfo=None, ensembler=None):
         assert sampleInfo is not None or ensembler is not None
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import os
+from os import path
+import hashlib
+import pickle as pkl
+import shutil
+import tempfile
+import util_funcs
+from util_funcs import read_config
+
+FEATURE_STORE_VERSION = 1 #bump if the stored layout changes, invalidates every stored item
+
+def get_file_version(file_path):
+    """(mtime, size) of a file, None if it doesn't exist"""
+    if not path.exists(file_path):
+        return None
+    file_stat = os.stat(file_path)
+    return (file_stat.st_mtime, file_stat.st_size)
+
+def get_source_key(edf_path, layer_name, params, extra_paths=[]):
+    """Key of an item read straight from an edf file. Includes the mtime and size
+        of the file, so rewritten files miss the store
+
+    Parameters
+    ----------
+    edf_path : str
+    layer_name : str
+        usually the class name of the dataset
+    params : tuple
+        every parameter that changes the output, has to have a stable repr
+    extra_paths : list
+        other files the item is read from (i.e. the tse annotations), their
+        mtime and size are part of the key as well
+    """
+    file_stat = os.stat(edf_path)
+    extra_versions = tuple((path.abspath(extra_path), get_file_version(extra_path)) for extra_path in extra_paths)
+    key = repr((FEATURE_STORE_VERSION, path.abspath(edf_path), file_stat.st_mtime, file_stat.st_size, extra_versions, layer_name, params))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def get_layer_key(upstream_key, layer_name, params):
+    """Key of an item computed from an upstream item, so changing the parameters
+        of one layer only changes the keys of that layer and the ones after it.
+        None if the upstream item has no key
+    """
+    if upstream_key is None:
+        return None
+    key = repr((FEATURE_STORE_VERSION, upstream_key, layer_name, params))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def get_dataset_item_key(dataset, i):
+    """key of item i of a dataset that implements get_feature_key, None for
+        datasets that don't (i.e. most wf_analysis transformers), so whatever
+        is computed from their items is never stored
+    """
+    if not hasattr(dataset, "get_feature_key"):
+        return None
+    return dataset.get_feature_key(i)
+
+class FeatureStore():
+    """Content addressed store of dataset outputs on disk, one directory per
+        item. Arrays and DataFrames with a single numeric dtype are stored as
+        .npy files and memory mapped (copy on write) when read back, anything
+        else in the item (labels, DataFrame index and columns) is pickled next
+        to them. Items are written to a temporary directory and renamed into
+        place, so concurrent runs can share a store: whoever finishes first
+        wins and the others read that
+
+    Parameters
+    ----------
+    root : str
+        directory of the store, if None "feature_store_dir" from the config,
+        else the feature_store cache dir
+
+    """
+    def __init__(self, root=None):
+        if root is None:
+            root = read_config()["feature_store_dir"] if "feature_store_dir" in read_config() else util_funcs.get_cache_dir("feature_store")
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+
+    def get_item_dir(self, key):
+        return path.join(self.root, key[:2], key)
+
+    def __contains__(self, key):
+        return path.exists(path.join(self.get_item_dir(key), "meta.pkl"))
+
+    def load(self, key):
+        """stored item, or None if there is none"""
+        item_dir = self.get_item_dir(key)
+        meta_path = path.join(item_dir, "meta.pkl")
+        if not path.exists(meta_path):
+            return None
+        meta = pkl.load(open(meta_path, "rb"))
+        item = []
+        for part_num, (kind, value) in enumerate(meta["parts"]):
+            if kind == "object":
+                item.append(value)
+                continue
+            values = np.load(path.join(item_dir, "part_{}.npy".format(part_num)), mmap_mode="c")
+            if kind == "ndarray":
+                item.append(values)
+            else:
+                index, columns = value
+                item.append(pd.DataFrame(values, index=index, columns=columns))
+        return tuple(item) if meta["is_tuple"] else item[0]
+
+    def save(self, key, item):
+        item_dir = self.get_item_dir(key)
+        if path.exists(item_dir):
+            return
+        os.makedirs(path.dirname(item_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=path.dirname(item_dir), prefix=key + ".", suffix=".tmp") #unique per call, threads of one process can store the same key at once
+        parts = []
+        for part_num, part in enumerate(item if type(item) == tuple else (item,)):
+            if type(part) == np.ndarray and part.dtype != object:
+                np.save(path.join(tmp_dir, "part_{}.npy".format(part_num)), part)
+                parts.append(("ndarray", None))
+            elif type(part) == pd.DataFrame and len(set(part.dtypes)) == 1 and part.values.dtype != object:
+                np.save(path.join(tmp_dir, "part_{}.npy".format(part_num)), part.values)
+                parts.append(("dataframe", (part.index, part.columns)))
+            else:
+                parts.append(("object", part))
+        pkl.dump({"version": FEATURE_STORE_VERSION, "is_tuple": type(item) == tuple, "parts": parts}, open(path.join(tmp_dir, "meta.pkl"), "wb"))
+        try:
+            os.rename(tmp_dir, item_dir) #write then rename so other processes never see a partial item
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True) #someone else stored it first
+
+    def get_or_compute(self, key, compute):
+        """stored item for key, calling compute() and storing the result if there
+            is none. A None key (upstream can't be keyed) is always computed
+        """
+        if key is None:
+            return compute()
+        item = self.load(key)
+        if item is not None:
+            self.hits += 1
+            return item
+        self.misses += 1
+        item = compute()
+        self.save(key, item)
+        return item
+
+def get_feature_store(feature_store):
+    """Resolves the feature_store option of the datasets
+
+    Parameters
+    ----------
+    feature_store : bool, str or FeatureStore
+        None or False for no store, True for the default store, a path for a
+        store in that directory
+
+    Returns
+    -------
+    FeatureStore
+        or None
+    """
+    if feature_store is None or feature_store is False:
+        return None
+    if feature_store is True:
+        return FeatureStore()
+    if type(feature_store) == str:
+        return FeatureStore(feature_store)
+    return feature_store
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+import os
+from os import path
+import functools
+import pickle as pkl
+import util_funcs
+import corpus_manifest
+
+REGISTRY_VERSION = 1 #bump if the pickled layout changes, invalidates every saved registry
+REGISTRY_KINDS = ["patient", "session", "token"]
+
+class IdRegistry():
+    """Integer code table for names (patients, sessions, tokens). Codes never
+        change once assigned, new names are appended after the existing ones
+
+    Parameters
+    ----------
+    names : list
+        name of each code, code i is names[i]. Has to be unique
+
+    Attributes
+    ----------
+    names : np.ndarray
+        object array, indexing it with codes decodes them
+    codes : dict
+        name -> code
+    """
+    def __init__(self, names=[]):
+        self.names = np.array(list(names), dtype=object)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+        if len(self.codes) != len(self.names):
+            raise Exception("names of an IdRegistry have to be unique")
+        self.name_index = None
+
+    @classmethod
+    def from_values(cls, values):
+        """registry of the unique values, codes follow sorted order"""
+        return cls(sorted(set(values)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.codes
+
+    def get_index(self):
+        if self.name_index is None or len(self.name_index) != len(self.names):
+            self.name_index = pd.Index(self.names)
+        return self.name_index
+
+    def get_code(self, name):
+        """code of a single name"""
+        if name not in self.codes:
+            raise Exception("{} has no code in this registry".format(name))
+        return self.codes[name]
+
+    def add(self, names):
+        """assigns codes to the names that don't have one yet, in the order given
+
+        Returns
+        -------
+        bool
+            whether any name was added
+        """
+        new_names = [name for name in pd.unique(np.asarray(list(names), dtype=object)) if name not in self.codes]
+        for name in new_names:
+            self.codes[name] = len(self.codes)
+        if len(new_names) != 0:
+            self.names = np.concatenate([self.names, np.array(new_names, dtype=object)])
+        return len(new_names) != 0
+
+    def encode(self, names, missing=-1):
+        """codes of an array of names, missing where a name has no code
+
+        Returns
+        -------
+        np.ndarray
+            int64 array, same length as names
+        """
+        codes = self.get_index().get_indexer(np.asarray(list(names), dtype=object)).astype(np.int64)
+        if missing != -1:
+            codes[codes == -1] = missing
+        return codes
+
+    def decode(self, codes):
+        """names of an array of codes"""
+        return self.names[np.asarray(codes, dtype=np.int64)]
+
+    def save(self, registry_path):
+        os.makedirs(path.dirname(registry_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(registry_path, os.getpid()) #write then rename so other processes never see a partial file
+        pkl.dump({"version": REGISTRY_VERSION, "names": list(self.names)}, open(tmp_path, "wb"))
+        os.replace(tmp_path, registry_path)
+
+    @classmethod
+    def load(cls, registry_path):
+        """saved registry, or None if there is none (or it is from an older version)"""
+        if not path.exists(registry_path):
+            return None
+        saved = pkl.load(open(registry_path, "rb"))
+        if saved["version"] != REGISTRY_VERSION:
+            return None
+        return cls(saved["names"])
+
+def get_registry_path(kind, data_split, ref):
+    return path.join(util_funcs.get_cache_dir("id_registry"), "{}_{}_{}.pkl".format(data_split, ref, kind))
+
+def get_names_from_paths(edf_paths, kind):
+    """patient, session or token name of each edf token path, the same names
+        read.parse_edf_token_path_structure gives but split for all paths at once.
+        Tokens are named by their full path
+    """
+    assert kind in REGISTRY_KINDS
+    edf_paths = pd.Series(list(edf_paths), dtype=object)
+    if kind == "token":
+        return edf_paths.values
+    path_parts = edf_paths.str.split("/")
+    return (path_parts.str[-3] if kind == "patient" else path_parts.str[-2]).values
+
+def build_registry(kind, data_split="train", ref="01_tcp_ar", rebuild=False):
+    """Registry of every patient, session or token in a split. The first time,
+        patients and sessions get codes in sorted order (so codes are the same
+        as positions in read.getAllTrainPatients() and read.getAllTrainSessions())
+        and tokens in corpus manifest order. The registry is saved in the cache
+        dir, and names that show up later are appended so older codes stay valid
+
+    Parameters
+    ----------
+    kind : str
+        one of REGISTRY_KINDS
+    data_split : str
+    ref : str
+    rebuild : bool
+        if True, ignores the saved registry and assigns every code again
+
+    Returns
+    -------
+    IdRegistry
+    """
+    assert kind in REGISTRY_KINDS
+    tokens = corpus_manifest.get_manifest(data_split, ref).tokens
+    names = tokens["edf_path"] if kind == "token" else sorted(set(tokens[kind]))
+    registry_path = get_registry_path(kind, data_split, ref)
+    registry = None if rebuild else IdRegistry.load(registry_path)
+    if registry is None:
+        registry = IdRegistry()
+    if registry.add(names) or not path.exists(registry_path):
+        registry.save(registry_path)
+    return registry
+
+@functools.lru_cache(30)
+def get_registry(kind, data_split="train", ref="01_tcp_ar"):
+    """cached version of build_registry, checked for new names once per process
+    """
+    return build_registry(kind, data_split, ref)
+
+def encode_paths(edf_paths, kind, data_split="train", ref="01_tcp_ar", missing=-1):
+    """codes of the patient, session or token of each edf token path
+
+    Returns
+    -------
+    np.ndarray
+        int64 array, missing for paths whose name isn't in the split
+    """
+    return get_registry(kind, data_split, ref).encode(get_names_from_paths(edf_paths, kind), missing=missing)
+
+def decode_codes(codes, kind, data_split="train", ref="01_tcp_ar"):
+    """names of the patient, session or token codes of a split"""
+    return get_registry(kind, data_split, ref).decode(codes)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="builds (or extends) the patient, session and token registries for a split")
+    parser.add_argument("data_split")
+    parser.add_argument("ref")
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+    for kind in REGISTRY_KINDS:
+        registry = build_registry(kind, args.data_split, args.ref, rebuild=args.rebuild)
+        print("{} {} codes, saved to {}".format(len(registry), kind, get_registry_path(kind, args.data_split, args.ref)))
@@ -176,11 +176,16 @@ class EdfDataGenerator(DataGenerator):
         return train_data_gen, validation_data_gen
 
 
+    def get_dataset_items(self, i):
+        if hasattr(self.dataset, "get_batch"): #dataset can read the whole batch in one pass
+            return self.dataset.get_batch(i)
+        return self.dataset[i]
+
     def get_x_y(self, i):
         if self.precache:
             data = [self.dataset[j] for j in i]
         elif self.xy_tuple_form:
-            data = self.dataset[i]
+            data = self.get_dataset_items(i)
         if self.xy_tuple_form:
             x = [datum[0] for datum in data]
             if self.labels is not None:
@@ -331,7 +336,7 @@ class DataGenMultipleLabels(EdfDataGenerator):
             data = [self.dataset[j] for j in i]
         else:
             # print("Using mp with dataset of size {}".format(len(i)))
-            data = self.dataset[i]
+            data = self.get_dataset_items(i)
 
         if self.xy_tuple_form:
             x = [datum[0] for datum in data]
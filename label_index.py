@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+import functools
+import os
+import data_reader as read
+
+class TseLabelIndex():
+    """Interval index over the tse events of many tokens, built once so labeling
+        windows doesn't have to read and filter a tse file per window.
+
+        Events are kept in flat arrays, sorted by token and then by start time.
+        Every token gets its own stretch of a single time axis (token id * span
+        + seconds), so the windows of many tokens are looked up with one
+        np.searchsorted. Assumes the events of a token don't overlap each other,
+        which holds for tse files since they partition the recording
+
+    Parameters
+    ----------
+    edf_tokens : list
+        paths of the edf files (or any token names) to index
+    tse_paths : list
+        tse file of each token, if None uses read.convert_edf_path_to_tse(token)
+
+    Attributes
+    ----------
+    categories : list
+        label names, label_code indexes into this
+    start : np.ndarray
+    end : np.ndarray
+        seconds from the start of the recording
+    label_code : np.ndarray
+    p : np.ndarray
+    token_id : np.ndarray
+        position in edf_tokens of the token each event belongs to
+    offsets : np.ndarray
+        the events of token i are offsets[i]:offsets[i + 1]
+
+    """
+    def __init__(self, edf_tokens, tse_paths=None):
+        if tse_paths is None:
+            tse_paths = [read.convert_edf_path_to_tse(token) for token in edf_tokens]
+        self.edf_tokens = list(edf_tokens)
+        self.token_ids = {token: i for i, token in enumerate(self.edf_tokens)}
+        self.categories = list(read.get_tse_label_categories())
+        category_codes = {label: code for code, label in enumerate(self.categories)}
+        starts, ends, label_codes, probs, counts = [], [], [], [], []
+        for tse_path in tse_paths:
+            tse_data = read.read_tse_file(tse_path)
+            for label in tse_data["label"].cat.categories:
+                if label not in category_codes:
+                    category_codes[label] = len(self.categories)
+                    self.categories.append(label)
+            file_codes = np.array([category_codes[label] for label in tse_data["label"].cat.categories], dtype=np.int64)
+            order = np.argsort(tse_data["start"].values, kind="mergesort")
+            starts.append(tse_data["start"].values[order])
+            ends.append(tse_data["end"].values[order])
+            label_codes.append(file_codes[tse_data["label"].cat.codes.values[order]])
+            probs.append(tse_data["p"].values[order])
+            counts.append(len(tse_data))
+        self.start = np.concatenate(starts) if len(starts) != 0 else np.zeros(0)
+        self.end = np.concatenate(ends) if len(ends) != 0 else np.zeros(0)
+        self.label_code = np.concatenate(label_codes) if len(label_codes) != 0 else np.zeros(0, dtype=np.int64)
+        self.p = np.concatenate(probs) if len(probs) != 0 else np.zeros(0)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.token_id = np.repeat(np.arange(len(counts)), counts)
+
+        #time axis shared by all tokens
+        self.span = (self.end.max() if len(self.end) != 0 else 0) + 1
+        self.key_start = self.start + self.token_id * self.span
+        self.key_end_max = np.maximum.accumulate(self.end + self.token_id * self.span) if len(self.end) != 0 else np.zeros(0)
+        label_names = np.array(self.categories, dtype=object)[self.label_code]
+        self.is_seizure = np.array(["sz" in label for label in label_names], dtype=bool)
+        self.is_background = label_names == "bckg"
+        self.cumulative_counts = {}
+
+    def __len__(self):
+        return len(self.start)
+
+    def get_token_ids(self, tokens, num_windows=None):
+        """token id of each token, a single token is repeated num_windows times"""
+        if type(tokens) == str:
+            return np.full(num_windows, self.token_ids[tokens], dtype=np.int64)
+        return np.array([self.token_ids[token] for token in tokens], dtype=np.int64)
+
+    def window_ranges(self, tokens, t0, t1):
+        """Events overlapping each window [t0, t1)
+
+        Parameters
+        ----------
+        tokens : list or str
+            token of each window, or one token for all of them
+        t0 : np.ndarray
+        t1 : np.ndarray
+            start and end of each window in seconds
+
+        Returns
+        -------
+        np.ndarray
+        np.ndarray
+            the events overlapping window j are lo[j]:hi[j]
+        """
+        t0 = np.atleast_1d(np.asarray(t0, dtype=np.float64))
+        t1 = np.atleast_1d(np.asarray(t1, dtype=np.float64))
+        token_ids = self.get_token_ids(tokens, len(t0))
+        offset = token_ids * self.span
+        hi = np.searchsorted(self.key_start, np.minimum(t1, self.span) + offset, side="left")
+        lo = np.searchsorted(self.key_end_max, np.maximum(t0, 0) + offset, side="right")
+        hi = np.minimum(hi, self.offsets[token_ids + 1])
+        lo = np.minimum(np.maximum(lo, self.offsets[token_ids]), hi)
+        return lo, hi
+
+    def count_in_windows(self, tokens, t0, t1, event_mask=None, mask_name=None):
+        """number of events (where event_mask is True, if given) overlapping each window [t0, t1)
+
+        Parameters
+        ----------
+        event_mask : np.ndarray
+            bool per event
+        mask_name : str
+            if given, the prefix sum of event_mask is kept under this name and reused
+        """
+        lo, hi = self.window_ranges(tokens, t0, t1)
+        if event_mask is None:
+            return hi - lo
+        if mask_name is not None and mask_name in self.cumulative_counts:
+            cumulative_count = self.cumulative_counts[mask_name]
+        else:
+            cumulative_count = np.concatenate([[0], np.cumsum(event_mask)])
+            if mask_name is not None:
+                self.cumulative_counts[mask_name] = cumulative_count
+        return cumulative_count[hi] - cumulative_count[lo]
+
+    def any_seizure(self, tokens, t0, t1):
+        """whether any event with "sz" in its label overlaps each window [t0, t1)"""
+        return self.count_in_windows(tokens, t0, t1, self.is_seizure, "seizure") > 0
+
+    def any_not_background(self, tokens, t0, t1):
+        """whether any event not labeled bckg overlaps each window [t0, t1)"""
+        return self.count_in_windows(tokens, t0, t1, ~self.is_background, "not_background") > 0
+
+    def overlapping(self, token, t0, t1):
+        """
+        Returns
+        -------
+        pd.DataFrame
+            the events of token overlapping [t0, t1), same columns as read.read_tse_file
+        """
+        lo, hi = self.window_ranges(token, [t0], [t1])
+        events = slice(lo[0], hi[0])
+        return pd.DataFrame({
+            "start": self.start[events],
+            "end": self.end[events],
+            "label": pd.Categorical.from_codes(self.label_code[events], categories=self.categories),
+            "p": self.p[events],
+            "duration": self.end[events] - self.start[events]},
+            columns=["start", "end", "label", "p", "duration"])
+
+    def labels_at(self, tokens, times):
+        """label code of the event at each time, i.e. the first event with
+            start <= t <= end, the same label read.expand_tse_file puts there
+            (where two events share a boundary, the earlier one wins).
+            -1 where no event covers t
+        """
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        token_ids = self.get_token_ids(tokens, len(times))
+        key_times = times + token_ids * self.span
+        events = np.searchsorted(self.key_end_max, key_times, side="left")
+        found = (events < self.offsets[token_ids + 1]) & (times >= 0) & (times < self.span)
+        events = np.where(found, events, 0)
+        found &= self.start[events] <= times if len(self) != 0 else found
+        return np.where(found, self.label_code[events], -1)
+
+    def get_label_names(self, label_codes):
+        """label names of label codes, None for -1"""
+        names = np.array(self.categories + [None], dtype=object)
+        return names[np.where(np.asarray(label_codes) == -1, len(self.categories), label_codes)]
+
+    def get_duration(self, token):
+        """end of the last event of token in seconds"""
+        token_id = self.token_ids[token]
+        if self.offsets[token_id] == self.offsets[token_id + 1]:
+            return 0
+        return self.end[self.offsets[token_id]:self.offsets[token_id + 1]].max()
+
+@functools.lru_cache(10)
+def load_label_index(data_split, ref, tse_version):
+    """TseLabelIndex of every token in a split, memoized per tse_version (see
+        get_label_index). Use get_label_index
+    """
+    return TseLabelIndex(read.get_all_token_file_names(data_split, ref))
+
+def get_label_index(data_split, ref):
+    """TseLabelIndex of every token in a split, built again only when a tse file
+        of the split was rewritten (its latest mtime changed) or tokens were
+        added or removed
+    """
+    tokens = read.get_all_token_file_names(data_split, ref)
+    tse_mtimes = [os.stat(read.convert_edf_path_to_tse(token)).st_mtime for token in tokens]
+    tse_version = (max(tse_mtimes) if len(tse_mtimes) != 0 else None, len(tokens))
+    return load_label_index(data_split, ref, tse_version)
@@ -19,6 +19,7 @@ from addict import Dict
 from keras.utils import multi_gpu_model
 import keras.optimizers
 import ensembleReader as er
+import label_index
 import time
 from sklearn.metrics import confusion_matrix, roc_auc_score, accuracy_score, log_loss
 from functools import lru_cache
@@ -106,20 +107,19 @@ class FileDataReader(util_funcs.MultiProcessingDataset):
         self.all_files = util_funcs.get_abs_files(util_funcs.get_abs_files(util_funcs.get_abs_files("/n/scratch2/ms994/medium_size/test/")), False)
         self.overlap = overlap
         self.unit_size = unit_size
+        self.max_size = max_size
+        self.split = split
+        self.use_mp = False
         if train_label_files_segs is not None:
             self.train_label_files_segs = train_label_files_segs
         elif cachedIndex is None:
-
-            def getFnAnn(tknFn):
-                labelFile = read.read_tse_file(tknFn + "/label.tse")
-                ann = er.generate_label_rolling_window(labelFile, pre_cooldown=0, post_cooldown=0,sample_time=0, num_seconds=2)
-                return tknFn, ann
             fileNames = util_funcs.get_abs_files(util_funcs.get_abs_files(util_funcs.get_abs_files(directory)), False)
-            self.train_label_files_segs = Parallel(4)([delayed(getFnAnn)(tknFn) for tknFn in fileNames])
+            self.indexDict = self.get_index_from_tse_files(fileNames)
+            if filename is None:
+                filename = "/n/scratch2/ms994/medium_size/" + split + "/20sindex.pkl"
+            pkl.dump(self.indexDict, open(filename, "wb"))
+            return
 
-        self.max_size = max_size
-        self.split = split
-        self.use_mp = False
         if cachedIndex is None:
             self.indexDict = Dict() #used to grab and set the indexes used to grab data from the fs
             currentInd = 0
@@ -143,6 +143,38 @@ class FileDataReader(util_funcs.MultiProcessingDataset):
             pkl.dump(self.indexDict, open(filename, "wb"))
         else:
             self.indexDict = cachedIndex
+
+    def get_index_from_tse_files(self, fileNames):
+        """Builds the index straight from the label.tse of each token directory with
+            one label_index.TseLabelIndex, labeling every overlap sized step of
+            every max_size window with one vectorized lookup per file. Steps get
+            their seizure label, or bckg for anything else, same as labeling with
+            er.generate_label_rolling_window without any cooldowns
+        """
+        tse_label_index = label_index.TseLabelIndex(fileNames, tse_paths=[tknFn + "/label.tse" for tknFn in fileNames])
+        step_offsets = np.arange(0, self.max_size, self.overlap)
+        step_index = pd.to_timedelta(step_offsets, unit="s")
+        indexDict = Dict()
+        currentInd = 0
+        for tknFn in fileNames:
+            max_segment_index = tse_label_index.get_duration(tknFn) / self.overlap
+            num_windows = max(int(np.floor(max_segment_index - self.max_size)), 0)
+            if num_windows == 0:
+                continue
+            startTimes = np.arange(num_windows) * self.max_size
+            step_times = (startTimes[:, None] + step_offsets[None, :]).reshape(-1)
+            step_labels = tse_label_index.get_label_names(tse_label_index.labels_at(tknFn, step_times))
+            step_labels = np.array([label if label is not None and "sz" in label else "bckg" for label in step_labels]).reshape(num_windows, -1)
+            for j, startTime in enumerate(startTimes):
+                labelSlice = pd.Series(step_labels[j], index=pd.Timedelta(seconds=startTime) + step_index)
+                indexDict[currentInd].start = startTime
+                indexDict[currentInd].edf_file = tknFn
+                indexDict[currentInd].label = not (labelSlice == "bckg").all()
+                indexDict[currentInd].time_seizure_label = (labelSlice != "bckg")
+                indexDict[currentInd].time_seizure_subtypes = labelSlice.apply(lambda x: constants.SEIZURE_SUBTYPES.index(x))
+                currentInd += 1
+        return indexDict
+
     def __len__(self):
         return len(self.indexDict)
     def  __getitem__(self, i):
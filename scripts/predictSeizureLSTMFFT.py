@@ -10,6 +10,7 @@ import numpy as np
 import numpy.random as random
 from os import path
 import data_reader as read
+import id_registry
 from keras import backend as K
 
 # from multiprocessing import Process
@@ -215,8 +216,7 @@ def update_data(edss, seizure_classification_only, seizure_classes_to_use, inclu
         patient_labels = [0 for i in range(len(edss))]
     else:
         patients = [datum[1][1] for datum in edss]
-        allPatient = list(set(patients))
-        patient_labels = [allPatient.index(patient) for patient in patients]
+        patient_labels = id_registry.get_registry("patient").encode(patients).tolist()
     seizure_detection_labels = [datum[1][0] for datum in edss]
     if include_seizure_type:
         seizure_class_labels = [datum[1][2] for datum in edss]
@@ -359,8 +359,9 @@ def get_data_generators(train_pkl,  valid_pkl, test_pkl, processed_train_pkl, pr
 
     #we want to have an actual string stored in record so we can do some more dissection on the segments, but we want an integer index when we run the code
     patients = [datum[1][1] for datum in train_edss]
-    allPatients = list(set(patients))
-    patientInd = [allPatients.index(patient) for patient in patients]
+    patient_registry = id_registry.get_registry("patient")
+    allPatients = patient_registry.names
+    patientInd = patient_registry.encode(patients).tolist()
     validPatientInd = [0 for i in range(len(valid_edss))] #we don't actually care about predicting valid patients, since the split should be patient wise
 
 
@@ -10,6 +10,7 @@ import numpy as np
 import numpy.random as random
 from os import path
 import data_reader as read
+import id_registry
 from keras import backend as K
 
 # from multiprocessing import Process
@@ -689,8 +690,7 @@ def update_data(edss, seizure_classification_only, seizure_classes_to_use, inclu
         remove_outlier_by_std_thresh=None
     else:
         patients = [datum[1][1] for datum in edss]
-        allPatient = list(set(patients))
-        patient_labels = [allPatient.index(patient) for patient in patients]
+        patient_labels = id_registry.get_registry("patient").encode(patients).tolist()
     seizure_detection_labels = [datum[1][0] for datum in edss]
     if include_seizure_type:
         seizure_class_labels = [datum[1][2] for datum in edss]
@@ -818,8 +818,9 @@ def get_data_generators(train_pkl,  valid_pkl, test_pkl, regenerate_data, use_st
 
     #we want to have an actual string stored in record so we can do some more dissection on the segments, but we want an integer index when we run the code
     patients = [datum[1][1] for datum in train_edss]
-    allPatients = list(set(patients))
-    patientInd = [allPatients.index(patient) for patient in patients]
+    patient_registry = id_registry.get_registry("patient")
+    allPatients = patient_registry.names
+    patientInd = patient_registry.encode(patients).tolist()
     validPatientInd = [0 for i in range(len(valid_edss))] #we don't actually care about predicting valid patients, since the split should be patient wise
 
 
@@ -896,30 +897,30 @@ def false_alarms_per_hour(fp, total_samps, num_seconds):
     return (fp / total_samps) * num_chances_per_hour
 
 @ex.capture
-def get_test_patient_edg(test_pkl, batch_size):
+def get_test_patient_edg(test_pkl, batch_size, patient_split="dev_test"):
     test_edss = pkl.load(open(test_pkl, "rb"))
     patients = [datum[1] for datum in test_edss]
-    allPatients = list(set(patients))
-    patientInd = [allPatients.index(patient) for patient in patients]
-    num_patients = len(allPatients)
+    patient_registry = id_registry.get_registry("patient", patient_split) #train and valid pkls come from the train split, test from dev_test
+    patientInd = patient_registry.encode(patients).tolist()
+    num_patients = len(patient_registry)
     # x_data = [datum[0] for datum in test_edss]
     test_edg = EdfDataGenerator(test_edss, labels=patientInd, n_classes=num_patients, batch_size=batch_size, shuffle=True, precache=True)
     return test_edg, num_patients
 
 @ex.capture
 def train_patient_accuracy_after_training(x_input, cnn_y, trained_model, train_pkl):
-    return test_patient_accuracy_after_training(x_input, cnn_y, trained_model, test_pkl=train_pkl)
+    return test_patient_accuracy_after_training(x_input, cnn_y, trained_model, test_pkl=train_pkl, patient_split="train")
 
 @ex.capture
 def valid_patient_accuracy_after_training(x_input, cnn_y, trained_model, valid_pkl):
-    return test_patient_accuracy_after_training(x_input, cnn_y, trained_model, test_pkl=valid_pkl)
+    return test_patient_accuracy_after_training(x_input, cnn_y, trained_model, test_pkl=valid_pkl, patient_split="train")
 
 
 
 @ex.capture
-def test_patient_accuracy_after_training(x_input, cnn_y, trained_model, lr, lr_decay, epochs, model_name, fit_generator_verbosity, test_pkl, num_patients=None):
+def test_patient_accuracy_after_training(x_input, cnn_y, trained_model, lr, lr_decay, epochs, model_name, fit_generator_verbosity, test_pkl, num_patients=None, patient_split="dev_test"):
     # if test_edg is None:
-    test_edg, num_patients = get_test_patient_edg(test_pkl=test_pkl)
+    test_edg, num_patients = get_test_patient_edg(test_pkl=test_pkl, patient_split=patient_split)
     # train_test_edg, valid_test_edg = test_edg.create_validation_train_split()
     patient_layer = Dense(num_patients, activation="softmax")(cnn_y)
     patient_model = Model(inputs=[x_input], outputs=[patient_layer])
@@ -11,6 +11,7 @@ import numpy as np
 import numpy.random as random
 from os import path
 import data_reader as read
+import id_registry
 from multiprocessing import Process
 import constants
 import util_funcs
@@ -131,14 +132,16 @@ def get_data_from_index_datum(dataset, i, index_datum, is_train = True, split="t
     yData = index_datum.time_seizure_label
     ySubtypeData = index_datum.time_seizure_subtypes
     split, patient, session, token = read.parse_edf_token_path_structure(index_datum.edf_file)
-    montage_data = read.gen_seizure_channel_labels(index_datum.edf_file[:-4] + ".lbl", width=pd.Timedelta(seconds=2)).loc[pd.Timedelta(seconds=index_datum.start):pd.Timedelta(seconds=index_datum.start+20)]
+    montage_start = index_datum.start + (-index_datum.start) % 2 #the expanded frame's 2 second grid starts at 0, its slice began at the first grid point at or after start
+    montage_times = np.arange(montage_start, index_datum.start + 20 + 1, 2)
+    montage_data = pd.DataFrame(read.get_montage_labels_at(index_datum.edf_file[:-4] + ".lbl", montage_times), index=pd.to_timedelta(montage_times, unit="s"), columns=constants.MONTAGE_COLUMNS)
     feature = { \
                'original_index': _int64_feature(index_datum.original_ind) if "original_ind" in index_datum.keys() else  _int64_feature(i) ,
                'data': _float_feature_list(xData[0].reshape(-1)), \
                'label': _int64_feature_list(yData.to_numpy().reshape(-1)), \
                'subtypeLabel': _int64_feature_list(ySubtypeData.to_numpy().reshape(-1)), \
-               'patient': _int64_feature(read.getAllTrainPatients().index(patient) if is_train else 0), \
-               'session': _int64_feature(read.getAllTrainSessions().index(session) if is_train else 0)
+               'patient': _int64_feature(id_registry.get_registry("patient").get_code(patient) if is_train else 0), \
+               'session': _int64_feature(id_registry.get_registry("session").get_code(session) if is_train else 0)
               }
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
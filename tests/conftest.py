@@ -0,0 +1,42 @@
+import sys
+from os import path
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import os
+import shutil
+import pytest
+from edf_fixtures import TEST_ROOT, SPLIT_DIRS, test_config, write_token, clear_split_caches
+
+@pytest.fixture(scope="session")
+def edf_corpus():
+    """Small read only corpus: three train tokens of two patients at different
+        sample rates (one with a slower aux channel) and one dev_test token
+
+    Returns
+    -------
+    dict
+        split -> edf paths
+    """
+    corpus = {
+        "train": [
+            write_token("train", "00000001", "s001_2015_01_01", "t000", 30, 256, (10.0, 17.5), seed=1),
+            write_token("train", "00000001", "s001_2015_01_01", "t001", 20, 250, (5.0, 12.25), seed=2),
+            write_token("train", "00000002", "s002_2016_02_02", "t000", 16, 400, (3.0, 6.0), aux_rate=100, seed=3)],
+        "dev_test": [
+            write_token("dev_test", "00000009", "s001_2015_01_01", "t000", 12, 512, (1.0, 3.0), seed=4)]}
+    clear_split_caches()
+    return corpus
+
+@pytest.fixture
+def scratch_split():
+    """Empty combined split that tests can write tokens into, cleared (along with
+        its manifest and registries) before and after each test
+    """
+    def clear():
+        shutil.rmtree(path.join(TEST_ROOT, "edf", "combined"), ignore_errors=True)
+        shutil.rmtree(path.join(test_config["cache_dir"], "corpus_manifest"), ignore_errors=True)
+        shutil.rmtree(path.join(test_config["cache_dir"], "id_registry"), ignore_errors=True)
+        clear_split_caches()
+    clear()
+    os.makedirs(SPLIT_DIRS["combined"])
+    yield "combined"
+    clear()
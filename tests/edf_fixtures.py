@@ -0,0 +1,114 @@
+"""Config and file writers for the tests. Importing this points the config at a
+    temporary directory, so it has to happen before anything imports util_funcs
+    (conftest.py imports it first)
+"""
+import sys
+import os
+from os import path
+import json
+import shutil
+import atexit
+import tempfile
+repo_root = path.join(path.dirname(path.abspath(__file__)), "..")
+sys.path.insert(0, repo_root)
+import numpy as np
+
+#util_funcs reads the config when it is imported, so the test config has to be in place before any test module imports the repo.
+#every split and cache points into a temporary directory, tests never touch the real corpus or caches
+TEST_ROOT = tempfile.mkdtemp(prefix="eeg_tests.")
+atexit.register(shutil.rmtree, TEST_ROOT, True)
+os.makedirs(path.join(TEST_ROOT, "eeg_root"))
+os.symlink(path.abspath(repo_root), path.join(TEST_ROOT, "eeg_root", "dbmi_eeg_clustering")) #channel names etc. are read from EEG_ROOT/dbmi_eeg_clustering/assets
+SPLIT_DIRS = {split: path.join(TEST_ROOT, "edf", split, "01_tcp_ar") for split in ["train", "dev_test", "combined"]}
+test_config = {
+    "EEG_ROOT": path.join(TEST_ROOT, "eeg_root") + "/",
+    "data_dir_root": path.join(TEST_ROOT, "edf"),
+    "train_01_tcp_ar": SPLIT_DIRS["train"],
+    "dev_test_01_tcp_ar": SPLIT_DIRS["dev_test"],
+    "combined_01_tcp_ar": SPLIT_DIRS["combined"], #scratch split, tests that rewrite files use this one
+    "cache_dir": path.join(TEST_ROOT, "cache")}
+json.dump(test_config, open(path.join(TEST_ROOT, "config.json"), "w"))
+os.environ["CONFIG_PATH"] = path.join(TEST_ROOT, "config.json")
+
+MONTAGE_LINES = ["FP1-F7", "F7-T3", "T3-T5", "T5-O1", "FP2-F8", "F8-T4", "T4-T6", "T6-O2", "A1-T3", "T3-C3", "C3-CZ",
+                 "CZ-C4", "C4-T4", "T4-A2", "FP1-F3", "F3-C3", "C3-P3", "P3-O1", "FP2-F4", "F4-C4", "C4-P4", "P4-O2"]
+LBL_SYMBOLS = ["(null)", "spsw", "gped", "pled", "eybl", "artf", "bckg", "seiz", "fnsz", "gnsz"]
+
+def write_edf(edf_path, duration, sample_rate, aux_rate=None, seed=0):
+    """Writes an edf file with the 21 common channels in shuffled order plus an
+        EKG channel and a PHOTIC channel (sampled at aux_rate, if given)
+
+    Returns
+    -------
+    dict
+        channel label -> samples written
+    """
+    import pyedflib
+    import util_funcs
+    random = np.random.RandomState(seed)
+    channel_labels = list(util_funcs.get_common_channel_names())
+    random.shuffle(channel_labels)
+    channel_labels = channel_labels[:10] + ["EEG EKG1-REF"] + channel_labels[10:] + ["PHOTIC-REF"]
+    sample_rates = [sample_rate] * (len(channel_labels) - 1) + [aux_rate if aux_rate is not None else sample_rate]
+    writer = pyedflib.EdfWriter(edf_path, len(channel_labels), file_type=pyedflib.FILETYPE_EDFPLUS)
+    writer.setSignalHeaders([dict(label=label, dimension="uV", sample_frequency=rate, physical_max=3000., physical_min=-3000., digital_max=32767, digital_min=-32768, transducer="", prefilter="") for label, rate in zip(channel_labels, sample_rates)])
+    signals = []
+    for j, rate in enumerate(sample_rates):
+        times = np.arange(int(duration * rate)) / rate
+        signals.append(100 * np.sin(2 * np.pi * (3 + j) * times) + 20 * random.randn(len(times)) + 50)
+    writer.writeSamples(signals)
+    writer.close()
+    return dict(zip(channel_labels, signals))
+
+def write_tse(tse_path, events):
+    """events is a list of (start, end, label)"""
+    with open(tse_path, "w") as f:
+        f.write("version = tse_v1.0.0\n\n")
+        for start, end, label in events:
+            f.write("{:.4f} {:.4f} {} 1.0000\n".format(start, end, label))
+
+def write_lbl(lbl_path, events):
+    """events is a list of (start, end, montage number, symbol), one label line each"""
+    with open(lbl_path, "w") as f:
+        f.write("version = lbl_v1.0.0\n\n")
+        for i, montage in enumerate(MONTAGE_LINES):
+            f.write("montage = {:2d}, {:<7s}: EEG {}-REF -- EEG {}-REF\n".format(i, montage, *montage.split("-")))
+        f.write("\nnumber_of_levels = 1\nlevel[0] = 1\n\n")
+        f.write("symbols[0] = {" + ", ".join("{}: '{}'".format(i, symbol) for i, symbol in enumerate(LBL_SYMBOLS)) + "}\n\n")
+        for start, end, montage, symbol in events:
+            probs = [1.0 if candidate == symbol else 0.0 for candidate in LBL_SYMBOLS]
+            f.write("label = {{0, 0, {:.4f}, {:.4f}, {}, [{}]}}\n".format(start, end, montage, ", ".join("{:.1f}".format(prob) for prob in probs)))
+
+def write_token(split, patient, session, token, duration, sample_rate, seizure, aux_rate=None, seed=0):
+    """Writes the edf, tse and lbl files of one token into a split. The seizure
+        (start, end) is fnsz in the tse file and on every third montage of the lbl file
+
+    Returns
+    -------
+    str
+        path of the edf file
+    """
+    session_dir = path.join(SPLIT_DIRS[split], patient[:3], patient, session)
+    os.makedirs(session_dir, exist_ok=True)
+    edf_path = path.join(session_dir, "{}_{}_{}.edf".format(patient, session.split("_")[0], token))
+    write_edf(edf_path, duration, sample_rate, aux_rate=aux_rate, seed=seed)
+    seizure_start, seizure_end = seizure
+    write_tse(edf_path[:-4] + ".tse", [(0, seizure_start, "bckg"), (seizure_start, seizure_end, "fnsz"), (seizure_end, duration, "bckg")])
+    lbl_events = []
+    for i in range(len(MONTAGE_LINES)):
+        lbl_events += [(0, seizure_start, i, "bckg"), (seizure_start, seizure_end, i, "fnsz" if i % 3 == 0 else "bckg"), (seizure_end, duration, i, "bckg")]
+    write_lbl(edf_path[:-4] + ".lbl", lbl_events)
+    return edf_path
+
+def bump_mtime(file_path, seconds=10):
+    """moves the mtime of a rewritten file forward, so the change is seen even on
+        filesystems with coarse timestamps
+    """
+    file_stat = os.stat(file_path)
+    os.utime(file_path, (file_stat.st_atime + seconds, file_stat.st_mtime + seconds))
+
+def clear_split_caches():
+    import corpus_manifest
+    import id_registry
+    corpus_manifest.get_manifest.cache_clear()
+    id_registry.get_registry.cache_clear()
@@ -0,0 +1,150 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import edf_fixtures
+import constants
+import util_funcs
+import data_reader as read
+import edf_cache
+import feature_store as fstore
+import label_index
+
+#everything cached on disk or in memory has to match a fresh computation, and has to be computed again once its source files change
+
+RESAMPLE = pd.Timedelta(seconds=constants.COMMON_DELTA)
+
+def rewrite_edf(edf_path, duration, sample_rate, seed):
+    """swaps in a new recording under the same path, while the reader pool may still hold the old one"""
+    new_path = edf_path + ".new.edf"
+    edf_fixtures.write_edf(new_path, duration, sample_rate, seed=seed)
+    os.replace(new_path, edf_path)
+    edf_fixtures.bump_mtime(edf_path)
+
+def test_cached_window_matches_filtered_recording(edf_corpus):
+    edf_path = edf_corpus["train"][0]
+    channels = util_funcs.get_common_channel_names()
+    preprocessor = read.EdfPreprocessor(channels=channels, fill_nans=False, dtype=np.float64)
+    filtered, channel_names, period = preprocessor.read(edf_path)
+    for start in [pd.Timedelta(seconds=0), pd.Timedelta(seconds=5.5), 1000]:
+        window, channel_names, period = edf_cache.read_cached_window(edf_path, start, pd.Timedelta(seconds=2), RESAMPLE, channels)
+        start_row = start if type(start) == int else int(round(start / RESAMPLE))
+        assert window.dtype == np.float32 and window.shape == (500, len(channels))
+        assert np.allclose(window, filtered[start_row:start_row + 500], atol=1e-3)
+    window, channel_names, period = edf_cache.read_cached_window(edf_path, pd.Timedelta(seconds=29), pd.Timedelta(seconds=2), RESAMPLE, channels)
+    assert np.isnan(window[250:]).all() #past the end of the 30 second recording
+
+def test_cached_window_follows_rewritten_file(tmp_path):
+    edf_path = str(tmp_path / "00000001_s001_t000.edf")
+    edf_fixtures.write_edf(edf_path, 8, 250, seed=7)
+    channels = util_funcs.get_common_channel_names()
+    old_cache_path = edf_cache.build_cached_recording(edf_path, RESAMPLE, channels)
+    before, _, _ = edf_cache.read_cached_window(edf_path, pd.Timedelta(seconds=1), pd.Timedelta(seconds=2), RESAMPLE, channels)
+
+    rewrite_edf(edf_path, 8, 250, seed=8)
+    assert edf_cache.get_cache_path(edf_path, RESAMPLE, channels) != old_cache_path
+    after, _, _ = edf_cache.read_cached_window(edf_path, pd.Timedelta(seconds=1), pd.Timedelta(seconds=2), RESAMPLE, channels)
+    expected, _, _ = read.EdfPreprocessor(channels=channels, fill_nans=False, dtype=np.float64).read(edf_path)
+    assert not np.allclose(before, after)
+    assert np.allclose(after, expected[250:750], atol=1e-3)
+
+def test_feature_store_round_trip(tmp_path):
+    store = fstore.FeatureStore(str(tmp_path))
+    data = pd.DataFrame(np.arange(12, dtype=np.float64).reshape(4, 3), index=pd.timedelta_range(0, periods=4, freq="1s"), columns=["a", "b", "c"])
+    item = (data, np.arange(5), {"label": "fnsz"})
+    store.save("ab01", item)
+    assert "ab01" in store and "ab02" not in store and store.load("ab02") is None
+    loaded = store.load("ab01")
+    assert type(loaded) == tuple and loaded[0].equals(data) and np.array_equal(loaded[1], item[1]) and loaded[2] == item[2]
+    store.save("ab03", np.ones(3))
+    assert np.array_equal(store.load("ab03"), np.ones(3))
+
+def test_feature_store_get_or_compute(tmp_path):
+    store = fstore.FeatureStore(str(tmp_path))
+    calls = []
+    def compute():
+        calls.append(1)
+        return np.arange(3)
+    assert np.array_equal(store.get_or_compute("cd01", compute), np.arange(3))
+    assert np.array_equal(store.get_or_compute("cd01", compute), np.arange(3))
+    assert len(calls) == 1 and store.hits == 1 and store.misses == 1
+    store.get_or_compute(None, compute) #items that can't be keyed are never stored
+    store.get_or_compute(None, compute)
+    assert len(calls) == 3 and store.hits == 1 and store.misses == 1
+
+def test_feature_keys_follow_files_and_parameters(tmp_path):
+    edf_path = str(tmp_path / "00000001_s001_t000.edf")
+    tse_path = edf_path[:-4] + ".tse"
+    edf_fixtures.write_edf(edf_path, 4, 250, seed=9)
+    edf_fixtures.write_tse(tse_path, [(0, 4, "bckg")])
+    key = fstore.get_source_key(edf_path, "EdfDataset", (1, 2), extra_paths=[tse_path])
+    assert key == fstore.get_source_key(edf_path, "EdfDataset", (1, 2), extra_paths=[tse_path])
+    assert key != fstore.get_source_key(edf_path, "EdfDataset", (1, 3), extra_paths=[tse_path])
+    assert fstore.get_layer_key(key, "Fft", (1,)) != fstore.get_layer_key(key, "Fft", (2,))
+    assert fstore.get_layer_key(None, "Fft", (1,)) is None
+    assert fstore.get_dataset_item_key([1, 2], 0) is None
+
+    edf_fixtures.write_tse(tse_path, [(0, 1, "bckg"), (1, 4, "fnsz")])
+    edf_fixtures.bump_mtime(tse_path)
+    tse_key = fstore.get_source_key(edf_path, "EdfDataset", (1, 2), extra_paths=[tse_path])
+    assert tse_key != key
+    rewrite_edf(edf_path, 4, 250, seed=10)
+    assert fstore.get_source_key(edf_path, "EdfDataset", (1, 2), extra_paths=[tse_path]) not in [key, tse_key]
+
+def test_fft_transformer_serves_stored_items(edf_corpus, tmp_path):
+    edf_dataset = read.EdfDataset("train", "01_tcp_ar", n_process=1, max_length=pd.Timedelta(seconds=4))
+    plain = read.EdfFFTDatasetTransformer(edf_dataset, n_process=1)
+    store = fstore.FeatureStore(str(tmp_path))
+    stored = read.EdfFFTDatasetTransformer(edf_dataset, n_process=1, feature_store=store)
+    first = [stored[i] for i in range(len(stored))]
+    second = [stored[i] for i in range(len(stored))]
+    assert store.misses == len(stored) and store.hits == len(stored)
+    for computed, loaded, expected in zip(first, second, [plain[i] for i in range(len(plain))]):
+        assert computed[0].equals(expected[0]) and loaded[0].equals(expected[0])
+        assert str(loaded[1]) == str(expected[1])
+    other_bins = read.EdfFFTDatasetTransformer(edf_dataset, n_process=1, feature_store=store, freq_bins=list(range(0, 40, 2)))
+    assert other_bins.get_feature_key(0) != stored.get_feature_key(0)
+
+def test_label_index_matches_tse_files(edf_corpus):
+    tokens = read.get_all_token_file_names("train", "01_tcp_ar")
+    index = label_index.get_label_index("train", "01_tcp_ar")
+    random = np.random.RandomState(0)
+    window_tokens = [tokens[i] for i in random.randint(len(tokens), size=300)]
+    t0 = random.uniform(-5, 35, 300)
+    t1 = t0 + random.uniform(0, 8, 300)
+    any_not_background = index.any_not_background(window_tokens, t0, t1)
+    any_seizure = index.any_seizure(window_tokens, t0, t1)
+    for j, token in enumerate(window_tokens):
+        tse_data = read.read_tse_file(read.convert_edf_path_to_tse(token))
+        overlapping = tse_data.loc[(tse_data.start < t1[j]) & (tse_data.end > t0[j])]
+        assert any_not_background[j] == (overlapping.label != "bckg").any()
+        assert any_seizure[j] == overlapping.label.astype(str).str.contains("sz").any()
+        assert np.allclose(index.overlapping(token, t0[j], t1[j]).start.values, overlapping.start.values)
+    for token in tokens:
+        expanded = read.expand_tse_file(read.read_tse_file(read.convert_edf_path_to_tse(token)), fully_expand=False)
+        labels = index.get_label_names(index.labels_at(token, expanded.index.total_seconds()))
+        assert (labels.astype(str) == expanded.values.astype(str)).all()
+        assert index.get_duration(token) == read.read_tse_file(read.convert_edf_path_to_tse(token)).end.max()
+
+def test_label_index_rebuilt_when_tse_changes(scratch_split):
+    edf_path = edf_fixtures.write_token(scratch_split, "00000003", "s001_2015_01_01", "t000", 10, 250, (2.0, 4.0))
+    index = label_index.get_label_index(scratch_split, "01_tcp_ar")
+    assert label_index.get_label_index(scratch_split, "01_tcp_ar") is index
+    assert index.any_seizure(edf_path, [3], [3.5])[0] and not index.any_seizure(edf_path, [6], [8])[0]
+
+    edf_fixtures.write_tse(read.convert_edf_path_to_tse(edf_path), [(0, 6, "bckg"), (6, 8, "gnsz"), (8, 10, "bckg")])
+    edf_fixtures.bump_mtime(read.convert_edf_path_to_tse(edf_path))
+    rebuilt = label_index.get_label_index(scratch_split, "01_tcp_ar")
+    assert rebuilt is not index
+    assert not rebuilt.any_seizure(edf_path, [3], [3.5])[0] and rebuilt.any_seizure(edf_path, [6], [8])[0]
+
+def test_montage_labels_follow_rewritten_lbl(tmp_path):
+    lbl_path = str(tmp_path / "00000001_s001_t000.lbl")
+    fp1_f7 = edf_fixtures.MONTAGE_LINES.index("FP1-F7")
+    edf_fixtures.write_lbl(lbl_path, [(0, 4, fp1_f7, "bckg"), (4, 6, fp1_f7, "seiz"), (6, 10, fp1_f7, "bckg")])
+    column = constants.MONTAGE_COLUMNS.index("FP1-F7")
+    assert list(read.get_montage_labels_at(lbl_path, [1, 5, 8])[:, column]) == [0, 1, 0]
+
+    edf_fixtures.write_lbl(lbl_path, [(0, 8, fp1_f7, "bckg"), (8, 10, fp1_f7, "seiz")])
+    edf_fixtures.bump_mtime(lbl_path)
+    assert list(read.get_montage_labels_at(lbl_path, [1, 5, 8.5])[:, column]) == [0, 0, 1]
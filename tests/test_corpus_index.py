@@ -0,0 +1,107 @@
+import os
+from os import path
+import numpy as np
+import pandas as pd
+import edf_fixtures
+import constants
+import data_reader as read
+import corpus_manifest
+import id_registry
+
+def walk_tokens(data_split):
+    """every edf file under a split, found the slow way"""
+    return sorted([path.join(dir_path, file_name) for dir_path, dir_names, file_names in os.walk(edf_fixtures.SPLIT_DIRS[data_split]) for file_name in file_names if file_name.endswith(".edf")])
+
+def test_manifest_matches_directory_walk(edf_corpus):
+    manifest = corpus_manifest.build_manifest("train", "01_tcp_ar")
+    assert sorted(manifest.tokens["edf_path"]) == walk_tokens("train") == sorted(edf_corpus["train"])
+    assert read.get_all_token_file_names("train", "01_tcp_ar") == manifest.tokens["edf_path"].tolist()
+    for token in manifest.tokens.itertuples():
+        split, patient, session, token_name = read.parse_edf_token_path_structure(token.edf_path)
+        assert (token.patient, token.session) == (patient, session)
+        assert token.tse_path == read.convert_edf_path_to_tse(token.edf_path)
+        assert token.lbl_path == read.get_associated_lbl(token.edf_path)
+        assert token.txt_path is None
+    assert sorted(manifest.session_dirs) == sorted(set(path.dirname(edf_path) for edf_path in edf_corpus["train"]))
+    assert read.getAllTrainPatients() == ["00000001", "00000002"]
+
+def test_manifest_picks_up_added_and_removed_tokens(scratch_split):
+    first = edf_fixtures.write_token(scratch_split, "00000003", "s001_2015_01_01", "t000", 4, 250, (1.0, 2.0))
+    assert corpus_manifest.build_manifest(scratch_split, "01_tcp_ar").tokens["edf_path"].tolist() == [first]
+
+    second = edf_fixtures.write_token(scratch_split, "00000003", "s001_2015_01_01", "t001", 4, 250, (1.0, 2.0))
+    edf_fixtures.bump_mtime(path.dirname(second)) #the saved listing of a dir is only reused while its mtime is unchanged
+    assert sorted(corpus_manifest.build_manifest(scratch_split, "01_tcp_ar").tokens["edf_path"]) == [first, second]
+
+    os.remove(first)
+    edf_fixtures.bump_mtime(path.dirname(second), seconds=20)
+    assert corpus_manifest.build_manifest(scratch_split, "01_tcp_ar").tokens["edf_path"].tolist() == [second]
+    assert corpus_manifest.build_manifest(scratch_split, "01_tcp_ar", rebuild=True).tokens["edf_path"].tolist() == [second]
+
+def test_id_registry_codes():
+    registry = id_registry.IdRegistry.from_values(["b", "a", "b"])
+    assert list(registry.names) == ["a", "b"] and "a" in registry and "c" not in registry
+    assert list(registry.encode(["a", "b", "c"])) == [0, 1, -1]
+    registry.add(["c", "a"])
+    assert registry.get_code("c") == 2 and list(registry.encode(["c", "a"])) == [2, 0]
+    assert list(registry.decode([2, 0, 1])) == ["c", "a", "b"]
+
+def test_id_registry_save_and_load(tmp_path):
+    registry = id_registry.IdRegistry(["x", "y"])
+    registry.save(str(tmp_path / "registry.pkl"))
+    assert list(id_registry.IdRegistry.load(str(tmp_path / "registry.pkl")).names) == ["x", "y"]
+    assert id_registry.IdRegistry.load(str(tmp_path / "missing.pkl")) is None
+
+def test_split_registries_match_old_positions(edf_corpus):
+    tokens = read.get_all_token_file_names("train", "01_tcp_ar")
+    assert list(id_registry.get_registry("patient").names) == read.getAllTrainPatients()
+    assert list(id_registry.get_registry("session").names) == read.getAllTrainSessions()
+    patient_codes = id_registry.encode_paths(tokens, "patient")
+    session_codes = id_registry.encode_paths(tokens, "session")
+    assert list(id_registry.encode_paths(tokens, "token")) == list(range(len(tokens)))
+    for token, patient_code, session_code in zip(tokens, patient_codes, session_codes):
+        split, patient, session, token_name = read.parse_edf_token_path_structure(token)
+        assert patient_code == read.getAllTrainPatients().index(patient)
+        assert session_code == read.getAllTrainSessions().index(session)
+    assert list(id_registry.decode_codes(patient_codes, "patient")) == [read.parse_edf_token_path_structure(token)[1] for token in tokens]
+
+def test_registry_codes_stay_put_when_patients_are_added(scratch_split):
+    edf_fixtures.write_token(scratch_split, "00000005", "s001_2015_01_01", "t000", 4, 250, (1.0, 2.0))
+    edf_fixtures.write_token(scratch_split, "00000007", "s001_2015_01_01", "t000", 4, 250, (1.0, 2.0))
+    assert list(id_registry.build_registry("patient", scratch_split).names) == ["00000005", "00000007"]
+
+    edf_fixtures.write_token(scratch_split, "00000006", "s001_2015_01_01", "t000", 4, 250, (1.0, 2.0))
+    edf_fixtures.bump_mtime(path.join(edf_fixtures.SPLIT_DIRS[scratch_split], "000"))
+    corpus_manifest.get_manifest.cache_clear()
+    registry = id_registry.build_registry("patient", scratch_split)
+    assert list(registry.names) == ["00000005", "00000007", "00000006"] #new names are appended, older codes don't move
+    assert list(id_registry.build_registry("patient", scratch_split, rebuild=True).names) == ["00000005", "00000006", "00000007"]
+
+def test_tokenize_lbl_file(tmp_path):
+    lbl_path = str(tmp_path / "00000001_s001_t000.lbl")
+    events = [(0, 2.5, 0, "bckg"), (2.5, 4.25, 0, "fnsz"), (0, 4.25, 21, "bckg"), (1, 3, 5, "gnsz")]
+    edf_fixtures.write_lbl(lbl_path, events)
+    lbl_file = read.tokenize_lbl_file(lbl_path)
+    assert lbl_file.montage_names == dict(enumerate(edf_fixtures.MONTAGE_LINES))
+    assert lbl_file.symbols == edf_fixtures.LBL_SYMBOLS
+    assert list(lbl_file.start) == [event[0] for event in events] and list(lbl_file.end) == [event[1] for event in events]
+    assert list(lbl_file.montage) == [event[2] for event in events]
+    assert list(lbl_file.level) == [0] * 4 and list(lbl_file.sublevel) == [0] * 4
+    assert [edf_fixtures.LBL_SYMBOLS[j] for j in lbl_file.probs.argmax(axis=1)] == [event[3] for event in events]
+    annotation = read.get_per_channel_annotation(lbl_path)
+    assert list(annotation.channel) == [edf_fixtures.MONTAGE_LINES[event[2]] for event in events]
+    assert list(annotation.columns[5:]) == edf_fixtures.LBL_SYMBOLS
+
+def test_montage_labels_match_expanded_frame(edf_corpus):
+    for edf_path in edf_corpus["train"]:
+        lbl_path = read.get_associated_lbl(edf_path)
+        expanded = read.gen_seizure_channel_labels(lbl_path, width=pd.Timedelta(seconds=1))
+        assert list(expanded.columns) == constants.MONTAGE_COLUMNS
+        seizure = read.read_tse_file(read.convert_edf_path_to_tse(edf_path)).query("label == 'fnsz'").iloc[0]
+        for time, row in expanded.iterrows():
+            seconds = time.total_seconds()
+            in_seizure = seizure.start <= seconds < seizure.end #lines share their boundaries, the later line in the file wins
+            for montage_column, value in row.items():
+                assert value == (in_seizure and edf_fixtures.MONTAGE_LINES.index(montage_column) % 3 == 0)
+        times = expanded.index.total_seconds()[::3]
+        assert np.array_equal(read.get_montage_labels_at(lbl_path, times), expanded.values[::3])
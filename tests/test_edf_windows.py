@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import edf_fixtures
+import constants
+import util_funcs
+import data_reader as read
+import edf_header_index
+from wf_analysis import filters
+
+#every window read has to line up with the whole recording read by edf_eeg_2_np at the same rate
+
+RESAMPLE = pd.Timedelta(seconds=constants.COMMON_DELTA)
+
+def read_full(edf_path, channels):
+    data, channel_names, period = read.edf_eeg_2_np(edf_path, resample=RESAMPLE, channels=channels, dtype=np.float64)
+    return data
+
+def get_rows(seconds):
+    return int(round(seconds / constants.COMMON_DELTA))
+
+@pytest.mark.parametrize("start_s,duration_s", [(0, 2), (1.5, 4), (3.004, 2.5), (7, 5)])
+def test_read_window_matches_full_recording(edf_corpus, start_s, duration_s):
+    channels = util_funcs.get_common_channel_names()
+    for edf_path in edf_corpus["train"] + edf_corpus["dev_test"]:
+        full = read_full(edf_path, channels)
+        window, channel_names, period = read.read_window(edf_path, start_s, duration_s, channels=channels, dtype=np.float64)
+        assert channel_names == channels and period == RESAMPLE
+        assert window.shape == (get_rows(duration_s), len(channels))
+        assert np.allclose(window, full[get_rows(start_s):get_rows(start_s) + len(window)])
+
+def test_read_window_aux_channel_at_its_own_rate(edf_corpus):
+    edf_path = edf_corpus["train"][2] #PHOTIC-REF is at 100 Hz, the rest at 400 Hz
+    full = read_full(edf_path, None)
+    window, channel_names, period = read.read_window(edf_path, 2.2, 3, dtype=np.float64)
+    assert channel_names == list(edf_header_index.get_header(edf_path).channel_labels)
+    assert np.allclose(window, full[get_rows(2.2):get_rows(2.2) + len(window)], equal_nan=True)
+
+def test_read_window_past_the_end_is_nan(edf_corpus):
+    edf_path = edf_corpus["train"][1] #20 seconds long
+    channels = util_funcs.get_common_channel_names()
+    full = read_full(edf_path, channels)
+    window, channel_names, period = read.read_window(edf_path, 18, 4, channels=channels, dtype=np.float64)
+    assert np.allclose(window[:get_rows(2)], full[get_rows(18):])
+    assert np.isnan(window[get_rows(2):]).all()
+
+def test_read_windows_matches_read_window(edf_corpus):
+    channels = util_funcs.get_common_channel_names()
+    first, second = edf_corpus["train"][:2]
+    requests = [(first, 4, 2), (second, 0, 3), (first, 1, 4), (first, 25, 2), (second, 19, 2)]
+    windows, channel_names, period = read.read_windows(requests, channels=channels, dtype=np.float64, max_gap_s=5)
+    assert windows.shape == (len(requests), get_rows(4), len(channels))
+    for window, (edf_path, start_s, duration_s) in zip(windows, requests):
+        expected, _, _ = read.read_window(edf_path, start_s, duration_s, channels=channels, dtype=np.float64)
+        assert np.allclose(window[:len(expected)], expected, equal_nan=True)
+        assert np.isnan(window[len(expected):]).all() #shorter windows are NaN padded
+
+def test_read_windows_needs_matching_channels(edf_corpus):
+    with pytest.raises(Exception):
+        read.read_windows([(edf_corpus["train"][0], 0, 1), (edf_corpus["train"][1], 0, 1)]) #same channels, different order
+
+@pytest.mark.parametrize("window_s,start_s", [(3, 0), (2.5, 4)])
+def test_stream_windows_match_filtered_recording(edf_corpus, window_s, start_s):
+    channels = util_funcs.get_common_channel_names()
+    for edf_path in edf_corpus["train"]:
+        full = read_full(edf_path, channels)[get_rows(start_s):]
+        expected = filters.StreamingSosFilter(1, 50, 1 / constants.COMMON_DELTA, order=5).filter(edf_path, full, channels)
+        windows = list(read.stream_windows(edf_path, window_s, channels=channels, start_s=start_s, dtype=np.float64))
+        assert all(len(window) == get_rows(window_s) for window in windows[:-1])
+        assert np.allclose(np.concatenate(windows), expected)
+
+def test_preprocessor_read_matches_full_recording(edf_corpus):
+    edf_path = edf_corpus["train"][0]
+    channels = util_funcs.get_common_channel_names()
+    full = read_full(edf_path, channels)
+    preprocessor = read.EdfPreprocessor(channels=channels, dtype=np.float64)
+    data, channel_names, period = preprocessor.read(edf_path)
+    expected = filters.sos_bandpass_filter(full, lowcut=1, highcut=50, fs=1 / constants.COMMON_DELTA, order=5, axis=0)
+    assert channel_names == channels and np.allclose(data, expected)
+
+    unfiltered = read.EdfPreprocessor(channels=channels, filter=False, fill_nans=False, dtype=np.float64)
+    data, channel_names, period = unfiltered.read(edf_path, start=pd.Timedelta(seconds=3), max_length=pd.Timedelta(seconds=2))
+    assert np.allclose(data, full[get_rows(3):get_rows(5) + 1])
+    windows, channel_names, period = unfiltered.read_windows([(edf_path, 3, 2), (edf_path, 10, 1)])
+    assert np.allclose(windows[0], full[get_rows(3):get_rows(5)])
+    assert np.allclose(windows[1, :get_rows(1)], full[get_rows(10):get_rows(11)])
+
+def test_preprocessor_read_window_filters_the_window(edf_corpus):
+    edf_path = edf_corpus["train"][1]
+    channels = util_funcs.get_common_channel_names()
+    preprocessor = read.EdfPreprocessor(channels=channels, dtype=np.float64)
+    data, channel_names, period = preprocessor.read_window(edf_path, 2, 3)
+    window, _, _ = read.read_window(edf_path, 2, 3, channels=channels, dtype=np.float64)
+    assert np.allclose(data, filters.sos_bandpass_filter(window, lowcut=1, highcut=50, fs=1 / constants.COMMON_DELTA, order=5, axis=0))
+    assert set(preprocessor.get_stage_stats().index) >= {"read", "select_channels", "filter"}
+
+def test_edf_eeg_2_df_matches_np(edf_corpus):
+    edf_path = edf_corpus["dev_test"][0]
+    data, channel_names, period = read.edf_eeg_2_np(edf_path, resample=RESAMPLE)
+    data_df = read.edf_eeg_2_df(edf_path, resample=RESAMPLE)
+    assert list(data_df.columns) == channel_names and np.allclose(data_df.values, data, equal_nan=True)
+    assert data_df.index[1] - data_df.index[0] == RESAMPLE
+
+def test_rewritten_file_gets_new_header_and_data(tmp_path):
+    edf_path = str(tmp_path / "00000001_s001_t000.edf")
+    edf_fixtures.write_edf(edf_path, 10, 250, seed=5)
+    channels = util_funcs.get_common_channel_names()
+    assert edf_header_index.get_header(edf_path).file_duration == 10
+    before, _, _ = read.read_window(edf_path, 1, 2, channels=channels, dtype=np.float64)
+
+    new_path = str(tmp_path / "new.edf")
+    signals = edf_fixtures.write_edf(new_path, 12, 250, seed=6)
+    os.replace(new_path, edf_path) #the pool still holds an idle handle on the old file
+    edf_fixtures.bump_mtime(edf_path)
+    assert edf_header_index.get_header(edf_path).file_duration == 12
+    after, _, _ = read.read_window(edf_path, 1, 2, channels=channels, dtype=np.float64)
+    assert not np.allclose(before, after)
+    assert np.allclose(after[:, 0], signals[channels[0]][250:750], atol=0.1) #within the edf quantization step
@@ -0,0 +1,110 @@
+import sys
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import numpy as np
+import pandas as pd
+import pytest
+import data_reader as read
+import ensembleReader as er
+
+#pd.Series implementations from before the label code rewrite, the new versions have to give the same labels
+
+def old_generate_label_rolling_window(ann, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1):
+    if post_cooldown is None:
+        post_cooldown = pre_cooldown
+    partial_expand = read.expand_tse_file(ann, fully_expand=False)
+    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, periods=int(ann.end.max()))
+    label_arr = pd.Series(index=timeInd, dtype=object).fillna("bckg")
+    def is_seiz_class(label):
+        if type(label) == pd.Series:
+            return label.apply(lambda data: "sz" in data)
+        return "sz" in label
+    for i, time_index in enumerate(partial_expand.index):
+        if is_seiz_class(partial_expand[i]):
+            label_arr[time_index] = partial_expand[i]
+        elif i != 0 and is_seiz_class(partial_expand[partial_expand.index[max(0,i-post_cooldown):i-1]]).any():
+            label_arr[time_index] = "postsz"
+        elif is_seiz_class(partial_expand.iloc[i:i+pre_cooldown]).any():
+            label_arr[time_index] = "presz"
+        elif is_seiz_class(partial_expand.iloc[i+pre_cooldown:i+pre_cooldown+sample_time]).any():
+            label_arr[time_index] = "sample"
+    return label_arr
+
+def old_seizure_series_annotate_times(raw_ann, pre_cooldown=5, post_cooldown=None, sample_time=5, num_seconds=1):
+    if post_cooldown is None:
+        post_cooldown = pre_cooldown
+    end_max = raw_ann.end.max() - raw_ann.end.max() % num_seconds
+    timeInd = pd.timedelta_range(freq=pd.Timedelta(seconds=num_seconds), start=0, end=end_max * pd.Timedelta(seconds=1))
+    labelTimeSeries = pd.Series("bckg", index=timeInd, dtype=object)
+    seizure_times = []
+    preseizure_cooldown_times = []
+    postseizure_cooldown_times = []
+    possible_sample_times = []
+    for i, label in raw_ann.iterrows():
+        if "sz" in label["label"].lower():
+            seizure_times.append((label.start, label.end, label.label))
+            preseizure_cooldown_times.append((max(0, label.start-pre_cooldown), label.start, "presz"))
+            possible_sample_times.append((max(0, label.start-pre_cooldown - sample_time), max(0, label.start-pre_cooldown), "sample"))
+            postseizure_cooldown_times.append((label.end, min(max(raw_ann.end), label.end+post_cooldown), "postsz"))
+    for times in [possible_sample_times, preseizure_cooldown_times, postseizure_cooldown_times, seizure_times]:
+        for start, end, label in times:
+            if start != end:
+                labelTimeSeries[pd.Timedelta(seconds=start):pd.Timedelta(seconds=end)] = label
+    return labelTimeSeries[pd.Timedelta(seconds=0):pd.Timedelta(seconds=end_max-num_seconds*2)]
+
+def random_ann(rng):
+    num_events = rng.randint(1, 8)
+    bounds = np.sort(np.round(rng.uniform(0, 120, num_events - 1), rng.choice([0, 2])))
+    bounds = np.concatenate([[0], bounds, [np.round(rng.uniform(120, 200), rng.choice([0, 2]))]])
+    labels = [rng.choice(["bckg", "fnsz", "gnsz"]) for i in range(num_events)]
+    return pd.DataFrame({
+        "start": bounds[:-1],
+        "end": bounds[1:],
+        "label": pd.Categorical(labels, categories=list(read.get_tse_label_categories())),
+        "p": 1.0})
+
+COOLDOWNS = [dict(), dict(pre_cooldown=3, post_cooldown=7, sample_time=10), dict(pre_cooldown=0, post_cooldown=0, sample_time=0)]
+
+def assert_same_series(old, new):
+    assert old.index.equals(new.index)
+    assert (old.values == new.values).all()
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rolling_window_matches_old(seed):
+    rng = np.random.RandomState(seed)
+    for i in range(10):
+        ann = random_ann(rng)
+        for kwargs in COOLDOWNS:
+            assert_same_series(old_generate_label_rolling_window(ann, **kwargs), er.generate_label_rolling_window(ann, **kwargs))
+
+def test_rolling_window_keeps_trailing_seizure_second():
+    ann = pd.DataFrame({
+        "start": [0.0, 10.0],
+        "end": [10.0, 20.5],
+        "label": pd.Categorical(["bckg", "fnsz"], categories=list(read.get_tse_label_categories())),
+        "p": 1.0})
+    labels = er.generate_label_rolling_window(ann)
+    assert_same_series(old_generate_label_rolling_window(ann), labels)
+    assert len(labels) == 21 and labels.iloc[-1] == "fnsz"
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("num_seconds", [1, 2, 4])
+def test_annotate_times_matches_old(seed, num_seconds):
+    rng = np.random.RandomState(seed)
+    for i in range(10):
+        ann = random_ann(rng)
+        for kwargs in COOLDOWNS:
+            assert_same_series(
+                old_seizure_series_annotate_times(ann.astype({"label": str}), num_seconds=num_seconds, **kwargs),
+                er.seizure_series_annotate_times(ann, num_seconds=num_seconds, **kwargs))
+
+@pytest.mark.parametrize("use_rolling", [False, True])
+def test_annotate_split_matches_series_functions(use_rolling):
+    rng = np.random.RandomState(0)
+    anns = [random_ann(rng) for i in range(10)]
+    files = ["token_{}.edf".format(i) for i in range(len(anns))]
+    label_func = er.generate_label_rolling_window if use_rolling else er.seizure_series_annotate_times
+    split = er.annotate_split(files, anns, use_rolling=use_rolling)
+    assert [file for file, labels in split] == files
+    for (file, labels), ann in zip(split, anns):
+        assert_same_series(label_func(ann), labels)
@@ -0,0 +1,110 @@
+import os
+import pytest
+from addict import Dict
+import util_funcs
+import dataContainer
+
+#items read through a forked worker pool have to reflect the dataset as it is now, not as it was when the pool was forked
+
+class SquareDataset(util_funcs.MultiProcessingDataset):
+    def __init__(self, num_items=12, n_process=2, executor="processes"):
+        self.num_items = num_items
+        self.n_process = n_process
+        self.executor = executor
+        self.offset = 0
+        self.verbose = False
+    def __len__(self):
+        return self.num_items
+    def __getitem__(self, i):
+        if self.should_use_mp(i):
+            return self.getItemSlice(i)
+        return i * i + self.offset
+
+class WrapperDataset(util_funcs.MultiProcessingDataset):
+    """reads its items from a dataset nested somewhere in inner"""
+    runtime_attributes = util_funcs.MultiProcessingDataset.runtime_attributes + ["reads"]
+    def __init__(self, inner, get_upstream):
+        self.inner = inner
+        self.get_upstream = get_upstream
+        self.n_process = 2
+        self.verbose = False
+        self.reads = 0
+    def __len__(self):
+        return 6
+    def __getitem__(self, i):
+        if self.should_use_mp(i):
+            return self.getItemSlice(i)
+        self.reads += 1
+        return (os.getpid(), self.get_upstream(self.inner)[i])
+
+class LabelDataset(util_funcs.MultiProcessingDataset):
+    def __init__(self, sampleInfo):
+        self.sampleInfo = sampleInfo
+        self.n_process = 2
+        self.verbose = False
+    def __len__(self):
+        return len(self.sampleInfo)
+    def __getitem__(self, i):
+        if self.should_use_mp(i):
+            return self.getItemSlice(i)
+        return self.sampleInfo[i].label
+
+@pytest.mark.parametrize("executor", ["processes", "threads", "serial"])
+def test_slices_match_single_items(executor):
+    dataset = SquareDataset(num_items=50, executor=executor)
+    assert dataset[:] == [i * i for i in range(50)]
+    assert dataset[5:40:3] == [i * i for i in range(5, 40, 3)]
+    assert dataset[[7, 3, 49]] == [49, 9, 2401]
+
+def test_pool_is_reused_until_an_attribute_changes():
+    dataset = SquareDataset()
+    dataset[:]
+    pool = util_funcs._DATASET_POOLS[id(dataset)]
+    dataset[2:5]
+    assert util_funcs._DATASET_POOLS[id(dataset)] is pool
+    dataset.verbose = False #runtime attributes don't restart the pool
+    dataset[:]
+    assert util_funcs._DATASET_POOLS[id(dataset)] is pool
+    dataset.offset = 100
+    assert dataset[:3] == [100, 101, 104]
+    assert util_funcs._DATASET_POOLS[id(dataset)] is not pool
+    pool = util_funcs._DATASET_POOLS[id(dataset)]
+    util_funcs.invalidate_pools()
+    dataset[:2]
+    assert util_funcs._DATASET_POOLS[id(dataset)] is not pool
+
+@pytest.mark.parametrize("inner,get_upstream", [
+    (SquareDataset(n_process=1), lambda inner: inner),
+    ([0, SquareDataset(n_process=1)], lambda inner: inner[1]),
+    ({"upstream": SquareDataset(n_process=1)}, lambda inner: inner["upstream"])], ids=["attribute", "list", "dict"])
+def test_upstream_changes_restart_the_pool(inner, get_upstream):
+    wrapper = WrapperDataset(inner, get_upstream)
+    items = wrapper[:]
+    assert [item[1] for item in items] == [i * i for i in range(6)] and all(item[0] != os.getpid() for item in items)
+    pool = util_funcs._DATASET_POOLS[id(wrapper)]
+    wrapper.reads = 0
+    wrapper[:]
+    assert util_funcs._DATASET_POOLS[id(wrapper)] is pool
+    get_upstream(inner).offset = 7
+    assert [item[1] for item in wrapper[:]] == [i * i + 7 for i in range(6)]
+
+def test_node_view_changes_restart_the_pool():
+    container = dataContainer.DataContainerV2(SquareDataset(n_process=1), n_process=2)
+    container.verbose = False
+    wrapper = WrapperDataset(dataContainer.NodeView(container, "source"), lambda inner: inner)
+    assert [item[1] for item in wrapper[:]] == [i * i for i in range(6)]
+    container.nodes["source"].dataset.offset = 3
+    assert [item[1] for item in wrapper[:]] == [i * i + 3 for i in range(6)]
+
+def test_sample_info_writes_restart_the_pool():
+    sampleInfo = Dict()
+    for i in range(6):
+        sampleInfo[i].label = 0
+    dataset = LabelDataset(sampleInfo)
+    assert dataset[:] == [0] * 6
+    assert isinstance(sampleInfo, util_funcs.TrackedDict) and isinstance(sampleInfo[3], util_funcs.TrackedDict)
+    sampleInfo[3].label = 5
+    assert dataset[:] == [0, 0, 0, 5, 0, 0]
+    sampleInfo[6] = Dict(label=2)
+    dataset.sampleInfo[6].label = 4 #new entries are tracked too
+    assert dataset[:] == [0, 0, 0, 5, 0, 0, 4]
@@ -10,11 +10,18 @@ import pyedflib
 from sacred.serializer import restore  # to return a stored sacred result back
 import multiprocessing as mp
 import queue
+import tempfile
+import resource
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+from concurrent.futures.process import BrokenProcessPool
 import constants
 from functools import lru_cache
 from imblearn.over_sampling import SMOTE, ADASYN
 from imblearn.under_sampling import RandomUnderSampler
 import string, random
+from addict import Dict
 
 
 root_path = "/home/ms994/" if "EEG_ROOT" not in os.environ.keys() else os.environ["EEG_ROOT"]
@@ -59,23 +66,362 @@ class ImbalancedClassResampler():
         self.fit(x, y)
         return self.transform(x, y)
 
+EXECUTORS = ["serial", "threads", "processes"]
+_IN_POOL_WORKER = False #set in pool workers, slices of datasets inside a worker are read serially
+_thread_state = threading.local() #same, for threads reading a slice
+_POOL_DATASETS = {} #pool key -> weakref to the dataset the pool serves, workers inherit it when forked
+_DATASET_POOLS = {} #id(dataset) -> DatasetWorkerPool
+_pool_keys = itertools.count()
+_result_block_keys = itertools.count()
+_pool_generation = 0 #bumped by invalidate_pools
+
+def _init_pool_worker(memory_budget=None):
+    global _IN_POOL_WORKER
+    _IN_POOL_WORKER = True
+    if memory_budget is not None:
+        #allocations past the budget raise MemoryError in the worker instead of getting the job killed
+        address_space = int(open("/proc/self/statm").read().split()[0]) * resource.getpagesize()
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        new_limit = address_space + memory_budget
+        if hard_limit != resource.RLIM_INFINITY:
+            new_limit = min(new_limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (new_limit, hard_limit))
+
+def _thread_get_item(dataset, i):
+    _thread_state.in_worker = True
+    return dataset[i]
+
+def _thread_call_method(dataset, method_name, indices):
+    _thread_state.in_worker = True
+    return getattr(dataset, method_name)(indices)
+
+def _pool_call_method(key, method_name, indices):
+    dataset = _POOL_DATASETS[key]()
+    return getattr(dataset, method_name)(indices)
+
+def _pool_get_items(key, indices, verbosity, result_block=None, first_position=0):
+    dataset = _POOL_DATASETS[key]()
+    results = []
+    for i in indices:
+        if verbosity is not None and i % verbosity == 0:
+            print("retrieving: {}".format(i))
+        results.append(dataset[i])
+    if result_block is not None:
+        return result_block.write(first_position, results)
+    return results
+
+def invalidate_pools():
+    """makes every dataset start new workers on its next slice, called by
+        TrackedDict for changes to state datasets share (i.e. labels written
+        into a sampleInfo dict)
+    """
+    global _pool_generation
+    _pool_generation += 1
+
+class TrackedDict(Dict):
+    """addict.Dict that calls invalidate_pools() whenever something in it is set
+        or deleted, so pool workers never read a stale copy of state that is
+        changed in place after they were forked (i.e. labels written into
+        sampleInfo). Nested Dicts are TrackedDicts too, see track_state
+    """
+    def __setitem__(self, name, value):
+        invalidate_pools()
+        super().__setitem__(name, track_state(value))
+
+    def __delitem__(self, name):
+        invalidate_pools()
+        super().__delitem__(name)
+
+def track_state(value):
+    """turns a plain addict.Dict (and the Dicts nested in it) into a TrackedDict
+        in place, so every object already holding it sees the writes tracked
+    """
+    if type(value) == Dict:
+        object.__setattr__(value, "__class__", TrackedDict) #Dict.__setattr__ would store it as a key
+        for nested in value.values():
+            track_state(nested)
+    return value
+
+def find_datasets(values, seen=None):
+    """MultiProcessingDatasets among values, looking inside lists, tuples and
+        dicts, and through wrappers that have a get_upstream_datasets method
+        (i.e. dataContainer.NodeView)
+    """
+    if seen is None:
+        seen = set()
+    datasets = []
+    to_check = list(values)
+    while len(to_check) != 0:
+        value = to_check.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, MultiProcessingDataset):
+            datasets.append(value)
+        elif isinstance(value, (list, tuple)):
+            to_check += [nested for nested in value if not isinstance(nested, (str, bytes, int, float))]
+        elif isinstance(value, dict):
+            to_check += [nested for nested in value.values() if not isinstance(nested, (str, bytes, int, float))]
+        elif not isinstance(value, type) and hasattr(value, "get_upstream_datasets"):
+            to_check += list(value.get_upstream_datasets())
+    return datasets
+
+def get_shm_dir():
+    """where shared result blocks are memory mapped from, "shm_dir" from the
+        config, else /dev/shm (so pages never get written to disk) if there is one
+    """
+    if "shm_dir" in read_config():
+        return read_config()["shm_dir"]
+    return "/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class SharedResultBlock():
+    """Memory mapped arrays, preallocated for all the items of a slice, that
+        pool workers write their results into. Only what doesn't fit in the
+        arrays (labels, DataFrame index and columns) is pickled back to the
+        parent, and the items the parent returns are views into the arrays, so
+        the data is never copied through a pipe or held twice
+
+        The layout comes from one probe item: an ndarray or a DataFrame with a
+        single numeric dtype, or a tuple of those and anything else. Items that
+        don't match it (different shape, dtype or type) are sent back whole
+
+    Parameters
+    ----------
+    probe : object
+        an item of the dataset
+    num_items : int
+        rows to allocate
+    """
+    def __init__(self, probe, num_items):
+        self.is_tuple = type(probe) == tuple
+        self.layout = []
+        self.paths = []
+        block_key = next(_result_block_keys)
+        for part_num, part in enumerate(probe if self.is_tuple else (probe,)):
+            kind = SharedResultBlock.get_kind(part)
+            if kind is None:
+                self.layout.append(None)
+                self.paths.append(None)
+                continue
+            values = part if kind == "ndarray" else part.values
+            self.layout.append((kind, values.shape, values.dtype.str, None if kind == "ndarray" else list(part.columns)))
+            self.paths.append(path.join(get_shm_dir(), "mpd_result_{}_{}_{}.dat".format(os.getpid(), block_key, part_num)))
+        self.num_items = num_items
+        self.blocks = [None if part_layout is None else np.memmap(block_path, dtype=part_layout[2], mode="w+", shape=(num_items,) + part_layout[1]) for part_layout, block_path in zip(self.layout, self.paths)]
+
+    @staticmethod
+    def get_kind(part):
+        if type(part) == np.ndarray and part.dtype != object and part.size != 0:
+            return "ndarray"
+        if type(part) == pd.DataFrame and part.size != 0 and len(set(part.dtypes)) == 1 and part.values.dtype != object:
+            return "dataframe"
+        return None
+
+    def is_usable(self):
+        return any([part_layout is not None for part_layout in self.layout])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["blocks"] = None #workers map the files themselves
+        return state
+
+    def matches(self, item):
+        parts = item if self.is_tuple else (item,)
+        if (type(item) == tuple) != self.is_tuple or len(parts) != len(self.layout):
+            return False
+        for part, part_layout in zip(parts, self.layout):
+            if part_layout is None:
+                continue
+            kind, shape, dtype, columns = part_layout
+            if SharedResultBlock.get_kind(part) != kind:
+                return False
+            values = part if kind == "ndarray" else part.values
+            if values.shape != shape or values.dtype.str != dtype or (kind == "dataframe" and list(part.columns) != columns):
+                return False
+        return True
+
+    def write(self, first_position, items):
+        """Writes items into rows first_position onwards, called in the workers
+
+        Returns
+        -------
+        list
+            what has to be sent back for each item, ("item", item) if it didn't
+            fit the layout, otherwise ("block", parts) with None in place of
+            every part that was written to the arrays, except a DataFrame's index
+        """
+        blocks = [None if part_layout is None else np.memmap(block_path, dtype=part_layout[2], mode="r+", shape=(self.num_items,) + part_layout[1]) for part_layout, block_path in zip(self.layout, self.paths)]
+        sent_back = []
+        for position, item in enumerate(items, first_position):
+            if not self.matches(item):
+                sent_back.append(("item", item))
+                continue
+            parts = []
+            for part, part_layout, block in zip(item if self.is_tuple else (item,), self.layout, blocks):
+                if part_layout is None:
+                    parts.append(part)
+                elif part_layout[0] == "ndarray":
+                    block[position] = part
+                    parts.append(None)
+                else:
+                    block[position] = part.values
+                    parts.append(part.index)
+            sent_back.append(("block", parts))
+        del blocks #unmaps in the worker, the parent keeps its own mapping
+        return sent_back
+
+    def read(self, position, sent_back):
+        """item at position, rebuilt from what write sent back"""
+        how, parts = sent_back
+        if how == "item":
+            return parts
+        item = []
+        for part, part_layout, block in zip(parts, self.layout, self.blocks):
+            if part_layout is None:
+                item.append(part)
+            elif part_layout[0] == "ndarray":
+                item.append(block[position].view(np.ndarray))
+            else:
+                item.append(pd.DataFrame(block[position].view(np.ndarray), index=part, columns=part_layout[3]))
+        return tuple(item) if self.is_tuple else item[0]
+
+    def unlink(self):
+        """removes the files, the parent's mapping (and every view into it) stays valid"""
+        for block_path in self.paths:
+            if block_path is not None and path.exists(block_path):
+                os.remove(block_path)
+
+class DatasetWorkerPool():
+    """Long lived pool of forked processes serving the items of one dataset.
+        Workers get the dataset by inheriting it when they are forked, so it
+        never has to be pickled, and the pool is reused by later slices of the
+        same dataset until its pool version changes
+
+    Parameters
+    ----------
+    dataset : MultiProcessingDataset
+    n_process : int
+    version : tuple
+        invalidate_pools generation and dataset.get_pool_version() when the
+        pool was started
+    memory_budget : int
+        if set, bytes each worker may grow its address space by
+    """
+    def __init__(self, dataset, n_process, version, memory_budget=None):
+        self.key = next(_pool_keys)
+        self.n_process = n_process
+        self.version = version
+        self.broken = False
+        _POOL_DATASETS[self.key] = weakref.ref(dataset)
+        self.executor = ProcessPoolExecutor(max_workers=n_process, mp_context=mp.get_context("fork"), initializer=_init_pool_worker, initargs=(memory_budget,))
+
+    def map_chunks(self, chunks, verbosity=None, result_block=None, first_positions=None):
+        """Reads every chunk of indices in the workers
+
+        Parameters
+        ----------
+        chunks : list
+            lists of indices
+        result_block : SharedResultBlock
+            if given, workers write into it, chunk k starting at row first_positions[k]
+
+        Returns
+        -------
+        list
+            the items of each chunk (what SharedResultBlock.write sent back, if
+            result_block is given), in order. None for a chunk that was lost
+            because a worker died (i.e. SLURM killed it for using too much memory)
+            or ran out of memory
+        """
+        if first_positions is None:
+            first_positions = [0 for chunk in chunks]
+        futures = [self.executor.submit(_pool_get_items, self.key, chunk, verbosity, result_block, first_position) for chunk, first_position in zip(chunks, first_positions)]
+        return self.gather(futures)
+
+    def map_method(self, method_name, chunks):
+        """Calls dataset.method_name(chunk) in the workers for every chunk of
+            indices, results in order, None for a chunk that was lost (see map_chunks)
+        """
+        futures = [self.executor.submit(_pool_call_method, self.key, method_name, chunk) for chunk in chunks]
+        return self.gather(futures)
+
+    def gather(self, futures):
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                self.broken = True
+                results.append(None)
+            except MemoryError:
+                results.append(None)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        _POOL_DATASETS.pop(self.key, None)
+
+def _close_dataset_pool(dataset_id):
+    pool = _DATASET_POOLS.pop(dataset_id, None)
+    if pool is not None:
+        pool.shutdown()
+
+def get_dataset_pool(dataset, n_process, verbose=True):
+    """worker pool of a dataset, starting a new one if there is none yet, the old
+        one broke, or the dataset was invalidated since its workers were forked
+    """
+    version = (_pool_generation, dataset.get_pool_version())
+    pool = _DATASET_POOLS.get(id(dataset))
+    if pool is not None and not pool.broken and pool.n_process == n_process and pool.version == version:
+        return pool
+    _close_dataset_pool(id(dataset))
+    if verbose:
+        print("Starting {} processes".format(n_process))
+    pool = DatasetWorkerPool(dataset, n_process, version)
+    _DATASET_POOLS[id(dataset)] = pool
+    weakref.finalize(dataset, _close_dataset_pool, id(dataset))
+    return pool
+
 class MultiProcessingDataset():
     """Class to help improve speed of looking up multiple records at once using multiple processes.
         Was originally going to be designed around batch loading in, but was just used as a way to more quickly
         populate an array-like into memory
 
             Just make this the parent class, then call the getItemSlice method on slice objects
+        Slices are read by a DatasetWorkerPool that is kept around for the
+            dataset, so only the first slice pays for starting processes. Indices
+            are sent to the workers in chunks (chunk_size attribute, by default
+            about 4 chunks per process) and results come back in order
+        executor picks how slices are read: "processes" (the worker pool),
+            "threads" (for datasets dominated by file io or numpy/scipy calls
+            that release the GIL, items are read by n_process threads with
+            nothing forked or pickled) or "serial". Subclasses set their own
+            default, use_mp = False still forces a serial loop
+        Arrays and DataFrames of the same shape as the first item of a slice
+            are written by the workers into a SharedResultBlock instead of
+            being pickled back, set use_shared_memory = False to turn that off
         Issues:
             Doesn't solve original problem of being optimized for keras batches, only solves
                 the fact that I needed some dataset that could quickly use multiple cores to
                 get data. Use the models in keras_models.dataGen
-            SLURM opaquely kills processes if it consume too much memory, so we gotta
-                double check and see that there are placeholders in the toReturn array left
-            The toReturn array uses integer placeholders (representing logical indices of the
-                dataset ). If the returning datatype returned by indexing is also
-                an integer, then this won't work
-            Recovery from OOM is single threaded. Maybe we wanna make this
-                use mp if this becomes a new bottleneck?
+            SLURM opaquely kills processes if it consume too much memory, so items
+                lost with a dead worker (or a MemoryError) are read again by a
+                new pool with half the processes, each allowed to grow by
+                retry_memory_budget bytes (attribute or config, defaults to
+                the physical memory split between the processes), halving
+                until a single process is left. Whatever is still missing is
+                read in this process. last_retried_indices has the indices
+                that needed a retry in the last slice
+            Workers keep the copy of the dataset they were forked with, so
+                setting an attribute of a dataset (or of a dataset it reads
+                from) bumps its pool_version and the next slice starts new
+                workers. Attributes in runtime_attributes (statistics, progress
+                output) are left out. addict.Dicts set as attributes become
+                TrackedDicts, so writes into them (i.e. sampleInfo labels) are
+                caught as well. Anything else changed in place needs an
+                explicit invalidate_pool()
+            Items returned from the shared block are views, rows of one slice
+                share a single mapping that is freed when none of them is left
 
 
     """
@@ -86,6 +432,52 @@ class MultiProcessingDataset():
     #     self.queue = self.manager.Queue()
     #     self.get_process = mp.Process(target=background_caching, )
     #     self.background_data = [i for i in range(len(self))]
+    executor = "processes"
+    pool_version = 0
+    runtime_attributes = ["pool_version", "last_retried_indices", "verbose", "verbosity"] #workers don't read these, setting them keeps the pool
+
+    def __setattr__(self, name, value):
+        if name not in self.runtime_attributes:
+            value = track_state(value)
+            self.__dict__["pool_version"] = self.pool_version + 1 #workers forked before this have the old value
+        object.__setattr__(self, name, value)
+
+    def invalidate_pool(self):
+        """stops the workers, the next slice forks new ones with the dataset as it is then"""
+        self.pool_version += 1
+        self.close_pool()
+
+    def get_pool_version(self, seen=None):
+        """pool_version of this dataset and of the MultiProcessingDatasets it
+            reads from, so invalidating an inner dataset also restarts the
+            workers of the datasets built on it
+        """
+        if seen is None:
+            seen = set()
+        seen.add(id(self))
+        versions = [self.pool_version]
+        for value in self.get_upstream_datasets():
+            if id(value) not in seen:
+                versions.append(value.get_pool_version(seen))
+        return tuple(versions)
+
+    def get_upstream_datasets(self):
+        """MultiProcessingDatasets reachable from the attributes, see find_datasets.
+            Only looked for again when pool_version changes, since attributes
+            can't be replaced without changing it
+        """
+        cached = self.__dict__.get("_upstream_datasets")
+        if cached is None or cached[0] != self.pool_version:
+            attributes = [value for name, value in self.__dict__.items() if name != "_upstream_datasets"]
+            cached = (self.pool_version, find_datasets(attributes, seen=set([id(self)])))
+            self.__dict__["_upstream_datasets"] = cached
+        return cached[1]
+
+    def get_executor(self):
+        if self.executor not in EXECUTORS:
+            raise Exception("executor has to be one of {}, not {}".format(EXECUTORS, self.executor))
+        return self.executor
+
     def should_use_mp(self, i):
         return type(i) == slice
 
@@ -93,58 +485,130 @@ class MultiProcessingDataset():
         return type(i) == slice or type(i) == list
 
     def getItemSlice(self, i):
-        #assign index as placeholder for result in toReturn
         if type(i) == slice:
-            placeholder = [j for j in range(*i.indices(len(self)))] #use to look up correct index because using the ".index" method in an array holding arrays leads to comparison error
-            toReturn = [j for j in range(*i.indices(len(self)))]
+            indices = [j for j in range(*i.indices(len(self)))]
         elif type(i) == list: #indexing by list
-            placeholder = [j for j in i]
-            toReturn = [j for j in i]
-        if hasattr(self, "use_mp") and self.use_mp == False: #in case it makes more sense to just use a loop instead of dealing with overhead of starting processes
-            for i, j in enumerate(toReturn):
-                toReturn[i] = self[j]
-            return toReturn
-        manager = mp.Manager()
-        inQ = manager.Queue()
-        outQ = manager.Queue()
-        if self.n_process > 1: #otherwise use for loop
-            [inQ.put(j) for j in toReturn]
-            [inQ.put(None) for j in range(self.n_process)]
-            processes = [
-                mp.Process(
-                    target=self.helper_process,
-                    args=(
-                        inQ,
-                        outQ)) for j in range(
-                    self.n_process)]
-            if not hasattr(self, "verbose") or self.verbose == True:
-                print("Starting {} processes".format(self.n_process))
-            [p.start() for p in processes]
-            [p.join() for p in processes]
-            startIndex = toReturn[0]
-        while not outQ.empty():
-            place, res = outQ.get()
-            index = placeholder.index(place)
-            if type(res) == int:
-                if not hasattr(self, "verbose") or self.verbose == True:
-                    print("SLURM sent OOM event, retrying: ", res)
-                res = self[place] #slurm sent oom event, we gotta try again.
-            toReturn[index] = res
-        for index, res in enumerate(toReturn):
-            if type(res) == int:
-                toReturn[index] = self[res]
+            indices = [j for j in i]
+        self.last_retried_indices = []
+        executor = self.get_executor()
+        if not self.can_use_workers(len(indices)):
+            #in case it makes more sense to just use a loop instead of dealing with overhead of processes, or we are already in a worker
+            return [self[j] for j in indices]
+        if executor == "threads":
+            with ThreadPoolExecutor(max_workers=self.n_process) as thread_pool:
+                return list(thread_pool.map(lambda j: _thread_get_item(self, j), indices))
+        verbose = not hasattr(self, "verbose") or self.verbose == True
+        if verbose and not hasattr(self, "verbosity"):
+            self.verbosity = 250
+        verbosity = self.verbosity if verbose else None
+        pool = get_dataset_pool(self, self.n_process, verbose=verbose)
+        toReturn = [None for j in indices] #results are placed by position in indices
+        missing = [] #positions lost with a dead worker
+        result_block = None
+        start = 0
+        if (not hasattr(self, "use_shared_memory") or self.use_shared_memory) and len(indices) > 1:
+            #read one item first to get the layout of the block the others are written into
+            start = 1
+            first_results = pool.map_chunks([indices[:1]], verbosity)[0]
+            if first_results is None:
+                missing.append(0)
+            else:
+                toReturn[0] = first_results[0]
+                result_block = SharedResultBlock(toReturn[0], len(indices))
+                result_block = result_block if result_block.is_usable() else None
+        chunk_size = self.chunk_size if hasattr(self, "chunk_size") and self.chunk_size is not None else max(1, int(np.ceil((len(indices) - start) / (self.n_process * 4))))
+        first_positions = [j for j in range(start, len(indices), chunk_size)]
+        chunks = [indices[j:j + chunk_size] for j in first_positions]
+        if pool.broken:
+            chunk_results = [None for chunk in chunks]
+        else:
+            try:
+                chunk_results = pool.map_chunks(chunks, verbosity, result_block, first_positions)
+            finally:
+                if result_block is not None:
+                    result_block.unlink()
+        for chunk, first_position, results in zip(chunks, first_positions, chunk_results):
+            if results is None:
+                missing += [j for j in range(first_position, first_position + len(chunk))]
+                continue
+            if result_block is not None:
+                results = [result_block.read(position, sent_back) for position, sent_back in enumerate(results, first_position)]
+            toReturn[first_position:first_position + len(chunk)] = results
+        if len(missing) != 0:
+            self.retry_missing(indices, missing, toReturn, verbose)
         return toReturn
-        # return Pool().map(self.__getitem__, toReturn)
-
-    def helper_process(self, in_q, out_q):
-        for i in iter(in_q.get, None):
-            if not hasattr(self, "verbose") or self.verbose == True:
-                if not hasattr(self, "verbosity"):
-                    self.verbosity = 250
-                if i % self.verbosity == 0:
-                    print("retrieving: {}".format(i))
-            out_q.put((i, self[i]))
 
+    def can_use_workers(self, num_items):
+        """whether num_items should be spread over the executor, False if use_mp
+            is off, the executor is serial, there is a single process, or we
+            are already in a worker
+        """
+        if (hasattr(self, "use_mp") and self.use_mp == False) or self.get_executor() == "serial" or self.n_process <= 1 or _IN_POOL_WORKER or getattr(_thread_state, "in_worker", False) or num_items == 0:
+            return False
+        return True
+
+    def map_method(self, method_name, chunks):
+        """Calls self.method_name(chunk) for every chunk of indices on the
+            executor (worker pool or threads), for datasets that read a whole
+            chunk at once (i.e. get_batch). Chunks lost with a dead worker are
+            read again in this process
+
+        Returns
+        -------
+        list
+            result of each chunk, in order
+        """
+        if self.get_executor() == "threads":
+            with ThreadPoolExecutor(max_workers=self.n_process) as thread_pool:
+                return list(thread_pool.map(lambda chunk: _thread_call_method(self, method_name, chunk), chunks))
+        pool = get_dataset_pool(self, self.n_process, verbose=not hasattr(self, "verbose") or self.verbose == True)
+        chunk_results = [None for chunk in chunks] if pool.broken else pool.map_method(method_name, chunks)
+        return [getattr(self, method_name)(chunk) if results is None else results for chunk, results in zip(chunks, chunk_results)]
+
+    def get_retry_memory_budget(self, n_process):
+        """bytes each retry process may grow by"""
+        if hasattr(self, "retry_memory_budget") and self.retry_memory_budget is not None:
+            return self.retry_memory_budget
+        if "retry_memory_budget" in read_config():
+            return read_config()["retry_memory_budget"]
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // n_process
+
+    def retry_missing(self, indices, missing, toReturn, verbose=True):
+        """Reads the items lost to dead workers again, into toReturn
+
+        Parameters
+        ----------
+        indices : list
+            dataset indices of the slice
+        missing : list
+            positions in indices (and toReturn) that are still missing
+        toReturn : list
+            results of the slice, filled in place
+        """
+        self.last_retried_indices = [indices[position] for position in missing]
+        if verbose:
+            print("SLURM sent OOM event, retrying: ", self.last_retried_indices)
+        n_process = self.n_process // 2
+        while len(missing) != 0 and n_process >= 1:
+            retry_pool = DatasetWorkerPool(self, n_process, None, memory_budget=self.get_retry_memory_budget(n_process))
+            try:
+                results = retry_pool.map_chunks([[indices[position]] for position in missing])
+            finally:
+                retry_pool.shutdown()
+            still_missing = []
+            for position, result in zip(missing, results):
+                if result is None:
+                    still_missing.append(position)
+                else:
+                    toReturn[position] = result[0]
+            missing = still_missing
+            n_process = n_process // 2
+        for position in missing:
+            toReturn[position] = self[indices[position]] #slurm sent oom event, we gotta try again.
+
+    def close_pool(self):
+        """stops the worker processes of this dataset, if there are any"""
+        _close_dataset_pool(id(self))
 
 
 
@@ -154,6 +618,34 @@ def np_rolling_window(a, window):
     strides = a.strides + (a.strides[-1],)
     return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
 
+def np_ffill_bfill(a):
+    """numpy version of df.fillna(method="ffill").fillna(method="bfill") for a
+        time by channel array, so numpy data doesn't have to go through a DataFrame
+
+    Parameters
+    ----------
+    a : np.ndarray
+        2d array, time is the first axis
+
+    Returns
+    -------
+    np.ndarray
+        a, if there was nothing to fill, otherwise a filled copy
+
+    """
+    is_nan = np.isnan(a)
+    if not is_nan.any():
+        return a
+    rows = np.arange(a.shape[0])[:, None]
+    columns = np.arange(a.shape[1])
+    last_valid = np.where(is_nan, 0, rows)
+    np.maximum.accumulate(last_valid, axis=0, out=last_valid)
+    filled = a[last_valid, columns]
+    first_valid = np.argmax(~is_nan, axis=0) #rows before the first valid value get backfilled
+    before_first_valid = rows < first_valid
+    filled[before_first_valid] = np.broadcast_to(a[first_valid, columns], a.shape)[before_first_valid]
+    return filled
+
 
 def get_sacred_runs():
     return get_mongo_client().sacred.runs
@@ -202,6 +694,15 @@ def get_file_sizes(split, ref):
     assert ref in get_reference_node_types()
     return pd.read_csv(path.join(root_path, "dbmi_eeg_clustering/assets/{}_{}_file_lengths.csv".format(split, ref)), header=None, index_col=[0])
 
+def get_cache_dir(name):
+    """Directory to persist derived data (indices, caches) under, created if needed.
+        Uses "cache_dir" from the config, else a cache folder in the repo
+    """
+    cache_root = read_config()["cache_dir"] if "cache_dir" in read_config() else path.join(root_path, "dbmi_eeg_clustering/cache")
+    cache_dir = path.join(cache_root, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
 
 @lru_cache(10)
 def get_annotation_csv():
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import util_funcs
+import feature_store as fstore
 import wf_analysis.filters as filters
 import pywt
 import tsfresh.feature_extraction.feature_calculators as feats
@@ -106,6 +107,7 @@ class EdfDWTDatasetTransformer(util_funcs.MultiProcessingDataset):
         wavelet="db1",
         return_ann=True,
         max_coef=None,
+        feature_store=None,
     ):
         """Used to read the raw data in
 
@@ -125,6 +127,10 @@ class EdfDWTDatasetTransformer(util_funcs.MultiProcessingDataset):
             If true, the windows are used to reduce dim red, we don't use rolling-like behavior
         return_ann : bool
             If false, we just output the raw data
+        feature_store : bool, str or feature_store.FeatureStore
+            If set, items are looked up in (and added to) this store, keyed by
+            the key of the edf_dataset item and the wavelet parameters. Items
+            of an edf_dataset without get_feature_key are computed every time
         Returns
         -------
         None
@@ -136,23 +142,32 @@ class EdfDWTDatasetTransformer(util_funcs.MultiProcessingDataset):
         self.n_process = n_process
         self.precache = False
         self.return_ann = return_ann
+        self.wavelet = wavelet #set before precaching, the items need them
+        self.max_coef = max_coef
+        self.feature_store = fstore.get_feature_store(feature_store)
         if precache:
             print(
                 "starting precache job with: {} processes".format(
                     self.n_process))
             self.data = self[:]
         self.precache = precache
-        self.wavelet = wavelet
-        self.max_coef = max_coef
 
     def __len__(self):
         return len(self.edf_dataset)
 
+    def get_feature_key(self, i):
+        return fstore.get_layer_key(fstore.get_dataset_item_key(self.edf_dataset, i), type(self).__name__, (self.wavelet, self.max_coef, self.return_ann))
+
     def __getitem__(self, i):
         if self.precache:
             return self.data[i]
         if self.should_use_mp(i):
             return self.getItemSlice(i)
+        if self.feature_store is not None:
+            return self.feature_store.get_or_compute(self.get_feature_key(i), lambda: self.compute_item(i))
+        return self.compute_item(i)
+
+    def compute_item(self, i):
         original_data = self.edf_dataset[i]
         return original_data.apply(
             lambda x: pywt.dwt(
@@ -319,11 +334,11 @@ class BandPassTransformer(util_funcs.MultiProcessingDataset):
         bandPassColumns = [
             rawDataColumn +
             str(freqs) for rawDataColumn in rawData.columns for freqs in self.bandpass_freqs]
-        newBandPass = pd.DataFrame(columns=[bandPassColumns])
-        for rawDataColumn in rawData.columns:
-            for freqs in self.bandpass_freqs:
-                lp, hp = freqs
-                singChannelData = rawData[rawDataColumn]
-                newBandPass[rawDataColumn + str(freqs)] = filters.butter_bandpass_filter(
-                    singChannelData, lp, hp, constants.COMMON_FREQ, order=self.order)
+        bandPassData = []
+        for freqs in self.bandpass_freqs: #every channel filtered at once per band
+            lp, hp = freqs
+            bandPassData.append(filters.sos_bandpass_filter(
+                rawData.values, lp, hp, constants.COMMON_FREQ, order=self.order, axis=0))
+        bandPassData = np.stack(bandPassData, axis=2).reshape(rawData.shape[0], -1) #same column order as bandPassColumns
+        newBandPass = pd.DataFrame(bandPassData, columns=[bandPassColumns])
         return newBandPass, ann
@@ -1,4 +1,6 @@
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, lfilter, sosfilt
+import functools
+import numpy as np
 
 # https://scipy-cookbook.readthedocs.io/items/ButterworthBandpass.html
 
@@ -11,11 +13,101 @@ def butter_bandpass(lowcut, highcut, fs, order=5):
     return b, a
 
 
-def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
+def butter_bandpass_filter(data, lowcut, highcut, fs, order=5, axis=-1):
     b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-    y = lfilter(b, a, data)
+    y = lfilter(b, a, data, axis=axis)
     return y
 
+@functools.lru_cache(100)
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    """Second order sections version of butter_bandpass, designed once per
+        (lowcut, highcut, fs, order). Numerically more stable than b, a for a low
+        lowcut relative to fs
+    """
+    nyq = 0.5 * fs
+    low = lowcut / nyq
+    high = highcut / nyq
+    return butter(order, [low, high], btype='band', output='sos')
+
+
+def sos_bandpass_filter(data, lowcut, highcut, fs, order=5, axis=0):
+    """Bandpass filters every channel of data at once along axis with a cached
+        second order sections design
+
+    Parameters
+    ----------
+    data : np.ndarray
+        i.e. a (time, channel) array, or (batch, time, channel) with axis=1
+    lowcut : float
+    highcut : float
+    fs : float
+        sample rate of data, in Hz
+    order : int
+    axis : int
+        time axis of data
+
+    Returns
+    -------
+    np.ndarray
+        filtered data, float32 if data was float32 and float64 otherwise
+    """
+    data = np.asarray(data)
+    sos = butter_bandpass_sos(float(lowcut), float(highcut), float(fs), order)
+    out_dtype = np.float32 if data.dtype == np.float32 else np.float64
+    return sosfilt(sos, data, axis=axis).astype(out_dtype, copy=False)
+
+class StreamingSosFilter():
+    """Bandpass filter that keeps the sosfilt state of every (token, channel) between
+        calls, so a recording can be filtered as a sequence of consecutive chunks
+        and give the same output as filtering the whole recording at once
+
+    Parameters
+    ----------
+    lowcut : float
+    highcut : float
+    fs : float
+        sample rate of the chunks, in Hz
+    order : int
+
+    """
+    def __init__(self, lowcut, highcut, fs, order=5):
+        self.sos = butter_bandpass_sos(float(lowcut), float(highcut), float(fs), order)
+        self.states = {} #(token, channel) -> (n_sections, 2) zi
+
+    def filter(self, token, data, channels):
+        """Filters the next chunk of token along axis 0, continuing from where the
+            previous chunk of each channel left off (zero state for a new channel)
+
+        Parameters
+        ----------
+        token : str
+            i.e. the edf path, chunks of different tokens don't share state
+        data : np.ndarray
+            time by channel chunk
+        channels : list
+            channel label of each column of data
+
+        Returns
+        -------
+        np.ndarray
+            filtered chunk, float32 if data was float32 and float64 otherwise
+        """
+        data = np.asarray(data)
+        zero_state = np.zeros((self.sos.shape[0], 2))
+        zi = np.stack([self.states.get((token, channel), zero_state) for channel in channels], axis=-1)
+        filtered, zf = sosfilt(self.sos, data, axis=0, zi=zi)
+        for j, channel in enumerate(channels):
+            self.states[(token, channel)] = zf[..., j]
+        out_dtype = np.float32 if data.dtype == np.float32 else np.float64
+        return filtered.astype(out_dtype, copy=False)
+
+    def reset(self, token=None):
+        """Forgets the state of token, or of every token if None"""
+        if token is None:
+            self.states = {}
+        else:
+            self.states = {key: state for key, state in self.states.items() if key[0] != token}
+
 def butter_lp_filter(data, lowcut, fs, order=5):
     nyq = 0.5 * fs #just get the highest freq possible (nyquist, and bandgap it!)
     hc = nyq * 0.9 #can't accept exactly nyq
@@ -0,0 +1,82 @@
+from scipy.signal import resample_poly, firwin
+from fractions import Fraction
+import functools
+import numpy as np
+
+
+@functools.lru_cache(100)
+def get_polyphase_filter(up, down):
+    """Same low pass FIR that scipy.signal.resample_poly designs by default, but
+        only designed once per ratio instead of on every call
+    """
+    max_rate = max(up, down)
+    f_c = 1. / max_rate  # cutoff of FIR filter (rel. to Nyquist)
+    half_len = 10 * max_rate  # reasonable cutoff for our sinc-like function
+    return firwin(2 * half_len + 1, f_c, window=('kaiser', 5.0))
+
+
+class PolyphaseResampler():
+    """Resamples blocks of channels sharing a sample rate from native_rate to
+        target_rate with a polyphase filter, i.e. upsample by up, low pass, then
+        downsample by down in one step
+
+    Parameters
+    ----------
+    native_rate : float
+        sample rate of the input, in Hz
+    target_rate : float
+        sample rate of the output, in Hz
+
+    Attributes
+    ----------
+    up : int
+    down : int
+        the ratio target_rate/native_rate in lowest terms
+    context : int
+        number of input samples the filter needs on either side of a window to
+        give the same output as resampling the whole signal. Always a multiple
+        of down, so dropping the context keeps the output on the same grid
+    """
+    def __init__(self, native_rate, target_rate):
+        self.native_rate = native_rate
+        self.target_rate = target_rate
+        ratio = Fraction(target_rate).limit_denominator(1000) / Fraction(native_rate).limit_denominator(1000)
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        if self.up == self.down:
+            self.filter = None
+            self.context = 0
+            return
+        self.filter = get_polyphase_filter(self.up, self.down)
+        half_len_in_input = int(np.ceil((len(self.filter) // 2) / self.up))
+        self.context = int(np.ceil(half_len_in_input / self.down)) * self.down
+
+    def num_output_samples(self, num_input_samples):
+        return int(np.ceil(num_input_samples * self.up / self.down))
+
+    def num_context_output_samples(self, num_context_samples):
+        return num_context_samples * self.up // self.down
+
+    def __call__(self, data, axis=0):
+        """Resamples the whole block at once along axis
+
+        Parameters
+        ----------
+        data : np.ndarray
+            time by channel array, or any array with time on axis
+
+        Returns
+        -------
+        np.ndarray
+            float64 array with num_output_samples(data.shape[axis]) along axis
+        """
+        if self.up == self.down:
+            return data
+        return resample_poly(data, self.up, self.down, axis=axis, window=self.filter)
+
+
+@functools.lru_cache(100)
+def get_resampler(native_rate, target_rate):
+    """Resamplers (and their filters) are cached per (native_rate, target_rate) pair
+    """
+    return PolyphaseResampler(native_rate, target_rate)